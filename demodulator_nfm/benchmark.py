@@ -0,0 +1,307 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+from demodulator_bank import DemodulatorBankNFM
+from demodulator_model import LPF_SOS
+from demodulator_nfm import DemodulatorNFM
+from nfm_reference import adc_iq_simple, apply_lpf_iir, apply_pfd_simple
+from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+from sos_filter import SosFilter
+
+# Benchmarked code paths:
+# model           - reference stage functions (adc_iq_simple, apply_lpf_iir, apply_pfd_simple, see nfm_reference.py)
+# demodulate_nfm  - DemodulatorNFM, sample by sample
+# demodulate_block - DemodulatorNFM (DemodulatorBankNFM for several channels), block processing
+CASES = ('model', 'demodulate_nfm', 'demodulate_block')
+# Cases processing one sample per Python loop iteration, they run single channel only
+LOOP_CASES = ('demodulate_nfm',)
+# Cases with time of every stage measured by instrumentation in one extra run (not included in the throughput)
+BREAKDOWN_CASES = ('demodulate_block',)
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_CHANNELS = [1, 8]
+DEFAULT_DTYPES = ['float64', 'float32', 'int16']
+DEFAULT_REPEATS = 3
+# Loop cases are skipped for longer inputs, they would take minutes
+DEFAULT_MAX_LOOP_SAMPLES = 1000000
+# Block cases get the input in blocks of this size, so memory does not grow with the input length
+DEFAULT_BLOCK_SIZE = 1 << 20
+# Allowed relative degradation of throughput and peak memory before it is reported as regression
+DEFAULT_TOLERANCE = 0.1
+# Peak memory below this difference is never reported as regression (allocator noise)
+MEMORY_SLACK_BYTES = 64 * 1024
+# Full scale of int16 input samples
+INT16_FULL_SCALE = 0.9 * np.iinfo(np.int16).max
+
+# Parameters of the demodulated signal (testbench set #3)
+BENCHMARK_CONFIG = complete_config(TESTBENCH_PARAMETER_SETS[2])
+
+
+# This function generates samples [start, start + count) of FM signal modulated with the tones of config.
+# Phase of the modulation is calculated in closed form, so the signal may be generated block by block.
+# Every channel gets its own carrier phase. Returns array (channels x count), 1-D for one channel.
+def generate_input(config, start, count, channels_cnt, dtype):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    time_vector = np.arange(start, start + count) / sampling_freq
+    phase = 2 * np.pi * config['carrier_freq'] * time_vector
+    for freq, amplitude in zip(config['mod_freq_list'], config['mod_amp_list']):
+        phase += config['freq_sensitivity'] * amplitude * (1 - np.cos(2 * np.pi * freq * time_vector)) / freq
+    if channels_cnt > 1:
+        phase = phase + np.linspace(0, 2 * np.pi, channels_cnt, endpoint=False)[:, None]
+    signal = config['carrier_amplitude'] * np.cos(phase)
+    if np.dtype(dtype) == np.int16:
+        return np.round(signal * INT16_FULL_SCALE).astype(np.int16)
+    return signal.astype(dtype)
+
+
+# Floating point type of the pipeline for the input dtype. Integer input runs in float32, which holds int16
+# samples exactly (adc_iq_simple converts it to float32 as well).
+def pipeline_dtype(dtype):
+    dtype = np.dtype(dtype)
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float32)
+
+
+# Runs model stage functions on the input block by block, returns time of every stage summed over blocks.
+# Blocks are whole periods of the local oscillator (adc_iq_simple starts the oscillator at every call),
+# the filters keep their state, and the last discriminator_delay I/Q samples are prepended to the next block
+# (apply_pfd_simple output is shorter than its input by the delay).
+def _run_model(config, samples_cnt, channels_cnt, dtype, block_size):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=False)
+    discriminator_delay = demodulator.init(config['discriminator_delay_ratio'], config['carrier_freq'],
+                                           sum(config['mod_amp_list']), config['freq_sensitivity'])
+    local_osc_period = demodulator.local_osc_period
+    block_size = max(local_osc_period, block_size - block_size % local_osc_period)
+    channels_shape = () if channels_cnt == 1 else (channels_cnt,)
+    filter_dtype = pipeline_dtype(dtype)
+    filters = [SosFilter(LPF_SOS, channels_shape, filter_dtype) for _ in range(4)]
+    i_tail = np.zeros(channels_shape + (0,), dtype=filter_dtype)
+    q_tail = i_tail
+    stages = dict.fromkeys(('adc_iq_simple', 'apply_lpf_iir', 'apply_pfd_simple', 'apply_lpf_iir_output'), 0.0)
+
+    for block_start in range(0, samples_cnt, block_size):
+        signal = generate_input(config, block_start, min(block_size, samples_cnt - block_start), channels_cnt, dtype)
+
+        start_time = time.perf_counter()
+        [_, i_vect, q_vect] = adc_iq_simple(config['receiver_sampling_freq'], sampling_freq, signal)
+        stages['adc_iq_simple'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        [_, i_vect, q_vect] = apply_lpf_iir(i_vect, q_vect, filters[0], filters[1])
+        stages['apply_lpf_iir'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        i_vect = np.concatenate((i_tail, i_vect), axis=-1)
+        q_vect = np.concatenate((q_tail, q_vect), axis=-1)
+        i_tail = i_vect[..., -discriminator_delay:]
+        q_tail = q_vect[..., -discriminator_delay:]
+        [re_vect, im_vect] = apply_pfd_simple(i_vect, q_vect, discriminator_delay)
+        stages['apply_pfd_simple'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        apply_lpf_iir(re_vect, im_vect, filters[2], filters[3])
+        stages['apply_lpf_iir_output'] += time.perf_counter() - start_time
+
+    return stages
+
+
+def _run_demodulate_nfm(config, samples_cnt, channels_cnt, dtype, block_size):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=False,
+                                 dtype=pipeline_dtype(dtype))
+    demodulator.init(config['discriminator_delay_ratio'], config['carrier_freq'], sum(config['mod_amp_list']),
+                     config['freq_sensitivity'])
+    signal = generate_input(config, 0, samples_cnt, channels_cnt, dtype)
+
+    start_time = time.perf_counter()
+    for sample in signal:
+        demodulator.demodulate_nfm(sample)
+    return {'demodulate_nfm': time.perf_counter() - start_time}
+
+
+# Runs demodulate_block block by block, input generation is not timed.
+# The demodulator runs in pipeline_dtype of the input, input is converted to it by demodulate_block.
+# Returns time of the conversion and of demodulate_block summed over blocks. With instrumented=True
+# instrumentation is enabled and time of every stage is returned instead of the time of demodulate_block,
+# it includes the cost of the instrumentation, so it is used for the breakdown only.
+def _run_demodulate_block(config, samples_cnt, channels_cnt, dtype, block_size, instrumented=False):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    demodulator_dtype = pipeline_dtype(dtype)
+    if channels_cnt == 1:
+        demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=False,
+                                     dtype=demodulator_dtype)
+        demodulator.init(config['discriminator_delay_ratio'], config['carrier_freq'], sum(config['mod_amp_list']),
+                         config['freq_sensitivity'], config['decimation_factor'])
+    else:
+        demodulator = DemodulatorBankNFM(sampling_freq, config['oversampling_ratio'], verbose=False,
+                                         dtype=demodulator_dtype)
+        demodulator.init(np.full(channels_cnt, config['discriminator_delay_ratio']), config['carrier_freq'],
+                         sum(config['mod_amp_list']), config['freq_sensitivity'],
+                         decimation_factor=config['decimation_factor'])
+    instrumentation = demodulator.enable_instrumentation() if instrumented else None
+    convert_time = 0.0
+    demodulate_time = 0.0
+
+    for block_start in range(0, samples_cnt, block_size):
+        samples = generate_input(config, block_start, min(block_size, samples_cnt - block_start), channels_cnt, dtype)
+        start_time = time.perf_counter()
+        samples = np.asarray(samples, dtype=demodulator_dtype)
+        convert_time += time.perf_counter() - start_time
+        demodulator.demodulate_block(samples)
+        demodulate_time += time.perf_counter() - start_time
+
+    stages = {'convert': convert_time}
+    if instrumentation is None:
+        stages['demodulate_block'] = demodulate_time - convert_time
+    else:
+        stages.update(instrumentation.stage_time)
+    return stages
+
+
+_CASE_RUNNERS = {
+    'model': _run_model,
+    'demodulate_nfm': _run_demodulate_nfm,
+    'demodulate_block': _run_demodulate_block,
+}
+
+
+# This function benchmarks one case. Time is measured repeats times and the fastest run is reported,
+# peak memory is measured by tracemalloc in one extra run (tracing slows down the code, so it is not timed).
+# Cases of BREAKDOWN_CASES get the time of every stage from one more instrumented run (stage_breakdown).
+def benchmark_case(case, samples_cnt, channels_cnt, dtype, repeats=DEFAULT_REPEATS, block_size=DEFAULT_BLOCK_SIZE,
+                   config=BENCHMARK_CONFIG):
+    runner = _CASE_RUNNERS[case]
+    best_stages = None
+    for _ in range(repeats):
+        stages = runner(config, samples_cnt, channels_cnt, dtype, block_size)
+        if best_stages is None or sum(stages.values()) < sum(best_stages.values()):
+            best_stages = stages
+
+    tracemalloc.start()
+    try:
+        start_memory, _ = tracemalloc.get_traced_memory()
+        runner(config, samples_cnt, channels_cnt, dtype, block_size)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = sum(best_stages.values())
+    return {
+        'case': case,
+        'samples': samples_cnt,
+        'channels': channels_cnt,
+        'dtype': dtype,
+        'seconds': seconds,
+        'samples_per_s': samples_cnt * channels_cnt / seconds if seconds > 0 else float('inf'),
+        'stages': best_stages,
+        'stage_breakdown': runner(config, samples_cnt, channels_cnt, dtype, block_size, instrumented=True)
+        if case in BREAKDOWN_CASES else None,
+        'peak_memory_bytes': peak_memory - start_memory,
+    }
+
+
+# Runs all combinations of cases, sizes, channel counts and dtypes.
+# Loop cases run only for one channel and up to max_loop_samples samples.
+# Returns report: dictionary with description of the environment and list of results.
+def run_benchmarks(cases=CASES, sizes=DEFAULT_SIZES, channels=DEFAULT_CHANNELS, dtypes=DEFAULT_DTYPES,
+                   repeats=DEFAULT_REPEATS, max_loop_samples=DEFAULT_MAX_LOOP_SAMPLES, block_size=DEFAULT_BLOCK_SIZE,
+                   progress=None):
+    results = []
+    for case in cases:
+        for samples_cnt in sizes:
+            for channels_cnt in channels:
+                if case in LOOP_CASES and (channels_cnt != 1 or samples_cnt > max_loop_samples):
+                    continue
+                for dtype in dtypes:
+                    result = benchmark_case(case, samples_cnt, channels_cnt, dtype, repeats, block_size)
+                    results.append(result)
+                    if progress is not None:
+                        progress(result)
+
+    return {
+        'environment': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'repeats': repeats,
+        'block_size': block_size,
+        'results': results,
+    }
+
+
+def _result_key(result):
+    return result['case'], result['samples'], result['channels'], result['dtype']
+
+
+# This function compares results with baseline report. Results without counterpart in the baseline are ignored.
+# Throughput lower than (1 - tolerance) of the baseline and peak memory higher than (1 + tolerance)
+# of the baseline are regressions. Returns list of regressions, empty if there are none.
+def compare_results(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    baseline_results = {_result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        reference = baseline_results.get(_result_key(result))
+        if reference is None:
+            continue
+        if result['samples_per_s'] < (1 - tolerance) * reference['samples_per_s']:
+            regressions.append({'key': _result_key(result), 'metric': 'samples_per_s',
+                                'baseline': reference['samples_per_s'], 'current': result['samples_per_s']})
+        memory_limit = max((1 + tolerance) * reference['peak_memory_bytes'],
+                           reference['peak_memory_bytes'] + MEMORY_SLACK_BYTES)
+        if result['peak_memory_bytes'] > memory_limit:
+            regressions.append({'key': _result_key(result), 'metric': 'peak_memory_bytes',
+                                'baseline': reference['peak_memory_bytes'], 'current': result['peak_memory_bytes']})
+    return regressions
+
+
+def print_result(result):
+    stages = ', '.join(f'{name} {seconds * 1e3:.1f}' for name, seconds in result['stages'].items())
+    if result.get('stage_breakdown') is not None:
+        stages += ' (instrumented: ' + ', '.join(f'{name} {seconds * 1e3:.1f}'
+                                                 for name, seconds in result['stage_breakdown'].items()) + ')'
+    print(f'{result["case"]:>16} | {result["samples"]:>10} | {result["channels"]:>3} | {result["dtype"]:>7} | '
+          f'{result["samples_per_s"]:>12.4g} | {result["peak_memory_bytes"] / 2 ** 20:>9.2f} | {stages}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of NFM demodulation pipeline')
+    parser.add_argument('--cases', nargs='*', choices=CASES, default=list(CASES))
+    parser.add_argument('--sizes', type=float, nargs='*', default=DEFAULT_SIZES,
+                        help='Input lengths in samples, e.g. 1e3 1e6 1e8')
+    parser.add_argument('--channels', type=int, nargs='*', default=DEFAULT_CHANNELS)
+    parser.add_argument('--dtypes', nargs='*', choices=DEFAULT_DTYPES, default=DEFAULT_DTYPES)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--max-loop-samples', type=float, default=DEFAULT_MAX_LOOP_SAMPLES,
+                        help='Longest input for sample by sample code paths')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--output', default=None, help='Write report to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare with report stored in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative degradation against the baseline')
+    args = parser.parse_args()
+
+    print(f'{"case":>16} | {"samples":>10} | {"ch":>3} | {"dtype":>7} | {"samples/s":>12} | {"peak MiB":>9} | '
+          f'stages, ms')
+    report = run_benchmarks(args.cases, [int(size) for size in args.sizes], args.channels, args.dtypes, args.repeats,
+                            int(args.max_loop_samples), args.block_size, progress=print_result)
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+        regressions = compare_results(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression["key"]} {regression["metric"]}: '
+                  f'baseline {regression["baseline"]:.4g}, current {regression["current"]:.4g}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline')
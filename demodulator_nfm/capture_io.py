@@ -0,0 +1,214 @@
+import os
+import struct
+import warnings
+import numpy as np
+
+# Sample formats of raw captures: numpy type and factor to scale samples into [-1, 1) range
+SAMPLE_FORMATS = {
+    'int8': (np.int8, 1 / 128),
+    'int16': (np.int16, 1 / 32768),
+    'float32': (np.float32, 1.0),
+}
+
+# WAV format tags
+WAV_FORMAT_PCM = 1
+WAV_FORMAT_IEEE_FLOAT = 3
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+# This function reads RIFF chunks of WAV file header and returns
+# (format_tag, channels, sampling_freq, bits_per_sample, data_offset, data_size).
+# Only headers are read, sample data is not touched.
+def read_wav_header(file_name):
+    with open(file_name, 'rb') as wav_file:
+        riff, _, wave = struct.unpack('<4sI4s', wav_file.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{file_name} is not a WAV file')
+        wav_format = None
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f'{file_name} has no data chunk')
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt_chunk = wav_file.read(chunk_size)
+                format_tag, channels, sampling_freq, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt_chunk[:16])
+                if format_tag == WAV_FORMAT_EXTENSIBLE:
+                    # Actual format tag is the first two bytes of sub format GUID
+                    format_tag = struct.unpack('<H', fmt_chunk[24:26])[0]
+                wav_format = (format_tag, channels, sampling_freq, bits_per_sample)
+                wav_file.seek(chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                if wav_format is None:
+                    raise ValueError(f'{file_name}: data chunk goes before fmt chunk')
+                return wav_format + (wav_file.tell(), chunk_size)
+            else:
+                # Chunks are padded to even size
+                wav_file.seek(chunk_size + chunk_size % 2, 1)
+
+
+# Reader of ADC captures stored on disk.
+# The file is memory-mapped, so it is never loaded entirely: chunks are views into the mapping
+# and conversion to floating point is done for one chunk at a time.
+# Raw files are interleaved I/Q (iq=True) or real samples in one of SAMPLE_FORMATS.
+# WAV files with one channel are real samples, with two channels - I/Q.
+class CaptureReader():
+
+    def __init__(self, file_name, sample_format='int16', iq=False, sampling_freq=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        if file_name.lower().endswith('.wav'):
+            format_tag, channels, self.sampling_freq, bits_per_sample, data_offset, data_size = \
+                read_wav_header(file_name)
+            if channels not in (1, 2):
+                raise ValueError(f'{file_name}: only 1 (real) or 2 (I/Q) channels are supported, got {channels}')
+            self.iq = (channels == 2)
+            if format_tag == WAV_FORMAT_PCM and bits_per_sample == 16:
+                sample_type, self.scale, self.bias = np.int16, 1 / 32768, 0
+            elif format_tag == WAV_FORMAT_PCM and bits_per_sample == 8:
+                # 8-bit WAV samples are unsigned
+                sample_type, self.scale, self.bias = np.uint8, 1 / 128, -128
+            elif format_tag == WAV_FORMAT_IEEE_FLOAT and bits_per_sample == 32:
+                sample_type, self.scale, self.bias = np.float32, 1.0, 0
+            else:
+                raise ValueError(f'{file_name}: unsupported WAV format {format_tag}, {bits_per_sample} bits')
+            frame_size = channels * np.dtype(sample_type).itemsize
+            # Truncated file (e.g. interrupted recording) or streaming writer which left the size unknown:
+            # only samples present in the file are read
+            available_size = os.path.getsize(file_name) - data_offset
+            if data_size > available_size:
+                warnings.warn(f'{file_name}: data chunk of {data_size} bytes is truncated to {available_size} bytes')
+                data_size = available_size
+            self.samples_cnt = data_size // frame_size
+        else:
+            sample_type, self.scale = SAMPLE_FORMATS[sample_format]
+            self.bias = 0
+            self.iq = iq
+            self.sampling_freq = sampling_freq
+            data_offset = 0
+            channels = 2 if iq else 1
+            frame_size = channels * np.dtype(sample_type).itemsize
+            with open(file_name, 'rb') as raw_file:
+                raw_file.seek(0, 2)
+                self.samples_cnt = raw_file.tell() // frame_size
+
+        shape = (self.samples_cnt, 2) if self.iq else (self.samples_cnt,)
+        if self.samples_cnt == 0:
+            self.raw = np.empty(shape, dtype=sample_type)
+        else:
+            self.raw = np.memmap(file_name, dtype=sample_type, mode='r', offset=data_offset, shape=shape)
+
+    def __len__(self):
+        return self.samples_cnt
+
+    # Yields chunks of samples as they are stored in the file (zero-copy views into the mapping)
+    def raw_chunks(self, start=0, stop=None):
+        stop = self.samples_cnt if stop is None else min(stop, self.samples_cnt)
+        for chunk_start in range(start, stop, self.chunk_size):
+            yield self.raw[chunk_start:min(chunk_start + self.chunk_size, stop)]
+
+    # Converts one raw chunk to floating point samples in [-1, 1) range.
+    # I/Q chunks are converted to complex samples.
+    def convert(self, raw_chunk):
+        samples = raw_chunk.astype(self.dtype)
+        if self.bias:
+            samples += self.bias
+        if self.scale != 1.0:
+            samples *= self.scale
+        if self.iq:
+            samples = samples[:, 0] + 1j * samples[:, 1]
+        return samples
+
+    # Yields converted chunks. Only one chunk is converted at a time.
+    def chunks(self, start=0, stop=None):
+        for raw_chunk in self.raw_chunks(start, stop):
+            yield self.convert(raw_chunk)
+
+    def __iter__(self):
+        return self.chunks()
+
+
+# Writer of demodulated samples.
+# Output file is preallocated for samples_cnt samples and memory-mapped,
+# every written chunk goes directly to the mapping.
+# Samples are stored as float32 or as integers (int8/int16) scaled by 1/scale and saturated.
+class CaptureWriter():
+
+    def __init__(self, file_name, samples_cnt, sample_format='float32', sampling_freq=None, scale=None):
+        self.file_name = file_name
+        self.samples_cnt = samples_cnt
+        sample_type, default_scale = SAMPLE_FORMATS[sample_format]
+        self.scale = default_scale if scale is None else scale
+        self.sample_type = np.dtype(sample_type)
+        self.position = 0
+
+        data_offset = 0
+        if file_name.lower().endswith('.wav'):
+            if sample_format == 'int8':
+                raise ValueError('8-bit WAV samples are unsigned, use int16 or float32 format')
+            if sampling_freq is None:
+                raise ValueError('Sampling frequency is required to write WAV file')
+            data_offset = self.__write_wav_header(file_name, sample_format, int(sampling_freq))
+            mode = 'r+'
+        else:
+            mode = 'w+'
+
+        if samples_cnt == 0:
+            self.data = np.empty(0, dtype=self.sample_type)
+            open(file_name, 'ab').close()
+        else:
+            self.data = np.memmap(file_name, dtype=self.sample_type, mode=mode, offset=data_offset,
+                                  shape=(samples_cnt,))
+
+    def __write_wav_header(self, file_name, sample_format, sampling_freq):
+        format_tag = WAV_FORMAT_IEEE_FLOAT if sample_format == 'float32' else WAV_FORMAT_PCM
+        sample_size = self.sample_type.itemsize
+        data_size = self.samples_cnt * sample_size
+        header = struct.pack('<4sI4s4sIHHIIHH4sI',
+                             b'RIFF', 36 + data_size, b'WAVE',
+                             b'fmt ', 16, format_tag, 1, sampling_freq, sampling_freq * sample_size,
+                             sample_size, 8 * sample_size,
+                             b'data', data_size)
+        with open(file_name, 'wb') as wav_file:
+            wav_file.write(header)
+        return len(header)
+
+    def write(self, samples):
+        samples_cnt = len(samples)
+        if self.position + samples_cnt > self.samples_cnt:
+            raise ValueError(f'{self.file_name}: writing beyond {self.samples_cnt} samples')
+        destination = self.data[self.position:self.position + samples_cnt]
+        if np.issubdtype(self.sample_type, np.integer):
+            limits = np.iinfo(self.sample_type)
+            scaled = np.rint(np.asarray(samples) / self.scale)
+            np.clip(scaled, limits.min, limits.max, out=scaled)
+            destination[:] = scaled
+        else:
+            destination[:] = samples
+        self.position += samples_cnt
+
+    def close(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# This function demodulates the whole capture chunk by chunk and writes output to the writer.
+# Demodulator may be DemodulatorNFM or any object with demodulate_block method,
+# it must be initialized before the call. Returns number of written samples.
+def demodulate_capture(reader, writer, demodulator):
+    if reader.iq:
+        raise ValueError(f'{reader.file_name}: I/Q capture, demodulator expects real ADC samples')
+    for chunk in reader:
+        writer.write(demodulator.demodulate_block(chunk))
+    return writer.position
@@ -0,0 +1,137 @@
+import argparse
+import sys
+import numpy as np
+from demodulator_bank import DemodulatorBankNFM
+from nfm_reference import generate_modulation_signal, modulate_fm
+from quality_metrics import measure_quality
+
+# Candidate values of DISCRIMINATOR_DELAY_RATIO searched by default
+DEFAULT_DELAY_RATIOS = np.arange(0.5, 30.5, 0.5)
+# Longest delay tried, relative to the number of output samples used for the metrics
+MAX_DELAY_SHARE = 0.25
+# Extra lag (in output samples) allowed in addition to the discriminator delay when output is aligned
+# to the modulation signal, covers group delay of the filters
+LAG_SEARCH_MARGIN = 64
+# Criteria of the choice (keys of measure_quality result) with the score of the value, larger score is better.
+# Correlation is compared by absolute value: inverted output is as good as the direct one.
+CRITERIA = {
+    'sinad_db': lambda value: value,
+    'correlation': abs,
+    'rms_error': lambda value: -value,
+    'thd_db': lambda value: -value,
+}
+
+
+# This function searches DISCRIMINATOR_DELAY_RATIO giving the best demodulation quality for the given carrier.
+# Candidate ratios are converted to integer delays, every distinct delay becomes one channel of
+# DemodulatorBankNFM, so all candidates are demodulated in one pass over the input signal.
+# Output of every candidate is compared with the known modulation signal, the best one is chosen
+# by criterion (one of CRITERIA).
+# Returns dictionary with the best ratio and delay and the table of all candidates.
+def optimize_discriminator_delay(signal, modulation_signal, sampling_freq, oversampling_ratio, carrier_freq,
+                                 fm_modulation_amplitude, fm_frequency_sensitivity, tone_freqs,
+                                 delay_ratios=DEFAULT_DELAY_RATIOS, cut_samples_cnt=150, decimation_factor=1,
+                                 criterion='sinad_db'):
+    if criterion not in CRITERIA:
+        raise ValueError(f'Unknown criterion {criterion}, expected one of {tuple(CRITERIA)}')
+    bank = DemodulatorBankNFM(sampling_freq, oversampling_ratio, verbose=False)
+    output_sampling_freq = sampling_freq / decimation_factor
+    # Ratio of delay in samples to DISCRIMINATOR_DELAY_RATIO
+    samples_per_ratio = output_sampling_freq / (2 * abs(bank.localosc_sampling_freq - carrier_freq))
+    delay_ratios = np.asarray(delay_ratios, dtype=float)
+    candidate_delays = np.round(delay_ratios * samples_per_ratio).astype(int)
+    delays, first_ratio_idx = np.unique(candidate_delays, return_index=True)
+    # Delays which leave too few samples for comparison with the modulation signal are skipped
+    max_delay = MAX_DELAY_SHARE * (len(signal) - cut_samples_cnt) / decimation_factor
+    usable = (delays >= 1) & (delays <= max_delay)
+    if not np.any(usable):
+        raise ValueError(f'No candidate delay between 1 and {max_delay:.0f} samples, signal is too short')
+    first_ratio_idx = first_ratio_idx[usable]
+    delays = delays[usable]
+
+    bank.init(None, carrier_freq, fm_modulation_amplitude, fm_frequency_sensitivity,
+              discriminator_delay=delays, decimation_factor=decimation_factor)
+    output = bank.demodulate_block(signal)
+
+    reference = np.asarray(modulation_signal)[::decimation_factor][:output.shape[-1]]
+    metrics = measure_quality(output, reference, output_sampling_freq, tone_freqs,
+                              max_lag=delays + LAG_SEARCH_MARGIN,
+                              cut_samples_cnt=cut_samples_cnt // decimation_factor)
+
+    candidates = []
+    for channel_idx, delay in enumerate(delays):
+        row = {'delay_ratio': float(delay_ratios[first_ratio_idx[channel_idx]]),
+               'delay_ratio_precise': float(delay / samples_per_ratio),
+               'discriminator_delay': int(delay)}
+        row.update({name: float(values[channel_idx]) for name, values in metrics.items()})
+        candidates.append(row)
+    score = CRITERIA[criterion]
+    best = max(candidates, key=lambda row: score(row[criterion]))
+
+    return {'delay_ratio': best['delay_ratio'], 'discriminator_delay': best['discriminator_delay'],
+            'best': best, 'candidates': candidates}
+
+
+# Test signal of the configuration (see parameter_sweep.complete_config): FM signal and its modulation signal
+def _testbench_signal(config):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    time_vector = np.linspace(0, config['number_of_samples'] / sampling_freq, config['number_of_samples'] + 1)
+    modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'])
+    [signal, _] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                              config['freq_sensitivity'], modulation_signal)
+    return signal, modulation_signal
+
+
+def _optimize_config(config, signal, modulation_signal, criterion):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    return optimize_discriminator_delay(signal, modulation_signal, sampling_freq, config['oversampling_ratio'],
+                                        config['carrier_freq'], sum(config['mod_amp_list']),
+                                        config['freq_sensitivity'], config['mod_freq_list'],
+                                        cut_samples_cnt=config['cut_samples_cnt'],
+                                        decimation_factor=config['decimation_factor'], criterion=criterion)
+
+
+# This function checks that the choice of every criterion does not depend on the sign of the output:
+# the delay is chosen with the modulation signal as is and inverted (every channel is inverted against
+# the reference then). Returns dictionary criterion -> pair of the chosen delays, they must be equal.
+def check_criteria(config, criteria=tuple(CRITERIA)):
+    signal, modulation_signal = _testbench_signal(config)
+    return {criterion: tuple(_optimize_config(config, signal, reference, criterion)['discriminator_delay']
+                             for reference in (modulation_signal, -modulation_signal))
+            for criterion in criteria}
+
+
+if __name__ == '__main__':
+    from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+
+    parser = argparse.ArgumentParser(description='Find the best DISCRIMINATOR_DELAY_RATIO for testbench parameter sets')
+    parser.add_argument('--sets', type=int, nargs='*', help='Indexes (from 1) of parameter sets, all by default')
+    parser.add_argument('--samples', type=int, default=None, help='Number of samples for simulation')
+    parser.add_argument('--criterion', default='sinad_db', choices=tuple(CRITERIA))
+    parser.add_argument('--check', action='store_true',
+                        help='Check that every criterion chooses the same delay on inverted channels')
+    args = parser.parse_args()
+
+    set_indexes = args.sets or range(1, len(TESTBENCH_PARAMETER_SETS) + 1)
+    failed = False
+    if not args.check:
+        print(f'{"set":>4} | {"carrier":>9} | {"used ratio":>10} | {"best ratio":>10} | {"delay":>5} | '
+              f'{"SINAD dB":>8} | {"THD dB":>8} | {"corr":>6}')
+    for set_idx in set_indexes:
+        config = complete_config(TESTBENCH_PARAMETER_SETS[set_idx - 1])
+        if args.samples:
+            config['number_of_samples'] = args.samples
+        if args.check:
+            for criterion, (delay, inverted_delay) in check_criteria(config).items():
+                failed |= delay != inverted_delay
+                print(f'Set {set_idx}, {criterion}: delay {delay}, inverted {inverted_delay}'
+                      f'{"" if delay == inverted_delay else " - MISMATCH"}')
+            continue
+        signal, modulation_signal = _testbench_signal(config)
+        result = _optimize_config(config, signal, modulation_signal, args.criterion)
+        best = result['best']
+        print(f'{set_idx:>4} | {config["carrier_freq"]:>9.0f} | {config["discriminator_delay_ratio"]:>10} | '
+              f'{best["delay_ratio"]:>10} | {best["discriminator_delay"]:>5} | {best["sinad_db"]:>8.2f} | '
+              f'{best["thd_db"]:>8.2f} | {best["correlation"]:>6.3f}')
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,84 @@
+import numpy as np
+from demodulator_nfm import DemodulatorNFM
+
+# Bank of NFM demodulators which processes many channels in one vectorized pass.
+# All channels share the ADC sampling frequency, local oscillator and digital filters,
+# every channel has its own carrier frequency, discriminator delay and its own
+# filter, local oscillator and delay line state.
+# Input of demodulate_block is 2-D array (channels x samples). 1-D array is treated as
+# the same ADC stream fed to all channels.
+class DemodulatorBankNFM(DemodulatorNFM):
+
+    def init(self,
+             discriminator_delay_ratio,
+             fm_carrier_frequency,
+             fm_modulation_amplitude,
+             fm_frequency_sensitivity,
+             discriminator_delay=None,
+             decimation_factor=1):
+        # Every parameter may be scalar or list with one value per channel.
+        # Parameter discriminator_delay allows to set delays in samples explicitly,
+        # in this case discriminator_delay_ratio is not used.
+        self.output_sampling_freq = self.sampling_freq / decimation_factor
+        if discriminator_delay is None:
+            delay_ratio, carrier_freq = np.broadcast_arrays(
+                np.asarray(discriminator_delay_ratio, dtype=float), np.asarray(fm_carrier_frequency, dtype=float))
+            # Calculate delay in polar discriminator and round it to integer
+            discriminator_delay_precise = \
+                delay_ratio * self.output_sampling_freq / (2 * np.abs(self.localosc_sampling_freq - carrier_freq))
+            self.discriminator_delay = np.atleast_1d(np.round(discriminator_delay_precise).astype(int))
+        else:
+            self.discriminator_delay = np.atleast_1d(np.asarray(discriminator_delay, dtype=int))
+        if np.any(self.discriminator_delay < 1):
+            raise ValueError(f'Discriminator delay must be at least one sample: {self.discriminator_delay}')
+        self.channels_cnt = len(self.discriminator_delay)
+
+        # Clear digital filters internal data, filters keep separate state for every channel
+        self._init_stages(decimation_factor, self.channels_cnt)
+
+        # Delay lines of all channels have length of the longest delay and store the oldest sample first.
+        # Channel with delay D reads its delayed samples starting at column (max_delay - D).
+        self.max_discriminator_delay = int(self.discriminator_delay.max())
+        self.i_delay_buffer = np.zeros((self.channels_cnt, self.max_discriminator_delay), dtype=self.dtype)
+        self.q_delay_buffer = np.zeros((self.channels_cnt, self.max_discriminator_delay), dtype=self.dtype)
+        self.delay_buffer_idx = 0
+        self.__delay_line_start = self.max_discriminator_delay - self.discriminator_delay
+
+        max_phase_deviation = \
+            fm_frequency_sensitivity * (self.discriminator_delay / self.output_sampling_freq) * (fm_modulation_amplitude)
+
+        if self.verbose:
+            print(f'Channels: {self.channels_cnt}')
+            print(f'Discriminator delay in samples: min {self.discriminator_delay.min()}, '
+                  f'max {self.max_discriminator_delay}')
+            print(f'Max phase deviation: up to {max_phase_deviation.max() * 360} deg')
+
+        return self.discriminator_delay
+
+    # Per-sample call is kept for compatibility with DemodulatorNFM:
+    # newsample is one sample per channel (or one sample for all channels).
+    def demodulate_nfm(self, newsample):
+        if self.decimation_factor != 1:
+            raise ValueError('Sample by sample demodulation does not support decimation, use demodulate_block')
+        return self.demodulate_block(np.asarray(newsample, dtype=self.dtype)[..., None])[:, 0]
+
+    # Polar discriminator for all channels. Ragged delays are handled by reading every channel
+    # from its own offset in the common delay line with one gather operation.
+    def _discriminate_block(self, i_samples, q_samples):
+        samples_cnt = i_samples.shape[-1]
+        i_line = np.concatenate((self.i_delay_buffer, i_samples), axis=1)
+        q_line = np.concatenate((self.q_delay_buffer, q_samples), axis=1)
+        delayed_idx = self.__delay_line_start[:, None] + np.arange(samples_cnt)[None, :]
+        i_delayed = np.take_along_axis(i_line, delayed_idx, axis=1)
+        q_delayed = np.take_along_axis(q_line, delayed_idx, axis=1)
+        polar_det_out = (i_samples * q_delayed) - (q_samples * i_delayed)
+        self.i_delay_buffer = i_line[:, samples_cnt:].copy()
+        self.q_delay_buffer = q_line[:, samples_cnt:].copy()
+        return polar_det_out
+
+    def demodulate_block(self, samples):
+        samples = np.asarray(samples, dtype=self.dtype)
+        if samples.ndim > 2 or (samples.ndim == 2 and samples.shape[0] != self.channels_cnt):
+            raise ValueError(f'Expected array of shape ({self.channels_cnt}, samples), got {samples.shape}')
+        samples = np.broadcast_to(samples, (self.channels_cnt, samples.shape[-1]))
+        return super().demodulate_block(samples)
@@ -0,0 +1,320 @@
+import numpy as np
+from demodulator_nfm import DemodulatorNFM
+
+# Rounding modes used when fixed-point value is shifted right (precision is dropped):
+# 'floor'      - arithmetic shift, rounds toward minus infinity (cheapest in hardware)
+# 'round'      - rounds half up: add half of LSB, then shift
+# 'convergent' - rounds half to even, no bias on ties
+ROUNDING_MODES = ('floor', 'round', 'convergent')
+
+# Stages of the demodulator which count overflows (saturations)
+STAGES = ('input', 'mixer', 'i_lpf', 'q_lpf', 'discriminator', 'output_lpf')
+
+
+# Fixed-point number format Qm.n: int_bits (including sign) and frac_bits, word length is their sum.
+# Values are stored in the smallest integer type holding the word.
+class QFormat():
+
+    def __init__(self, int_bits, frac_bits):
+        self.int_bits = int_bits
+        self.frac_bits = frac_bits
+        self.word_bits = int_bits + frac_bits
+        if not 2 <= self.word_bits <= 32:
+            raise ValueError(f'Word length of Q{int_bits}.{frac_bits} must be from 2 to 32 bits')
+        self.min_int = -(1 << (self.word_bits - 1))
+        self.max_int = (1 << (self.word_bits - 1)) - 1
+        self.dtype = next(np.dtype(t) for t in (np.int8, np.int16, np.int32) if np.iinfo(t).bits >= self.word_bits)
+
+    def __repr__(self):
+        return f'Q{self.int_bits}.{self.frac_bits}'
+
+    # Convert floating point values to integers of this format, returns values (of dtype) and number of overflows
+    def quantize(self, values, rounding='round'):
+        scaled = np.asarray(values, dtype=float) * (1 << self.frac_bits)
+        if rounding == 'floor':
+            scaled = np.floor(scaled)
+        elif rounding == 'round':
+            scaled = np.floor(scaled + 0.5)
+        else:
+            scaled = np.rint(scaled)
+        overflows = int(np.count_nonzero((scaled < self.min_int) | (scaled > self.max_int)))
+        return np.clip(scaled, self.min_int, self.max_int).astype(self.dtype), overflows
+
+    # Integer values converted to dtype of this format with saturation, returns values and number of overflows
+    def saturate(self, values):
+        values = np.asarray(values)
+        info = np.iinfo(values.dtype)
+        if self.min_int <= info.min and info.max <= self.max_int:
+            return values.astype(self.dtype, copy=False), 0
+        values, overflows = saturate(values.astype(np.int64), self.word_bits)
+        return values.astype(self.dtype), overflows
+
+    def to_float(self, values):
+        return np.asarray(values, dtype=float) / (1 << self.frac_bits)
+
+
+# Saturate integer values to the given word length. Returns saturated values and number of overflows.
+def saturate(values, word_bits):
+    min_int = -(1 << (word_bits - 1))
+    max_int = (1 << (word_bits - 1)) - 1
+    overflow = (values < min_int) | (values > max_int)
+    if np.any(overflow):
+        return np.clip(values, min_int, max_int), int(np.count_nonzero(overflow))
+    return values, 0
+
+
+# Arithmetic shift right by shift bits with rounding (shift left if shift is negative)
+def shift_right(values, shift, rounding):
+    if shift <= 0:
+        return values << -shift
+    if rounding == 'floor':
+        return values >> shift
+    half = 1 << (shift - 1)
+    result = (values + half) >> shift
+    if rounding == 'convergent':
+        # On exact ties rounding half up gives odd result sometimes, move it to the even neighbour
+        tie = (values & ((1 << shift) - 1)) == half
+        result = result - (tie & ((result & 1) == 1))
+    return result
+
+
+# Parameters of fixed-point implementation:
+# data_format          - format of samples between stages (ADC input, I/Q, discriminator input)
+# coef_format          - format of filter coefficients
+# discriminator_format - format of the polar discriminator output and of the output LPF
+# accumulator_bits     - width of filter accumulator, accumulator is saturated to it
+# rounding             - rounding mode, one of ROUNDING_MODES
+class FixedPointConfig():
+
+    def __init__(self, data_format, coef_format, discriminator_format, accumulator_bits, rounding='round'):
+        if rounding not in ROUNDING_MODES:
+            raise ValueError(f'Unknown rounding mode {rounding}, expected one of {ROUNDING_MODES}')
+        # Products of samples and coefficients with guard bits must fit 64-bit integers
+        widest = max(data_format.word_bits, discriminator_format.word_bits)
+        if widest + coef_format.word_bits + 3 > 63 or accumulator_bits > 63:
+            raise ValueError('Filter accumulator does not fit 64-bit integers, reduce word lengths')
+        self.data_format = data_format
+        self.coef_format = coef_format
+        self.discriminator_format = discriminator_format
+        self.accumulator_bits = accumulator_bits
+        self.rounding = rounding
+
+
+# Typical configurations: 16-bit MCU/DSP with 32-bit accumulator and 32-bit target with 24-bit coefficients
+FIXED_POINT_PRESETS = {
+    'int16': FixedPointConfig(QFormat(1, 15), QFormat(2, 14), QFormat(1, 15), accumulator_bits=32),
+    'int32': FixedPointConfig(QFormat(2, 30), QFormat(2, 22), QFormat(2, 30), accumulator_bits=58),
+}
+
+
+# Recursive part of fixed-point second order section for one channel, Python integers are used as the
+# accumulator. Parameter fir_out is list of FIR part outputs (b0 * x[n] + b1 * x[n-1] + b2 * x[n-2]),
+# y1 and y2 are the previous outputs. Returns list of outputs, last two outputs and number of overflows.
+def _fixed_recursion(fir_out, a1, a2, y1, y2, shift, rounding, accumulator_bits, word_bits):
+    accumulator_min, accumulator_max = -(1 << (accumulator_bits - 1)), (1 << (accumulator_bits - 1)) - 1
+    output_min, output_max = -(1 << (word_bits - 1)), (1 << (word_bits - 1)) - 1
+    half = 1 << (shift - 1)
+    mask = (1 << shift) - 1
+    outputs = [0] * len(fir_out)
+    overflows = 0
+    for idx, fir_value in enumerate(fir_out):
+        accumulator = fir_value - a1 * y1 - a2 * y2
+        if accumulator > accumulator_max:
+            accumulator = accumulator_max
+            overflows += 1
+        elif accumulator < accumulator_min:
+            accumulator = accumulator_min
+            overflows += 1
+        if rounding == 'floor':
+            y0 = accumulator >> shift
+        else:
+            y0 = (accumulator + half) >> shift
+            if rounding == 'convergent' and (accumulator & mask) == half and y0 & 1:
+                y0 -= 1
+        if y0 > output_max:
+            y0 = output_max
+            overflows += 1
+        elif y0 < output_min:
+            y0 = output_min
+            overflows += 1
+        outputs[idx] = y0
+        y1, y2 = y0, y1
+    return outputs, y1, y2, overflows
+
+
+# Cascade of second order sections in fixed point, direct form I.
+# Products of samples and coefficients are summed in the accumulator of accumulator_bits,
+# the sum is shifted by coefficient fractional bits with rounding and saturated to the data format.
+# Samples and state are kept in dtype of the data format, only the accumulator is wider.
+# FIR part of every section is calculated for the whole block at once (int64 accumulator).
+# Rounding and saturation of every output feed the recursion, so it can not be split into blocks like
+# in SosFilter: the recursive part runs sample by sample on Python integers, one channel at a time.
+# This is bit-exact reference model of the firmware, not a fast implementation.
+class FixedSosFilter():
+
+    def __init__(self, sos, data_format, coef_format, accumulator_bits, rounding):
+        sos = np.atleast_2d(np.asarray(sos, dtype=float))
+        sos = sos / sos[:, 3:4]
+        self.coefs, self.coef_overflows = coef_format.quantize(sos, 'round')
+        if self.coef_overflows:
+            raise ValueError(f'Filter coefficients do not fit {coef_format}: {sos}')
+        self.sections_cnt = len(self.coefs)
+        self.data_format = data_format
+        self.coef_frac_bits = coef_format.frac_bits
+        self.accumulator_bits = accumulator_bits
+        self.rounding = rounding
+        self.overflows = 0
+        self.reset()
+
+    def reset(self, channels_shape=()):
+        channels_shape = (channels_shape,) if np.isscalar(channels_shape) else tuple(channels_shape)
+        # x_state[section, ..., 0] is x[n-1], x_state[section, ..., 1] is x[n-2]. Same for y_state.
+        self.x_state = np.zeros((self.sections_cnt,) + channels_shape + (2,), dtype=self.data_format.dtype)
+        self.y_state = np.zeros((self.sections_cnt,) + channels_shape + (2,), dtype=self.data_format.dtype)
+        self.overflows = 0
+
+    def process_block(self, samples):
+        samples = np.asarray(samples, dtype=self.data_format.dtype)
+        samples_cnt = samples.shape[-1]
+        if samples_cnt == 0:
+            return samples.copy()
+
+        for section_idx in range(self.sections_cnt):
+            b0, b1, b2, _, a1, a2 = (int(c) for c in self.coefs[section_idx])
+            x_state = self.x_state[section_idx]
+            y_state = self.y_state[section_idx]
+            line = np.concatenate((x_state[..., ::-1], samples), axis=-1).astype(np.int64)
+            fir_out = b0 * line[..., 2:] + b1 * line[..., 1:-1] + b2 * line[..., :-2]
+
+            output = np.empty(samples.shape, dtype=self.data_format.dtype)
+            flat_fir_out = fir_out.reshape(-1, samples_cnt)
+            flat_output = output.reshape(-1, samples_cnt)
+            flat_y_state = y_state.reshape(-1, 2)
+            for channel_idx in range(len(flat_fir_out)):
+                y1, y2 = (int(value) for value in flat_y_state[channel_idx])
+                outputs, y1, y2, overflows = _fixed_recursion(
+                    flat_fir_out[channel_idx].tolist(), a1, a2, y1, y2, self.coef_frac_bits, self.rounding,
+                    self.accumulator_bits, self.data_format.word_bits)
+                flat_output[channel_idx] = outputs
+                flat_y_state[channel_idx] = (y1, y2)
+                self.overflows += overflows
+
+            x_state[...] = line[..., -1:-3:-1]
+            samples = output
+
+        return samples
+
+
+# Fixed-point version of DemodulatorNFM for validation of MCU/FPGA firmware.
+# All stages work with integer arrays: input is quantized to data format (or given as integers of it),
+# square wave local oscillator is applied as sign change, filters are FixedSosFilter,
+# discriminator products are shifted to discriminator format. Samples between stages, filter state and
+# delay lines are kept in dtype of their format (int16 or int32), only products and accumulators are 64-bit.
+# Every stage saturates its results and counts overflows (see overflow_counts). Decimation is not supported.
+class DemodulatorNFMFixed(DemodulatorNFM):
+
+    # Parameter fixed_point is FixedPointConfig or name of one of FIXED_POINT_PRESETS
+    def __init__(self, sampling_freq, oversampling_ratio, fixed_point='int16', iq_filter_sos=None,
+                 output_filter_sos=None, verbose=True):
+        self.fixed_point = FIXED_POINT_PRESETS[fixed_point] if isinstance(fixed_point, str) else fixed_point
+        super().__init__(sampling_freq, oversampling_ratio, iq_filter_sos, output_filter_sos, verbose)
+        self.sin_base = self.sin_base.astype(np.int8)
+        self.cos_base = self.cos_base.astype(np.int8)
+
+    def _init_stages(self, decimation_factor, channels_shape=()):
+        if decimation_factor != 1:
+            raise ValueError('Fixed-point demodulator does not support decimation')
+        config = self.fixed_point
+        self.decimation_factor = 1
+        self.output_sampling_freq = self.sampling_freq
+        self.i_filter = FixedSosFilter(self.iq_filter_sos, config.data_format, config.coef_format,
+                                       config.accumulator_bits, config.rounding)
+        self.q_filter = FixedSosFilter(self.iq_filter_sos, config.data_format, config.coef_format,
+                                       config.accumulator_bits, config.rounding)
+        self.output_filter = FixedSosFilter(self.output_filter_sos, config.discriminator_format, config.coef_format,
+                                            config.accumulator_bits, config.rounding)
+        for sos_filter in (self.i_filter, self.q_filter, self.output_filter):
+            sos_filter.reset(channels_shape)
+        self.i_decimator = None
+        self.q_decimator = None
+        self.locosc_idx = 0
+        self.__overflows = dict.fromkeys(('input', 'mixer', 'discriminator'), 0)
+
+    def init(self, discriminator_delay_ratio, fm_carrier_frequency, fm_modulation_amplitude,
+             fm_frequency_sensitivity, decimation_factor=1):
+        discriminator_delay = super().init(discriminator_delay_ratio, fm_carrier_frequency, fm_modulation_amplitude,
+                                           fm_frequency_sensitivity, decimation_factor)
+        self.i_delay_buffer = np.zeros(discriminator_delay, dtype=self.fixed_point.data_format.dtype)
+        self.q_delay_buffer = np.zeros(discriminator_delay, dtype=self.fixed_point.data_format.dtype)
+        return discriminator_delay
+
+    # Number of saturations per stage since init
+    def overflow_counts(self):
+        counts = dict(self.__overflows)
+        counts['i_lpf'] = self.i_filter.overflows
+        counts['q_lpf'] = self.q_filter.overflows
+        counts['output_lpf'] = self.output_filter.overflows
+        return {stage: counts[stage] for stage in STAGES}
+
+    # Sign of samples is changed by the square wave in dtype of the data format.
+    # Only the most negative value overflows then (it stays negative), it is saturated to the largest one.
+    # Parameter out is optional pair of arrays of the data format dtype to store I and Q samples to.
+    def _mix_block(self, samples, out=None):
+        data_format = self.fixed_point.data_format
+        samples_cnt = samples.shape[-1]
+        locosc_idx = (self.locosc_idx + np.arange(samples_cnt)) % self.local_osc_period
+        self.locosc_idx = (self.locosc_idx + samples_cnt) % self.local_osc_period
+        mixed = []
+        for base, component_out in zip((self.sin_base, self.cos_base), (None, None) if out is None else out):
+            base_values = base[locosc_idx]
+            component = np.multiply(samples, base_values, out=component_out)
+            overflow = (samples == data_format.min_int) & (base_values < 0)
+            if np.any(overflow):
+                component[overflow] = data_format.max_int
+                self.__overflows['mixer'] += int(np.count_nonzero(overflow))
+            mixed.append(component)
+        return mixed[0], mixed[1]
+
+    def _discriminate_block(self, i_samples, q_samples):
+        config = self.fixed_point
+        samples_cnt = i_samples.shape[-1]
+        i_line = np.concatenate((np.roll(self.i_delay_buffer, -self.delay_buffer_idx), i_samples))
+        q_line = np.concatenate((np.roll(self.q_delay_buffer, -self.delay_buffer_idx), q_samples))
+        # Products are calculated in 64 bits and have 2 * frac_bits fractional bits. For wide words they are
+        # shifted before subtraction to keep the difference within 64 bits.
+        guard_shift = max(0, 2 * config.data_format.word_bits - 62)
+        polar_det_out = shift_right(i_samples.astype(np.int64) * q_line[:samples_cnt], guard_shift, 'floor') - \
+            shift_right(q_samples.astype(np.int64) * i_line[:samples_cnt], guard_shift, 'floor')
+        shift = 2 * config.data_format.frac_bits - guard_shift - config.discriminator_format.frac_bits
+        polar_det_out, overflows = saturate(shift_right(polar_det_out, shift, config.rounding),
+                                            config.discriminator_format.word_bits)
+        self.__overflows['discriminator'] += overflows
+        polar_det_out = polar_det_out.astype(config.discriminator_format.dtype)
+        self.i_delay_buffer = i_line[samples_cnt:].copy()
+        self.q_delay_buffer = q_line[samples_cnt:].copy()
+        self.delay_buffer_idx = 0
+        return polar_det_out
+
+    # Demodulate block of samples. Floating point samples are quantized to data format,
+    # integer samples are taken as values of data format. Output is integer array of discriminator
+    # format (use discriminator_format.to_float to convert it).
+    def demodulate_block(self, samples):
+        samples = self._convert_input(samples)
+        if samples.shape[-1] == 0:
+            return np.empty(samples.shape, dtype=self.fixed_point.discriminator_format.dtype)
+
+        output = self._process_block(samples)
+        return output.astype(self.fixed_point.discriminator_format.dtype)
+
+    # Floating point samples are quantized to data format, integer samples are saturated to it
+    def _convert_input(self, samples):
+        samples = np.asarray(samples)
+        if np.issubdtype(samples.dtype, np.integer):
+            samples, overflows = self.fixed_point.data_format.saturate(samples)
+        else:
+            samples, overflows = self.fixed_point.data_format.quantize(samples, self.fixed_point.rounding)
+        self.__overflows['input'] += overflows
+        return samples
+
+    def demodulate_nfm(self, newsample):
+        return self.demodulate_block(np.asarray(newsample)[..., None])[..., 0]
@@ -0,0 +1,210 @@
+import argparse
+import time
+import numpy as np
+from demodulator_nfm import DemodulatorNFM
+from nco import DEFAULT_TABLE_BITS
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Backends of DemodulatorNFMJit:
+# 'numba'  - the whole chain mixer -> LPF -> discriminator -> LPF compiled by Numba, one loop over samples
+# 'numpy'  - vectorized block processing of DemodulatorNFM
+# 'python' - the same kernel as 'numba' interpreted by Python, slow, used to check the kernel without Numba
+BACKENDS = ('numba', 'numpy', 'python')
+# Largest difference from the sample by sample reference accepted by check_equivalence
+EQUIVALENCE_TOLERANCE = 1e-12
+
+
+# One sample through cascade of second order sections, direct form I.
+# State layout is the same as of SosFilter: x_state[section, 0] is x[n-1], x_state[section, 1] is x[n-2].
+def _sos_sample(sos, x_state, y_state, sample):
+    for section_idx in range(sos.shape[0]):
+        output = sos[section_idx, 0] * sample + sos[section_idx, 1] * x_state[section_idx, 0] + \
+            sos[section_idx, 2] * x_state[section_idx, 1] - sos[section_idx, 4] * y_state[section_idx, 0] - \
+            sos[section_idx, 5] * y_state[section_idx, 1]
+        x_state[section_idx, 1] = x_state[section_idx, 0]
+        x_state[section_idx, 0] = sample
+        y_state[section_idx, 1] = y_state[section_idx, 0]
+        y_state[section_idx, 0] = output
+        sample = output
+    return sample
+
+
+# This function builds the whole demodulation chain for one channel, the same operations in the same order as
+# DemodulatorNFM.demodulate_nfm, on top of the given sos_sample (_sos_sample or its compiled version).
+# Filter states and delay lines are updated in place by the kernel, new local oscillator and delay line
+# indexes are returned.
+def _make_demodulate_kernel(sos_sample):
+
+    def _demodulate_kernel(samples, sin_base, cos_base, locosc_idx, iq_sos, i_x_state, i_y_state, q_x_state, q_y_state,
+                           output_sos, output_x_state, output_y_state, i_delay_buffer, q_delay_buffer, delay_buffer_idx,
+                           output):
+        local_osc_period = sin_base.shape[0]
+        discriminator_delay = i_delay_buffer.shape[0]
+        for idx in range(samples.shape[0]):
+            # multiply with local oscillator
+            i_sample = samples[idx] * sin_base[locosc_idx]
+            q_sample = samples[idx] * cos_base[locosc_idx]
+            locosc_idx += 1
+            if locosc_idx == local_osc_period:
+                locosc_idx = 0
+
+            # LPF I and Q channels
+            i_sample = sos_sample(iq_sos, i_x_state, i_y_state, i_sample)
+            q_sample = sos_sample(iq_sos, q_x_state, q_y_state, q_sample)
+
+            polar_det_out = (i_sample * q_delay_buffer[delay_buffer_idx]) - \
+                (q_sample * i_delay_buffer[delay_buffer_idx])
+            i_delay_buffer[delay_buffer_idx] = i_sample
+            q_delay_buffer[delay_buffer_idx] = q_sample
+            delay_buffer_idx += 1
+            if delay_buffer_idx == discriminator_delay:
+                delay_buffer_idx = 0
+
+            # Apply LPF to polar discriminator output
+            output[idx] = sos_sample(output_sos, output_x_state, output_y_state, polar_det_out)
+
+        return locosc_idx, delay_buffer_idx
+
+    return _demodulate_kernel
+
+
+# Pure Python kernel of the 'python' backend
+_python_kernel = _make_demodulate_kernel(_sos_sample)
+
+# Numba compiles the kernel on the first call, compiled code is cached on disk (__pycache__ next to this file),
+# so the next processes load it without compilation. nogil lets the kernel run in parallel threads.
+# Compiled functions get their own names, the Python ones stay interpreted for the 'python' backend.
+if numba is not None:
+    _jit_sos_sample = numba.njit(cache=True, nogil=True)(_sos_sample)
+    _jit_kernel = numba.njit(cache=True, nogil=True)(_make_demodulate_kernel(_jit_sos_sample))
+else:
+    _jit_kernel = None
+
+
+def available_backends():
+    return [backend for backend in BACKENDS if backend != 'numba' or numba is not None]
+
+
+# Backend name for the requested one: 'auto' gives 'numba' when Numba is installed, otherwise 'numpy'
+def select_backend(backend='auto'):
+    if backend == 'auto':
+        return 'numba' if numba is not None else 'numpy'
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS} or auto')
+    if backend == 'numba' and numba is None:
+        raise ValueError('Backend numba requires Numba to be installed')
+    return backend
+
+
+# DemodulatorNFM with optional compiled kernel. Kernel runs the whole chain sample by sample,
+# so the recursion of the filters is not split into blocks and the output is the same as of demodulate_nfm.
+# The kernel handles one channel with square wave local oscillator, without decimation and without
+# instrumentation (stages are fused in it), other cases go the numpy path of DemodulatorNFM.
+class DemodulatorNFMJit(DemodulatorNFM):
+
+    def __init__(self, sampling_freq, oversampling_ratio, iq_filter_sos=None, output_filter_sos=None, verbose=True,
+                 backend='auto', local_osc_freq=None, nco_table_bits=DEFAULT_TABLE_BITS, nco_amplitude_bits=None,
+                 dtype=np.float64):
+        self.backend = select_backend(backend)
+        super().__init__(sampling_freq, oversampling_ratio, iq_filter_sos, output_filter_sos, verbose,
+                         local_osc_freq, nco_table_bits, nco_amplitude_bits, dtype)
+        if self.verbose:
+            print(f'backend: {self.backend}')
+
+    def _process_block(self, samples):
+        if self.backend == 'numpy' or self.instrumentation is not None or self.nco is not None or \
+                self.decimation_factor != 1 or samples.ndim != 1:
+            return super()._process_block(samples)
+
+        kernel = _jit_kernel if self.backend == 'numba' else _python_kernel
+        output = np.empty(samples.shape[-1], dtype=self.dtype)
+        self.locosc_idx, self.delay_buffer_idx = kernel(
+            np.ascontiguousarray(samples), self.sin_base, self.cos_base, self.locosc_idx,
+            self.i_filter.sos, self.i_filter.x_state, self.i_filter.y_state,
+            self.q_filter.x_state, self.q_filter.y_state,
+            self.output_filter.sos, self.output_filter.x_state, self.output_filter.y_state,
+            self.i_delay_buffer, self.q_delay_buffer, self.delay_buffer_idx, output)
+        return output
+
+    def demodulate_nfm(self, newsample):
+        if self.backend == 'numpy' or self.instrumentation is not None or self.nco is not None:
+            return super().demodulate_nfm(newsample)
+        return self.demodulate_block(np.array([newsample], dtype=self.dtype))[0]
+
+
+# This function checks the backend against the reference: DemodulatorNFM.demodulate_nfm sample by sample.
+# Every testbench parameter set is demodulated by blocks of every size of block_sizes (the state must be kept
+# correctly between blocks). Returns list of dictionaries with set index, block size and the largest difference,
+# 'passed' is True when the difference is within tolerance.
+def check_equivalence(backend='auto', samples_cnt=4000, block_sizes=(1, 7, 256, 4000), tolerance=EQUIVALENCE_TOLERANCE,
+                      iq_filter_sos=None, output_filter_sos=None):
+    from nfm_reference import generate_modulation_signal, modulate_fm
+    from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+
+    backend = select_backend(backend)
+    results = []
+    for set_idx, parameter_set in enumerate(TESTBENCH_PARAMETER_SETS, start=1):
+        config = complete_config(parameter_set)
+        sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+        time_vector = np.linspace(0, samples_cnt / sampling_freq, samples_cnt + 1)
+        modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'])
+        [signal, _] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                                  config['freq_sensitivity'], modulation_signal)
+        init_args = (config['discriminator_delay_ratio'], config['carrier_freq'], sum(config['mod_amp_list']),
+                     config['freq_sensitivity'])
+
+        reference = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], iq_filter_sos, output_filter_sos,
+                                   verbose=False)
+        reference.init(*init_args)
+        reference_output = np.array([reference.demodulate_nfm(sample) for sample in signal])
+
+        for block_size in block_sizes:
+            demodulator = DemodulatorNFMJit(sampling_freq, config['oversampling_ratio'], iq_filter_sos,
+                                            output_filter_sos, verbose=False, backend=backend)
+            demodulator.init(*init_args)
+            output = np.concatenate([demodulator.demodulate_block(signal[start:start + block_size])
+                                     for start in range(0, len(signal), block_size)])
+            difference = float(np.max(np.abs(output - reference_output)))
+            results.append({'set': set_idx, 'backend': backend, 'block_size': block_size,
+                            'max_difference': difference, 'passed': difference <= tolerance})
+
+    return results
+
+
+if __name__ == '__main__':
+    from sos_filter import butterworth_lowpass_sos
+
+    parser = argparse.ArgumentParser(description='Check backends of DemodulatorNFMJit against the reference '
+                                                 'and compare their speed')
+    parser.add_argument('--backends', nargs='*', default=available_backends(), choices=BACKENDS)
+    parser.add_argument('--samples', type=int, default=4000, help='Number of samples of every equivalence check')
+    parser.add_argument('--speed-samples', type=int, default=1000000, help='Number of samples for speed comparison')
+    args = parser.parse_args()
+
+    all_passed = True
+    filters = {'default LPF': None, 'Butterworth order 4': butterworth_lowpass_sos(4, 20e3, 400e3)}
+    for backend in args.backends:
+        for filter_name, sos in filters.items():
+            results = check_equivalence(backend, args.samples, iq_filter_sos=sos, output_filter_sos=sos)
+            passed = all(result['passed'] for result in results)
+            all_passed &= passed
+            worst = max(result['max_difference'] for result in results)
+            print(f'{backend:>7} | {filter_name:>20} | max difference {worst:.3g} | {"PASSED" if passed else "FAILED"}')
+
+    signal = np.cos(np.arange(args.speed_samples) * 1.2)
+    for backend in args.backends:
+        if backend == 'python' and args.speed_samples > 100000:
+            continue
+        demodulator = DemodulatorNFMJit(400e3, 4, verbose=False, backend=backend)
+        demodulator.init(14, 154.3e3, 1, 1000)
+        demodulator.demodulate_block(signal[:1000])
+        start_time = time.perf_counter()
+        demodulator.demodulate_block(signal)
+        seconds = time.perf_counter() - start_time
+        print(f'{backend:>7} | {args.speed_samples / seconds:.4g} samples/s')
+
+    raise SystemExit(0 if all_passed else 1)
@@ -1,87 +1,152 @@
 
 import numpy as np
+from sos_filter import SosFilter, rescale_sos
+from polyphase_decimator import PolyphaseDecimator
+from instrumentation import Instrumentation, StageTimer, DEFAULT_TAP_SIZE
+from nco import NCO, DEFAULT_TABLE_BITS
 
-class DemodulatorNFM():
+# Default digital filter used for I, Q and polar discriminator output, one second order section
+# [b0, b1, b2, a0, a1, a2].
+# LPF, IIR, Order 1. Pass band 0.01*fs, Stop band 0.1*fs, attenuation in stop band -20dB.
+# DEFAULT_LPF_SOS = [[0.03054, 0.03054, 0.0, 1.0, -0.9389, 0.0]]
+# LPF, IIR, Order 1. Pass band 0.1*fs, Stop band 0.35*fs, attenuation in stop band -20dB.
+DEFAULT_LPF_SOS = [[0.1584, 0.1584, 0.0, 1.0, -0.6832, 0.0]]
 
-    def __init__(self, sampling_freq, oversampling_ratio):
+class DemodulatorNFM():
 
-        # Digital Filter coefficients
-        # LPF, IIR, Order 1. Pass band 0.01*fs, Stop band 0.1*fs, attenuation in stop band -20dB.
-        # Numerator coefficients
-        # self.DF_BCOEF = [0.03054, 0.03054]
-        # # Denumerator coefficients
-        # self.DF_ACOEF = [1.0, -0.9389]
+    # Parameters iq_filter_sos and output_filter_sos are second order sections of the filters
+    # applied to I/Q components and to the polar discriminator output (see sos_filter.py).
+    # Parameter verbose enables printing of the demodulator parameters.
+    # By default local oscillator is square wave of frequency sampling_freq / oversampling_ratio,
+    # oversampling_ratio must be multiple of 4. Parameter local_osc_freq selects numerically controlled
+    # oscillator of this frequency instead (see nco.py), oversampling_ratio is not used then and may be None.
+    # Parameters nco_table_bits and nco_amplitude_bits set size and precision of its sin/cos tables.
+    # Parameter dtype selects precision of the whole pipeline: np.float64 (default) or np.float32.
+    # Input is converted to dtype, all stages (oscillator, filters, discriminator) keep it up to the output.
+    def __init__(self, sampling_freq, oversampling_ratio, iq_filter_sos=None, output_filter_sos=None, verbose=True,
+                 local_osc_freq=None, nco_table_bits=DEFAULT_TABLE_BITS, nco_amplitude_bits=None, dtype=np.float64):
+        self.verbose = verbose
+        self.dtype = np.dtype(dtype)
+        # Statistics of the stages, see enable_instrumentation
+        self.instrumentation = None
 
-        # LPF, IIR, Order 1. Pass band 0.1*fs, Stop band 0.35*fs, attenuation in stop band -20dB.
-        # Numerator coefficients
-        self.DF_BCOEF = [0.1584, 0.1584]
-        # Denumerator coefficients
-        self.DF_ACOEF = [1.0, -0.6832]
+        # Digital Filters
+        self.iq_filter_sos = DEFAULT_LPF_SOS if iq_filter_sos is None else iq_filter_sos
+        self.output_filter_sos = DEFAULT_LPF_SOS if output_filter_sos is None else output_filter_sos
+        self.i_filter = SosFilter(self.iq_filter_sos, dtype=self.dtype)
+        self.q_filter = SosFilter(self.iq_filter_sos, dtype=self.dtype)
+        self.output_filter = SosFilter(self.output_filter_sos, dtype=self.dtype)
 
         self.sampling_freq = sampling_freq
-        self.localosc_sampling_freq = int(sampling_freq / oversampling_ratio)
-        self.local_osc_period = int(sampling_freq / self.localosc_sampling_freq)
-        local_osc_quarterperiod = int(self.local_osc_period / 4)
-        self.sin_base = np.concatenate((np.ones(2 * local_osc_quarterperiod), -1 * np.ones(2 * local_osc_quarterperiod)))
-        self.cos_base = np.concatenate((np.ones(local_osc_quarterperiod), -1 * np.ones(2 * local_osc_quarterperiod),
-                                   np.ones(local_osc_quarterperiod)))
-        print(f'sin base: {self.sin_base}')
-        print(f'cos base: {self.cos_base}')
+        if local_osc_freq is None:
+            self.nco = None
+            self.localosc_sampling_freq = int(sampling_freq / oversampling_ratio)
+            self.local_osc_period = int(sampling_freq / self.localosc_sampling_freq)
+            local_osc_quarterperiod = int(self.local_osc_period / 4)
+            self.sin_base = np.concatenate((np.ones(2 * local_osc_quarterperiod),
+                                            -1 * np.ones(2 * local_osc_quarterperiod))).astype(self.dtype)
+            self.cos_base = np.concatenate((np.ones(local_osc_quarterperiod), -1 * np.ones(2 * local_osc_quarterperiod),
+                                            np.ones(local_osc_quarterperiod))).astype(self.dtype)
+            if self.verbose:
+                print(f'sin base: {self.sin_base}')
+                print(f'cos base: {self.cos_base}')
+        else:
+            self.nco = NCO(local_osc_freq, sampling_freq, nco_table_bits, nco_amplitude_bits, dtype=self.dtype)
+            self.localosc_sampling_freq = self.nco.frequency
+            self.local_osc_period = None
+            self.sin_base = None
+            self.cos_base = None
+            if self.verbose:
+                print(f'NCO frequency: {self.nco.frequency} Hz (resolution {self.nco.resolution} Hz), '
+                      f'table size: {len(self.nco.sin_table)}')
+
+
+    # Clear internal data of filters and local oscillator and set up decimation after I/Q LPF.
+    # With decimation_factor > 1 I and Q components pass polyphase decimator, polar discriminator
+    # and output LPF run at sampling_freq / decimation_factor, and output LPF is recalculated for this rate.
+    def _init_stages(self, decimation_factor, channels_shape=()):
+        self.decimation_factor = decimation_factor
+        self.output_sampling_freq = self.sampling_freq / decimation_factor
+        self.i_filter.reset(channels_shape)
+        self.q_filter.reset(channels_shape)
+        if decimation_factor == 1:
+            self.output_filter = SosFilter(self.output_filter_sos, channels_shape, self.dtype)
+            self.i_decimator = None
+            self.q_decimator = None
+        else:
+            self.output_filter = SosFilter(rescale_sos(self.output_filter_sos, 1 / decimation_factor), channels_shape,
+                                           self.dtype)
+            self.i_decimator = PolyphaseDecimator(decimation_factor, dtype=self.dtype)
+            self.q_decimator = PolyphaseDecimator(decimation_factor, dtype=self.dtype)
+        self.locosc_idx = 0
+        if self.nco is not None:
+            self.nco.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.reset()
+
+    # Turn on collection of per-stage time and number of samples. Parameter taps is a list of tap points
+    # (see instrumentation.TAP_POINTS), the latest tap_size samples of every tap point are kept.
+    # Returns Instrumentation object holding the statistics, it is reset by init.
+    # When instrumentation is disabled (by default) the demodulator does no extra work except one check per call.
+    def enable_instrumentation(self, taps=(), tap_size=DEFAULT_TAP_SIZE):
+        self.instrumentation = Instrumentation(taps, tap_size)
+        return self.instrumentation
 
+    def disable_instrumentation(self):
+        self.instrumentation = None
 
+    # Parameter decimation_factor enables decimation of I/Q components after LPF,
+    # in this case discriminator delay is calculated in samples of the decimated rate.
     def init(self,
              discriminator_delay_ratio,
              fm_carrier_frequency,
              fm_modulation_amplitude,
-             fm_frequency_sensitivity):
-        # Buffers to store digital filter internal data
-        self.DF_Buffer_I_Input = 0
-        self.DF_Buffer_I_Output = 0
-        self.DF_Buffer_Q_Input = 0
-        self.DF_Buffer_Q_Output = 0
-        self.DF_Buffer_PolarOut_Input = 0
-        self.DF_Buffer_PolarOut_Output = 0
-        self.locosc_idx = 0
+             fm_frequency_sensitivity,
+             decimation_factor=1):
+        self._init_stages(decimation_factor)
 
         # Calculate delay in polar discriminator and round it to integer
         discriminator_delay_precise = \
-            discriminator_delay_ratio * self.sampling_freq / (2 * abs(
+            discriminator_delay_ratio * self.output_sampling_freq / (2 * abs(
                 self.localosc_sampling_freq - fm_carrier_frequency))  # Samples - Delay in polar frequency discriminator
         self.discriminator_delay = round(discriminator_delay_precise)
 
         max_phase_deviation = \
-            fm_frequency_sensitivity * (self.discriminator_delay / self.sampling_freq) * (fm_modulation_amplitude)
+            fm_frequency_sensitivity * (self.discriminator_delay / self.output_sampling_freq) * \
+            (fm_modulation_amplitude)
 
-        self.i_delay_buffer = np.zeros(self.discriminator_delay)
-        self.q_delay_buffer = np.zeros(self.discriminator_delay)
+        self.i_delay_buffer = np.zeros(self.discriminator_delay, dtype=self.dtype)
+        self.q_delay_buffer = np.zeros(self.discriminator_delay, dtype=self.dtype)
         self.delay_buffer_idx = 0
 
-        print(f'Discriminator delay in samples (precise): {discriminator_delay_precise}')
-        print(f'Discriminator delay in samples (rounded): {self.discriminator_delay}')
-        print(f'Max phase deviation: {max_phase_deviation} Hz * s = {max_phase_deviation * 360} deg')
+        if self.verbose:
+            print(f'Discriminator delay in samples (precise): {discriminator_delay_precise}')
+            print(f'Discriminator delay in samples (rounded): {self.discriminator_delay}')
+            print(f'Max phase deviation: {max_phase_deviation} Hz * s = {max_phase_deviation * 360} deg')
 
         return self.discriminator_delay
 
-    # This function uses the following global
+    # Sample by sample demodulation, works without decimation only
     def demodulate_nfm(self, newsample):
+        if self.decimation_factor != 1:
+            raise ValueError('Sample by sample demodulation does not support decimation, use demodulate_block')
+        # Instrumented sample goes the block path, which has the stages separated
+        if self.instrumentation is not None:
+            return self._process_block_instrumented(np.array([newsample], dtype=self.dtype))[0]
+
         # multiply with local oscillator
-        i_sample = newsample * self.sin_base[self.locosc_idx]
-        q_sample = newsample * self.cos_base[self.locosc_idx]
-        self.locosc_idx = (self.locosc_idx + 1) % self.local_osc_period
-
-        # LPF I channel
-        accumulator = i_sample * self.DF_BCOEF[0]
-        accumulator = accumulator + self.DF_Buffer_I_Input - (self.DF_Buffer_I_Output * self.DF_ACOEF[1])
-        self.DF_Buffer_I_Input = i_sample * self.DF_BCOEF[1]
-        self.DF_Buffer_I_Output = accumulator
-        i_sample = accumulator
-
-        # LPF Q channel
-        accumulator = q_sample * self.DF_BCOEF[0]
-        accumulator = accumulator + self.DF_Buffer_Q_Input - (self.DF_Buffer_Q_Output * self.DF_ACOEF[1])
-        self.DF_Buffer_Q_Input = q_sample * self.DF_BCOEF[1]
-        self.DF_Buffer_Q_Output = accumulator
-        q_sample = accumulator
+        if self.nco is None:
+            i_sample = newsample * self.sin_base[self.locosc_idx]
+            q_sample = newsample * self.cos_base[self.locosc_idx]
+            self.locosc_idx = (self.locosc_idx + 1) % self.local_osc_period
+        else:
+            sin_value, cos_value = self.nco.next_sample()
+            i_sample = newsample * sin_value
+            q_sample = newsample * cos_value
+
+        # LPF I and Q channels
+        i_sample = self.i_filter.process_sample(i_sample)
+        q_sample = self.q_filter.process_sample(q_sample)
 
         polar_det_out = (i_sample * self.q_delay_buffer[self.delay_buffer_idx]) -\
                         (q_sample * self.i_delay_buffer[self.delay_buffer_idx])
@@ -90,10 +155,110 @@ class DemodulatorNFM():
         self.delay_buffer_idx = (1 + self.delay_buffer_idx) % self.discriminator_delay
 
         # Apply LPF to polar discriminator output
-        accumulator = polar_det_out * self.DF_BCOEF[0]
-        accumulator = accumulator + self.DF_Buffer_PolarOut_Input - (self.DF_Buffer_PolarOut_Output * self.DF_ACOEF[1])
-        self.DF_Buffer_PolarOut_Input = polar_det_out * self.DF_BCOEF[1]
-        self.DF_Buffer_PolarOut_Output = accumulator
-        OutputSample = accumulator
+        OutputSample = self.output_filter.process_sample(polar_det_out)
+
+        return OutputSample
+
+    # Input samples converted to the type processed by the stages
+    def _convert_input(self, samples):
+        return np.asarray(samples, dtype=self.dtype)
+
+    # Multiply block of samples with local oscillator, returns I and Q samples.
+    # Parameter out is optional pair of arrays to store I and Q samples to.
+    def _mix_block(self, samples, out=None):
+        samples_cnt = samples.shape[-1]
+        if self.nco is None:
+            locosc_idx = (self.locosc_idx + np.arange(samples_cnt)) % self.local_osc_period
+            sin_values, cos_values = self.sin_base[locosc_idx], self.cos_base[locosc_idx]
+            self.locosc_idx = (self.locosc_idx + samples_cnt) % self.local_osc_period
+        else:
+            sin_values, cos_values = self.nco.generate(samples_cnt)
+        i_out, q_out = (None, None) if out is None else out
+        i_samples = np.multiply(samples, sin_values, out=i_out)
+        q_samples = np.multiply(samples, cos_values, out=q_out)
+        return i_samples, q_samples
+
+    # Polar discriminator applied to the whole block.
+    # Delay line is unrolled so that the oldest sample goes first,
+    # then the delayed samples are just the beginning of the delay line followed by the new block.
+    def _discriminate_block(self, i_samples, q_samples):
+        samples_cnt = i_samples.shape[-1]
+        i_line = np.concatenate((np.roll(self.i_delay_buffer, -self.delay_buffer_idx), i_samples))
+        q_line = np.concatenate((np.roll(self.q_delay_buffer, -self.delay_buffer_idx), q_samples))
+        polar_det_out = (i_samples * q_line[:samples_cnt]) - (q_samples * i_line[:samples_cnt])
+        self.i_delay_buffer = i_line[samples_cnt:].copy()
+        self.q_delay_buffer = q_line[samples_cnt:].copy()
+        self.delay_buffer_idx = 0
+        return polar_det_out
+
+    # This method does the same as demodulate_nfm but processes the whole array of samples per one call.
+    # All internal state (filter buffers, local oscillator phase and discriminator delay line) is kept
+    # between calls, so the signal may be split into blocks of any length, and the calls may be mixed
+    # with calls of demodulate_nfm. With decimation the output has one sample per decimation_factor
+    # input samples.
+    def demodulate_block(self, samples):
+        samples = self._convert_input(samples)
+        if samples.shape[-1] == 0:
+            return np.empty(samples.shape, dtype=self.dtype)
+        return self._process_block(samples)
+
+    # Stages of demodulate_block applied to array of float samples
+    def _process_block(self, samples):
+        if self.instrumentation is not None:
+            return self._process_block_instrumented(samples)
+
+        # multiply with local oscillator
+        i_samples, q_samples = self._mix_block(samples)
+
+        # LPF I and Q channels
+        i_samples = self.i_filter.process_block(i_samples)
+        q_samples = self.q_filter.process_block(q_samples)
+
+        # Keep only every decimation_factor-th sample of I and Q
+        if self.i_decimator is not None:
+            i_samples = self.i_decimator.process_block(i_samples)
+            q_samples = self.q_decimator.process_block(q_samples)
+
+        polar_det_out = self._discriminate_block(i_samples, q_samples)
+
+        # Apply LPF to polar discriminator output
+        return self.output_filter.process_block(polar_det_out)
+
+    # The same stages as in _process_block with time measurement and capture of tap points
+    def _process_block_instrumented(self, samples):
+        instrumentation = self.instrumentation
+        samples_cnt = samples.shape[-1]
+        instrumentation.calls += 1
+        timer = StageTimer()
+
+        i_samples, q_samples = self._mix_block(samples)
+        instrumentation.add_stage('mix', timer.split(), samples_cnt)
+        instrumentation.capture('mix_i', i_samples)
+        instrumentation.capture('mix_q', q_samples)
+
+        timer.split()
+        i_samples = self.i_filter.process_block(i_samples)
+        q_samples = self.q_filter.process_block(q_samples)
+        instrumentation.add_stage('iq_lpf', timer.split(), samples_cnt)
+        instrumentation.capture('lpf_i', i_samples)
+        instrumentation.capture('lpf_q', q_samples)
+
+        if self.i_decimator is not None:
+            timer.split()
+            i_samples = self.i_decimator.process_block(i_samples)
+            q_samples = self.q_decimator.process_block(q_samples)
+            instrumentation.add_stage('decimation', timer.split(), i_samples.shape[-1])
+            instrumentation.capture('decimated_i', i_samples)
+            instrumentation.capture('decimated_q', q_samples)
+
+        timer.split()
+        polar_det_out = self._discriminate_block(i_samples, q_samples)
+        instrumentation.add_stage('discriminator', timer.split(), polar_det_out.shape[-1])
+        instrumentation.capture('discriminator', polar_det_out)
+
+        timer.split()
+        output = self.output_filter.process_block(polar_det_out)
+        instrumentation.add_stage('output_lpf', timer.split(), output.shape[-1])
+        instrumentation.capture('output', output)
 
-        return OutputSample
\ No newline at end of file
+        return output
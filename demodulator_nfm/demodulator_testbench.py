@@ -1,9 +1,13 @@
 
+import argparse
+import importlib.util
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 from demodulator_nfm import DemodulatorNFM
+from nfm_reference import generate_modulation_signal, modulate_fm, scale_signal
+from quality_metrics import measure_quality
+from result_store import ResultStore, result_key, DEFAULT_MAX_BYTES
 
 # =========== USER DEFINES =============
 
@@ -76,132 +80,244 @@ CUT_SAMPLES_CNT = 150        # Number of samples at the beginning to skip transi
 
 # =========== USER DEFINES (end) =============
 
-# Precalculations:
-
-t_sampling = 1/SAMPLING_FREQUENCY
-t_observation = t_sampling * (NUMBER_OF_SAMPLES)
-print(f'Sampling frequency = {SAMPLING_FREQUENCY} Hz; Period = {t_sampling * 1e6} us')
-print(f'Local Oscillator frequency = {RECEIVER_SAMPLING_FREQUENCY} Hz')
-print(f'Observation interval = {t_observation * 1e6} us')
-print(f'Delay = {DISCRIMINATOR_DELAY_RATIO} count of pi')
-print(f'Modulating frequencies = {FM1_MOD_FREQ_LIST} Hz')
-print(f'Modulating amplitudes = {FM1_MOD_AMP_LIST} V')
-print(f'Frequency sensitivity = {FM1_FREQ_SENSITIVITY} Hz/V')
-
-# This function to generate modulation signal used to modulate carrier frequency later
-# Parameter modulation_freq_list is a list containing frequency components of modulation signal
-# Parameter modulation_amp_list is a list containing amplitudes of frequency components of modulation signal
-def generate_modulation_signal(time_vector, modulation_freq_list, modulation_amp_list):
-    time_vect_len = len(time_vector)
-    modulation_signal = np.zeros(time_vect_len)
-    for freq, amplitude in zip(modulation_freq_list, modulation_amp_list):
-        temp = amplitude * np.sin(time_vector * 2 * np.pi * freq )
-        modulation_signal = modulation_signal + temp
-
-    return modulation_signal
-
-# Function to generate samples of FM signal using known modulation signal
-def modulate_fm(time_vector, carrier_freq, carrier_amp, frequency_sensitivity, modulation_signal):
-    sampling_period = 1 / carrier_freq
-    samples_cnt = len(time_vector)
-    phase_components =np.zeros(samples_cnt)
-    # Calculate integral of modulation signal
-    sum = 0
-    for idx in range(samples_cnt):
-        sum = sum + modulation_signal[idx]
-        phase_components[idx] = sum
-    # Calculate phase component caused by modulation signal
-    phase_components = phase_components * frequency_sensitivity * sampling_period
-
-    fm_signal = carrier_amp * np.cos((time_vector * 2 * np.pi * carrier_freq) + phase_components )
-
-    return [fm_signal , phase_components]
-
-# This function to linear scale of the output signal at FM demodulator to the modulation signal
-# The vect to be scaled to reference vector ref_vect
-def scale_signal(ref_vect, vect, invert = False):
-    if (True == invert):
-        vect = -1 * vect
-    minval = min(ref_vect)
-    maxval = max(ref_vect)
-    aver = np.average([max(vect), min(vect)])
-    vect_centered = vect - aver
-    scale_factor = (maxval - minval) / (max(vect_centered) - min(vect_centered))
-    vect_scaled = vect_centered * scale_factor
-    offset = np.average([minval, maxval])
-    vect_output = vect_scaled + offset
-
-    return (vect_output)
+# Parameters above as configuration (see parameter_sweep.py)
+USER_CONFIG = {
+    'receiver_sampling_freq': RECEIVER_SAMPLING_FREQUENCY,
+    'oversampling_ratio': OVERSAMPLING_RATIO,
+    'carrier_freq': FM1_CARRIER_FREQ,
+    'carrier_amplitude': FM1_AMPLITURE,
+    'freq_sensitivity': FM1_FREQ_SENSITIVITY,
+    'mod_freq_list': FM1_MOD_FREQ_LIST,
+    'mod_amp_list': FM1_MOD_AMP_LIST,
+    'discriminator_delay_ratio': DISCRIMINATOR_DELAY_RATIO,
+    'number_of_samples': NUMBER_OF_SAMPLES,
+    'cut_samples_cnt': CUT_SAMPLES_CNT,
+}
+
+# Images and arrays are stored to the "results" folder which is located next to this script
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Results of runs are kept in the result store (see result_store.py) in this folder of the output folder
+STORE_DIR_NAME = 'store'
+# Intermediate signals of the demodulator kept with the results
+STORED_TAPS = ('mix_i', 'mix_q', 'lpf_i', 'lpf_q', 'discriminator')
+# Extra lag allowed in addition to the discriminator delay when output is aligned to the modulation signal
+LAG_SEARCH_MARGIN = 64
+
+
+def print_config(config):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    t_sampling = 1 / sampling_freq
+    print(f'Sampling frequency = {sampling_freq} Hz; Period = {t_sampling * 1e6} us')
+    print(f'Local Oscillator frequency = {config["receiver_sampling_freq"]} Hz')
+    print(f'Observation interval = {t_sampling * config["number_of_samples"] * 1e6} us')
+    print(f'Delay = {config["discriminator_delay_ratio"]} count of pi')
+    print(f'Modulating frequencies = {config["mod_freq_list"]} Hz')
+    print(f'Modulating amplitudes = {config["mod_amp_list"]} V')
+    print(f'Frequency sensitivity = {config["freq_sensitivity"]} Hz/V')
+
+
+# Name of the results of configuration, images and arrays are named after it
+def result_name(config):
+    Fmod = ""
+    Amod = ""
+    for f,a in zip(config['mod_freq_list'], config['mod_amp_list']):
+        Fmod = Fmod + str(f)+"_"
+        Amod = Amod + str(a) + "_"
+    return f'fc_{int(config["carrier_freq"])}_Fmod_{Fmod}Amod_{Amod}sens_{config["freq_sensitivity"]}_' \
+           f'over_{config["oversampling_ratio"]}'
+
+
+# This function generates FM signal for the configuration and applies it sample by sample
+# to the demodulate_nfm method. Returns dictionary with input signal, modulation signal, output signal,
+# output scaled to the modulation signal and discriminator delay.
+# Parameter taps is a list of tap points of the demodulator (see instrumentation.TAP_POINTS),
+# their signals are added to the result as 'tap_<name>'.
+def run_testbench(config, verbose=True, taps=()):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    t_observation = config['number_of_samples'] / sampling_freq
+    cut_samples_cnt = config['cut_samples_cnt']
+
+    # Create time vector
+    time_vector = np.linspace(0,t_observation, config['number_of_samples'] + 1 )
+    # Generate modulation signals
+    modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'])
+    # Generate final FM signal
+    [signal, phase_comps] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                                        config['freq_sensitivity'], modulation_signal)
+
+    # Create NFM demodulator object and initialize it
+    demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=verbose)
+    discriminator_delay = demodulator.init(config['discriminator_delay_ratio'],
+                     config['carrier_freq'],
+                     sum(config['mod_amp_list']),
+                     config['freq_sensitivity'])
+    if taps:
+        instrumentation = demodulator.enable_instrumentation(taps, len(signal))
+
+    # Apply sample by sample to the demodulate_nfm method
+    out_signal = np.empty(len(signal))
+    for idx, sample in enumerate(signal):
+        out_signal[idx] = demodulator.demodulate_nfm(sample)
+
+    # Just apply linear scaling to the output signal to be able to plot modulation signal
+    # at the same plot as demodulated signal.
+    if (config['discriminator_delay_ratio'] % 2):
+        invert = False
+    else:
+        invert = True
+    scaled_output = scale_signal(modulation_signal[cut_samples_cnt:], out_signal[cut_samples_cnt:], invert)
+
+    result = {'signal': signal, 'modulation_signal': modulation_signal, 'out_signal': out_signal,
+              'scaled_output': scaled_output, 'discriminator_delay': discriminator_delay}
+    for tap_point in taps:
+        result['tap_' + tap_point] = instrumentation.tap(tap_point)
+    return result
+
+
+# Quality metrics of the result against the modulation signal (see quality_metrics.py)
+def result_metrics(result, config):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    quality = measure_quality(result['out_signal'], result['modulation_signal'], sampling_freq, config['mod_freq_list'],
+                              max_lag=int(result['discriminator_delay']) + LAG_SEARCH_MARGIN,
+                              cut_samples_cnt=config['cut_samples_cnt'])
+    return {name: value.item() for name, value in quality.items()}
+
+
+# Returns result of the configuration from the store, runs the testbench and stores the result if it is missing
+# or rerun is True. Result is keyed by the configuration and the code version, its arrays are loaded lazily.
+def stored_testbench(config, store, verbose=True, rerun=False):
+    key = result_key(config)
+    result = None if rerun else store.get(key)
+    if result is None:
+        arrays = run_testbench(config, verbose, STORED_TAPS)
+        metadata = {'name': result_name(config), 'metrics': result_metrics(arrays, config)}
+        result = store.put(key, arrays, config, metadata)
+    return result
+
+
+# Writes arrays of the result as one .npz file or as .npy file per array, returns list of file names
+def save_arrays(result, name, output_dir, file_format='npz'):
+    arrays = {key: np.asarray(result[key]) for key in result.keys()}
+    if file_format == 'npz':
+        file_name = os.path.join(output_dir, name + '.npz')
+        np.savez(file_name, **arrays)
+        return [file_name]
+    file_names = []
+    for key, array in arrays.items():
+        file_names.append(os.path.join(output_dir, f'{name}_{key}.npy'))
+        np.save(file_names[-1], array)
+    return file_names
+
+
+# This function draws figures of the result. Matplotlib is imported here, so it is loaded only
+# when plots are requested. Figures of the output are stored to output_dir (raw_ and scaled_ images),
+# the figures are closed unless show is True. Returns list of image file names.
+def plot_result(result, name, output_dir, cut_samples_cnt, show=False):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    modulation_signal = result['modulation_signal']
+    discriminator_delay = int(result['discriminator_delay'])
+    figure_name = name + '.png'
+    file_names = [os.path.join(output_dir, "raw_" + figure_name), os.path.join(output_dir, "scaled_" + figure_name)]
+
+    # Change plot settings, like font size etc
+    mpl.rcParams['lines.linewidth'] = 2
+    mpl.rcParams['xtick.labelsize'] = 16
+    mpl.rcParams['ytick.labelsize'] = 16
+    mpl.rcParams['font.size'] = 16
+    figures = [plt.figure()]
+    plt.plot(modulation_signal)
+    plt.title("Modulation Signal")
+    plt.grid()
+
+    figures.append(plt.figure())
+    plt.plot(result['out_signal'][cut_samples_cnt:])
+    plt.title("Demodulator Output")
+    plt.xlabel("Samples")
+    plt.grid()
+    plt.savefig(file_names[0])
+
+    figures.append(plt.figure(figsize=(7.5, 5)))
+    plt.plot(modulation_signal[cut_samples_cnt:], "--", color="black", linewidth = 4)
+    plt.plot(result['scaled_output'][discriminator_delay:], color="gray", linewidth = 3)
+    plt.title("Modulating Signal and Scaled Output Signal")
+    plt.xlabel("Samples")
+    plt.ylabel("Voltage")
+    plt.grid()
+    plt.savefig(file_names[1])
+
+    if not show:
+        for figure in figures:
+            plt.close(figure)
+    return file_names
+
+
+# Figure worker renders images without display
+def _init_figure_worker():
+    import matplotlib
+    matplotlib.use('Agg')
 
-# ----- MAIN PROGRAM -----
-# Create time vector
-time_vector = np.linspace(0,t_observation, NUMBER_OF_SAMPLES + 1 )
-# Generate modulation signals
-modulation_signal = generate_modulation_signal(time_vector, FM1_MOD_FREQ_LIST, FM1_MOD_AMP_LIST)
-# Generate final FM signal
-[signal, phase_comps] = modulate_fm(time_vector, FM1_CARRIER_FREQ, FM1_AMPLITURE, FM1_FREQ_SENSITIVITY, modulation_signal)
-
-# Create NFM demodulator object and initialize it
-demodulator = DemodulatorNFM(SAMPLING_FREQUENCY, OVERSAMPLING_RATIO)
-discriminator_delay = demodulator.init(DISCRIMINATOR_DELAY_RATIO,
-                 FM1_CARRIER_FREQ,
-                 sum(FM1_MOD_AMP_LIST),
-                 FM1_FREQ_SENSITIVITY)
-
-# Apply sample by sample to the demodulate_nfm method
-out_signal = np.empty(len(signal))
-for idx, sample in enumerate(signal):
-    out_signal[idx] = demodulator.demodulate_nfm(sample)
-
-# Just apply linear scaling to the output signal to be able to plot modulation signal
-# at the same plot as demodulated signal.
-if (DISCRIMINATOR_DELAY_RATIO % 2):
-    invert = False
-else:
-    invert = True
-scaled_output = scale_signal(modulation_signal[CUT_SAMPLES_CNT:], out_signal[CUT_SAMPLES_CNT:], invert)
-
-# Define image file name to store images.
-Fmod = ""
-Amod = ""
-for f,a in zip(FM1_MOD_FREQ_LIST, FM1_MOD_AMP_LIST):
-    Fmod = Fmod + str(f)+"_"
-    Amod = Amod + str(a) + "_"
-figure_name = f'fc_{int(FM1_CARRIER_FREQ)}_Fmod_{Fmod}Amod_{Amod}sens_{FM1_FREQ_SENSITIVITY}_over_{OVERSAMPLING_RATIO}.png'
-print(f'image name: {figure_name}')
-
-# Change current directory to this script directory.
-# This is to store images to the "results" folder which is located next to this script.
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-
-# Change plot settings, like font size etc
-mpl.rcParams['lines.linewidth'] = 2
-mpl.rcParams['xtick.labelsize'] = 16
-mpl.rcParams['ytick.labelsize'] = 16
-mpl.rcParams['font.size'] = 16
-plt.figure()
-plt.plot(modulation_signal)
-plt.title("Modulation Signal")
-plt.grid()
-
-plt.figure()
-plt.plot(out_signal[CUT_SAMPLES_CNT:])
-plt.title("Demodulator Output")
-plt.xlabel("Samples")
-plt.grid()
-plt.savefig("results/" + "raw_" + figure_name)
-
-
-plt.figure(figsize=(7.5, 5))
-plt.plot(modulation_signal[CUT_SAMPLES_CNT:], "--", color="black", linewidth = 4)
-plt.plot(scaled_output[discriminator_delay:], color="gray", linewidth = 3)
-plt.title("Modulating Signal and Scaled Output Signal")
-plt.xlabel("Samples")
-plt.ylabel("Voltage")
-plt.grid()
-plt.savefig("results/" + "scaled_" + figure_name)
-
-plt.show()
 
+# ----- MAIN PROGRAM -----
+if __name__ == '__main__':
+    from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+
+    parser = argparse.ArgumentParser(description='Testbench of NFM demodulator')
+    parser.add_argument('--sets', type=int, nargs='*',
+                        help='Indexes (from 1) of testbench parameter sets, parameters of USER DEFINES by default')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help='Directory for images and arrays')
+    parser.add_argument('--no-plots', action='store_true', help='Do not draw figures, matplotlib is not loaded')
+    parser.add_argument('--show', action='store_true',
+                        help='Draw figures in this process and show them interactively')
+    parser.add_argument('--save-arrays', choices=('npz', 'npy'), default=None,
+                        help='Write output arrays in this format')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes rendering figures')
+    parser.add_argument('--quiet', action='store_true', help='Do not print parameters')
+    parser.add_argument('--no-store', action='store_true', help='Always run the testbench, do not use result store')
+    parser.add_argument('--rerun', action='store_true', help='Run the testbench and replace stored results')
+    parser.add_argument('--max-store-mb', type=float, default=DEFAULT_MAX_BYTES / (1 << 20),
+                        help='Size limit of the result store, least recently used results are evicted')
+    args = parser.parse_args()
+    if not args.no_plots and importlib.util.find_spec('matplotlib') is None:
+        parser.error('matplotlib is required for plots, use --no-plots to write arrays only')
+
+    configs = [USER_CONFIG] if not args.sets else \
+        [complete_config(TESTBENCH_PARAMETER_SETS[idx - 1]) for idx in args.sets]
+    os.makedirs(args.output_dir, exist_ok=True)
+    store = None if args.no_store else \
+        ResultStore(os.path.join(args.output_dir, STORE_DIR_NAME), int(args.max_store_mb * (1 << 20)))
+
+    # Figures are rendered by the worker pool while the next configuration is demodulated
+    figure_pool = None
+    if not args.no_plots and not args.show:
+        figure_pool = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_figure_worker)
+    figure_futures = []
+    for config in configs:
+        if not args.quiet:
+            print_config(config)
+        if store is None:
+            result = run_testbench(config, verbose=not args.quiet)
+        else:
+            result = stored_testbench(config, store, verbose=not args.quiet, rerun=args.rerun)
+            print(f'stored result {result.key}: {result.metadata["metrics"]}')
+        name = result_name(config)
+        if args.save_arrays:
+            for file_name in save_arrays(result, name, args.output_dir, args.save_arrays):
+                print(f'array file: {file_name}')
+        if figure_pool is not None:
+            figure_futures.append(figure_pool.submit(plot_result, result, name, args.output_dir,
+                                                     config['cut_samples_cnt']))
+        elif args.show:
+            plot_result(result, name, args.output_dir, config['cut_samples_cnt'], show=True)
+
+    if figure_pool is not None:
+        for future in figure_futures:
+            for file_name in future.result():
+                print(f'image file: {file_name}')
+        figure_pool.shutdown()
+    if store is not None:
+        store.flush()
+    if args.show:
+        import matplotlib.pyplot as plt
+        plt.show()
@@ -0,0 +1,111 @@
+import json
+import time
+import numpy as np
+
+# Stages of the demodulator which are timed
+STAGES = ('mix', 'iq_lpf', 'decimation', 'discriminator', 'output_lpf')
+# Points of the pipeline where intermediate signals may be captured
+TAP_POINTS = ('mix_i', 'mix_q', 'lpf_i', 'lpf_q', 'decimated_i', 'decimated_q', 'discriminator', 'output')
+# Number of the latest samples kept by every tap by default
+DEFAULT_TAP_SIZE = 4096
+
+
+# Ring buffer keeping the latest capacity samples (last axis) of the signal.
+# Memory is allocated on the first write and reused while the number of channels (leading axes) is the same.
+class TapBuffer():
+
+    def __init__(self, capacity=DEFAULT_TAP_SIZE):
+        self.capacity = capacity
+        self.buffer = None
+        self.reset()
+
+    def reset(self):
+        self.write_idx = 0
+        self.samples_written = 0
+
+    def write(self, samples):
+        samples = np.asarray(samples)
+        if self.buffer is None or self.buffer.shape[:-1] != samples.shape[:-1]:
+            self.buffer = np.zeros(samples.shape[:-1] + (self.capacity,), dtype=samples.dtype)
+            self.reset()
+        samples_cnt = samples.shape[-1]
+        self.samples_written += samples_cnt
+        if samples_cnt >= self.capacity:
+            self.buffer[...] = samples[..., samples_cnt - self.capacity:]
+            self.write_idx = 0
+            return
+        first_part = min(samples_cnt, self.capacity - self.write_idx)
+        self.buffer[..., self.write_idx:self.write_idx + first_part] = samples[..., :first_part]
+        self.buffer[..., :samples_cnt - first_part] = samples[..., first_part:]
+        self.write_idx = (self.write_idx + samples_cnt) % self.capacity
+
+    # The latest samples in time order, at most capacity of them
+    def read(self):
+        if self.buffer is None:
+            return np.empty(0)
+        if self.samples_written < self.capacity:
+            return self.buffer[..., :self.samples_written].copy()
+        return np.roll(self.buffer, -self.write_idx, axis=-1)
+
+
+# Statistics of the demodulator stages: cumulative time and number of samples processed by every stage
+# (samples of one channel, output samples for decimation), optional taps capturing the intermediate signals.
+# Instance is attached to the demodulator by DemodulatorNFM.enable_instrumentation.
+class Instrumentation():
+
+    def __init__(self, taps=(), tap_size=DEFAULT_TAP_SIZE):
+        unknown_taps = set(taps) - set(TAP_POINTS)
+        if unknown_taps:
+            raise ValueError(f'Unknown tap points {sorted(unknown_taps)}, expected some of {TAP_POINTS}')
+        self.taps = {name: TapBuffer(tap_size) for name in taps}
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.stage_time = dict.fromkeys(STAGES, 0.0)
+        self.stage_samples = dict.fromkeys(STAGES, 0)
+        for tap in self.taps.values():
+            tap.reset()
+
+    def add_stage(self, stage, seconds, samples_cnt):
+        self.stage_time[stage] += seconds
+        self.stage_samples[stage] += samples_cnt
+
+    def capture(self, tap_point, samples):
+        tap = self.taps.get(tap_point)
+        if tap is not None:
+            tap.write(samples)
+
+    # Captured samples of the tap point
+    def tap(self, tap_point):
+        return self.taps[tap_point].read()
+
+    # Statistics as dictionary of plain Python types. With include_taps the captured samples are added as lists.
+    def snapshot(self, include_taps=False):
+        stages = {}
+        for stage in STAGES:
+            seconds = self.stage_time[stage]
+            stages[stage] = {'seconds': seconds, 'samples': self.stage_samples[stage],
+                             'samples_per_s': self.stage_samples[stage] / seconds if seconds > 0 else None}
+        taps = {}
+        for name, tap in self.taps.items():
+            taps[name] = {'capacity': tap.capacity, 'samples_written': tap.samples_written}
+            if include_taps:
+                taps[name]['samples'] = tap.read().tolist()
+        return {'calls': self.calls, 'total_seconds': sum(self.stage_time.values()), 'stages': stages, 'taps': taps}
+
+    def to_json(self, include_taps=False, **kwargs):
+        return json.dumps(self.snapshot(include_taps), **kwargs)
+
+
+# Time measurement between stages: split() returns time since the previous split
+class StageTimer():
+
+    def __init__(self):
+        self.last_time = time.perf_counter()
+
+    def split(self):
+        now = time.perf_counter()
+        seconds = now - self.last_time
+        self.last_time = now
+        return seconds
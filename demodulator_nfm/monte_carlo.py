@@ -0,0 +1,130 @@
+import argparse
+import numpy as np
+from demodulator_bank import DemodulatorBankNFM
+from nfm_reference import generate_modulation_signal, modulate_fm
+from quality_metrics import measure_quality
+
+# Extra lag allowed in addition to the discriminator delay when output is aligned to the modulation signal
+LAG_SEARCH_MARGIN = 64
+# Percentiles reported for every metric
+PERCENTILES = (5, 50, 95)
+
+
+# Description of impairments added to the FM signal:
+# freq_offset_std [Hz]      - standard deviation of carrier frequency offset, random per realization
+# phase_noise_std [rad]     - standard deviation of phase increment per sample (Wiener phase noise)
+# interferers               - list of adjacent channel FM signals, every one is a dictionary with keys
+#                             freq_offset [Hz], amplitude, mod_freq_list, mod_amp_list, freq_sensitivity
+class Impairments():
+
+    def __init__(self, freq_offset_std=0.0, phase_noise_std=0.0, interferers=()):
+        self.freq_offset_std = freq_offset_std
+        self.phase_noise_std = phase_noise_std
+        self.interferers = list(interferers)
+
+
+# This function generates batch of noisy realizations of FM signal, array (realizations_cnt x samples).
+# Clean phase of the modulation (phase_components from modulate_fm) is shared by all realizations,
+# every realization gets its own random carrier phase, frequency offset, phase noise,
+# interferer phases and white Gaussian noise. SNR is relative to the carrier power.
+def generate_realizations(time_vector, carrier_freq, carrier_amp, phase_components, snr_db, realizations_cnt,
+                          impairments, rng):
+    samples_cnt = len(time_vector)
+    shape = (realizations_cnt, samples_cnt)
+    phase = 2 * np.pi * carrier_freq * time_vector + phase_components + rng.uniform(0, 2 * np.pi, (realizations_cnt, 1))
+    if impairments.freq_offset_std:
+        phase = phase + 2 * np.pi * rng.normal(0, impairments.freq_offset_std, (realizations_cnt, 1)) * time_vector
+    if impairments.phase_noise_std:
+        phase = phase + np.cumsum(rng.normal(0, impairments.phase_noise_std, shape), axis=1)
+    signals = carrier_amp * np.cos(phase)
+
+    for interferer in impairments.interferers:
+        interferer_freq = carrier_freq + interferer['freq_offset']
+        modulation_signal = generate_modulation_signal(time_vector, interferer['mod_freq_list'],
+                                                       interferer['mod_amp_list'])
+        [_, interferer_phase] = modulate_fm(time_vector, interferer_freq, 1, interferer['freq_sensitivity'],
+                                            modulation_signal)
+        signals += interferer['amplitude'] * np.cos(2 * np.pi * interferer_freq * time_vector + interferer_phase +
+                                                    rng.uniform(0, 2 * np.pi, (realizations_cnt, 1)))
+
+    noise_std = np.sqrt(carrier_amp ** 2 / 2 / 10 ** (snr_db / 10))
+    signals += rng.normal(0, noise_std, shape)
+
+    return signals
+
+
+# Summary of distribution of metric values: mean, standard deviation and percentiles
+def summarize(values):
+    values = np.asarray(values)
+    summary = {'mean': float(np.mean(values)), 'std': float(np.std(values))}
+    summary.update({f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+    return summary
+
+
+# This function runs Monte Carlo simulation of the demodulator for every SNR in snr_db_list.
+# Realizations are generated and demodulated in batches of chunk_size rows (one channel of
+# DemodulatorBankNFM per realization), metrics of every batch are calculated at once and only
+# the metric values are kept, so memory is bounded by chunk_size x number of samples.
+# Returns dictionary: SNR -> metric name -> summary of distribution (see summarize).
+def run_monte_carlo(config, snr_db_list, realizations_cnt, impairments=None, chunk_size=256, seed=0):
+    impairments = Impairments() if impairments is None else impairments
+    rng = np.random.default_rng(seed)
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    decimation_factor = config.get('decimation_factor', 1)
+    time_vector = np.linspace(0, config['number_of_samples'] / sampling_freq, config['number_of_samples'] + 1)
+    modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'])
+    [_, phase_components] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                                        config['freq_sensitivity'], modulation_signal)
+    reference = modulation_signal[::decimation_factor]
+
+    bank = DemodulatorBankNFM(sampling_freq, config['oversampling_ratio'], verbose=False)
+    results = {}
+    for snr_db in snr_db_list:
+        metric_values = {}
+        for chunk_start in range(0, realizations_cnt, chunk_size):
+            chunk_len = min(chunk_size, realizations_cnt - chunk_start)
+            signals = generate_realizations(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                                            phase_components, snr_db, chunk_len, impairments, rng)
+            discriminator_delay = bank.init(np.full(chunk_len, config['discriminator_delay_ratio']),
+                                            config['carrier_freq'], sum(config['mod_amp_list']),
+                                            config['freq_sensitivity'], decimation_factor=decimation_factor)
+            output = bank.demodulate_block(signals)
+            metrics = measure_quality(output, reference[:output.shape[-1]], sampling_freq / decimation_factor,
+                                      config['mod_freq_list'], max_lag=discriminator_delay + LAG_SEARCH_MARGIN,
+                                      cut_samples_cnt=config['cut_samples_cnt'] // decimation_factor)
+            for name, values in metrics.items():
+                metric_values.setdefault(name, []).append(values)
+        results[snr_db] = {name: summarize(np.concatenate(values)) for name, values in metric_values.items()}
+
+    return results
+
+
+if __name__ == '__main__':
+    from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of NFM demodulator with noise and interference')
+    parser.add_argument('--set', type=int, default=3, help='Index (from 1) of testbench parameter set')
+    parser.add_argument('--snr', type=float, nargs='*', default=[0, 5, 10, 15, 20, 30], help='SNR values, dB')
+    parser.add_argument('--realizations', type=int, default=1000)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--freq-offset-std', type=float, default=0.0, help='Carrier frequency offset std, Hz')
+    parser.add_argument('--phase-noise-std', type=float, default=0.0, help='Phase noise std per sample, rad')
+    parser.add_argument('--interferer', type=float, nargs=2, action='append', default=[],
+                        metavar=('FREQ_OFFSET', 'AMPLITUDE'),
+                        help='Adjacent channel FM interferer (modulated with 500 Hz tone)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    interferers = [{'freq_offset': freq_offset, 'amplitude': amplitude, 'mod_freq_list': [500],
+                    'mod_amp_list': [1.0], 'freq_sensitivity': 1000} for freq_offset, amplitude in args.interferer]
+    impairments = Impairments(args.freq_offset_std, args.phase_noise_std, interferers)
+    config = complete_config(TESTBENCH_PARAMETER_SETS[args.set - 1])
+    results = run_monte_carlo(config, args.snr, args.realizations, impairments, args.chunk_size, args.seed)
+
+    print(f'{"SNR dB":>7} | {"SINAD mean":>10} | {"SINAD p5":>9} | {"SINAD p50":>9} | {"SINAD p95":>9} | '
+          f'{"THD mean":>9} | {"corr p50":>8}')
+    for snr_db, metrics in results.items():
+        sinad = metrics['sinad_db']
+        print(f'{snr_db:>7.1f} | {sinad["mean"]:>10.2f} | {sinad["p5"]:>9.2f} | {sinad["p50"]:>9.2f} | '
+              f'{sinad["p95"]:>9.2f} | {metrics["thd_db"]["mean"]:>9.2f} | '
+              f'{metrics["correlation"]["p50"]:>8.3f}')
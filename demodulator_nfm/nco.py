@@ -0,0 +1,76 @@
+import numpy as np
+
+# Width of the phase accumulator, frequency resolution is sampling_freq / 2**phase_bits
+DEFAULT_PHASE_BITS = 32
+# Size of sin/cos tables is 2**table_bits, spurs caused by phase truncation are about 6 dB * table_bits below carrier
+DEFAULT_TABLE_BITS = 12
+MAX_PHASE_BITS = 32
+
+
+# Numerically controlled oscillator: phase accumulator and precomputed sin/cos lookup tables.
+# Phase is an unsigned integer of phase_bits bits which is incremented by phase_increment every sample,
+# upper table_bits bits of the phase (rounded) select the table entry. Parameter amplitude_bits quantizes
+# table values to signed integers of this width scaled back to [-1, 1] (None keeps float64 values),
+# parameter dtype is the type of the tables.
+# The phase is kept between calls of generate, so blocks of any length give continuous oscillation.
+# Frequency may be any value in (-sampling_freq/2, sampling_freq/2], it is rounded to the nearest
+# multiple of the resolution, the actual value is in attribute frequency.
+class NCO():
+
+    def __init__(self, frequency, sampling_freq, table_bits=DEFAULT_TABLE_BITS, amplitude_bits=None,
+                 phase_bits=DEFAULT_PHASE_BITS, dtype=np.float64):
+        if not 0 < table_bits <= phase_bits <= MAX_PHASE_BITS:
+            raise ValueError(f'Expected 0 < table_bits <= phase_bits <= {MAX_PHASE_BITS}, '
+                             f'got table_bits={table_bits}, phase_bits={phase_bits}')
+        # One bit is the sign, at least one more is needed for a non-zero scale of the table values
+        if amplitude_bits is not None and amplitude_bits < 2:
+            raise ValueError(f'Expected amplitude_bits >= 2, got {amplitude_bits}')
+        self.sampling_freq = sampling_freq
+        self.table_bits = table_bits
+        self.amplitude_bits = amplitude_bits
+        self.phase_bits = phase_bits
+        self.__phase_mask = (1 << phase_bits) - 1
+        self.__index_shift = phase_bits - table_bits
+        self.__index_mask = (1 << table_bits) - 1
+        # Half of the table step added before truncation of the phase, so the nearest table entry is selected
+        self.__index_round = (1 << self.__index_shift) >> 1
+
+        angles = 2 * np.pi * np.arange(1 << table_bits) / (1 << table_bits)
+        self.sin_table = self.__quantize(np.sin(angles)).astype(dtype)
+        self.cos_table = self.__quantize(np.cos(angles)).astype(dtype)
+
+        self.resolution = sampling_freq / (1 << phase_bits)
+        self.phase_increment = round(frequency / self.resolution) & self.__phase_mask
+        signed_increment = self.phase_increment - ((self.phase_increment >> (phase_bits - 1)) << phase_bits)
+        self.frequency = signed_increment * self.resolution
+        self.reset()
+
+    def __quantize(self, values):
+        if self.amplitude_bits is None:
+            return values
+        scale = (1 << (self.amplitude_bits - 1)) - 1
+        return np.round(values * scale) / scale
+
+    # Set phase of the oscillator, in cycles
+    def reset(self, phase=0.0):
+        self.phase = round(phase * (1 << self.phase_bits)) & self.__phase_mask
+
+    # Table indexes of the next samples_cnt samples, phase is advanced past them
+    def __next_indexes(self, samples_cnt):
+        # phase_increment * samples_cnt fits into 64 bits for any block shorter than 2**31 samples
+        phases = (self.phase + self.phase_increment * np.arange(samples_cnt, dtype=np.uint64)) \
+            & np.uint64(self.__phase_mask)
+        self.phase = (self.phase + self.phase_increment * samples_cnt) & self.__phase_mask
+        return ((phases + np.uint64(self.__index_round)) >> np.uint64(self.__index_shift)) & \
+            np.uint64(self.__index_mask)
+
+    # Returns sin and cos of the next samples_cnt samples
+    def generate(self, samples_cnt):
+        indexes = self.__next_indexes(samples_cnt)
+        return self.sin_table[indexes], self.cos_table[indexes]
+
+    # Returns sin and cos of the next sample
+    def next_sample(self):
+        index = ((self.phase + self.__index_round) >> self.__index_shift) & self.__index_mask
+        self.phase = (self.phase + self.phase_increment) & self.__phase_mask
+        return self.sin_table[index], self.cos_table[index]
@@ -0,0 +1,174 @@
+import numpy as np
+
+# Reference implementation of the NFM demodulation stages used by demodulator_model.py and the testbench.
+# All stage functions are vectorized and work on the last axis of the arrays.
+# Stages keep the floating point type of their input (float64 or float32), complex outputs have
+# the matching complex type (complex128 or complex64).
+
+# This function to generate modulation signal used to modulate carrier frequency later
+# Parameter modulation_freq_list is a list containing frequency components of modulation signal
+# Parameter modulation_amp_list is a list containing amplitudes of frequency components of modulation signal
+# Parameter dtype is the type of the returned signal
+def generate_modulation_signal(time_vector, modulation_freq_list, modulation_amp_list, dtype=np.float64):
+    time_vect_len = len(time_vector)
+    modulation_signal = np.zeros(time_vect_len, dtype=dtype)
+    for freq, amplitude in zip(modulation_freq_list, modulation_amp_list):
+        temp = amplitude * np.sin(time_vector * 2 * np.pi * freq )
+        modulation_signal = modulation_signal + temp.astype(dtype, copy=False)
+
+    return modulation_signal
+
+# Function to generate samples of FM signal using known modulation signal
+# Parameter dtype is the type of the returned signal and phase. The phase of the carrier grows to millions
+# of radians on long signals, which float32 can not hold, so it is calculated in the type of time_vector
+# and only the results are converted to dtype.
+def modulate_fm(time_vector, carrier_freq, carrier_amp, frequency_sensitivity, modulation_signal, dtype=np.float64):
+    sampling_period = 1 / carrier_freq
+    # Calculate integral of modulation signal and phase component caused by it
+    phase_components = np.cumsum(modulation_signal, axis=-1) * frequency_sensitivity * sampling_period
+
+    fm_signal = carrier_amp * np.cos((time_vector * 2 * np.pi * carrier_freq) + phase_components )
+
+    return [fm_signal.astype(dtype, copy=False), phase_components.astype(dtype, copy=False)]
+
+# This function to linear scale of the output signal at FM demodulator to the modulation signal
+# The vect to be scaled to reference vector ref_vect
+def scale_signal(ref_vect, vect, invert = False):
+    if (True == invert):
+        vect = -1 * vect
+    minval = min(ref_vect)
+    maxval = max(ref_vect)
+    aver = np.average([max(vect), min(vect)])
+    vect_centered = vect - aver
+    scale_factor = (maxval - minval) / (max(vect_centered) - min(vect_centered))
+    vect_scaled = vect_centered * scale_factor
+    offset = np.average([minval, maxval])
+    vect_output = vect_scaled + offset
+
+    return (vect_output)
+
+# Square wave local oscillator with period of local_osc_period samples: sin and cos bases of one period
+def local_oscillator_bases(local_osc_period):
+    local_osc_quaterperiod = int(local_osc_period / 4)
+    sin_base = np.concatenate((np.ones(2 * local_osc_quaterperiod), -1 * np.ones(2 * local_osc_quaterperiod)))
+    cos_base = np.concatenate((np.ones(local_osc_quaterperiod), -1 * np.ones(2 * local_osc_quaterperiod),
+                               np.ones(local_osc_quaterperiod)))
+    return sin_base, cos_base
+
+# Create IQ components using multiplication by square wave local oscillator,
+# the oscillator period is tiled over the whole input
+def adc_iq_simple(receiver_sampling_freq, sampling_freq, samples):
+    samples = np.asarray(samples)
+    samples = samples.astype(np.result_type(samples, np.float32), copy=False)
+    samples_len = samples.shape[-1]
+    local_osc_period = int(sampling_freq / receiver_sampling_freq)
+    sin_base, cos_base = local_oscillator_bases(local_osc_period)
+    periods_cnt = -(-samples_len // local_osc_period)
+    i_vect = samples * np.tile(sin_base.astype(samples.dtype), periods_cnt)[:samples_len]
+    q_vect = samples * np.tile(cos_base.astype(samples.dtype), periods_cnt)[:samples_len]
+    iq_vect = np.empty(i_vect.shape, dtype=np.result_type(i_vect, np.complex64))
+    iq_vect.real = i_vect
+    iq_vect.imag = q_vect
+
+    return [iq_vect, i_vect, q_vect]
+
+# Apply LPF IIR filters to the IQ samples.
+# Filters are SosFilter objects (see sos_filter.py), their state is kept between calls.
+# Samples are converted to the type of the filters.
+def apply_lpf_iir(i_samples, q_samples, i_filter, q_filter):
+    i_samples_out = i_filter.process_block(i_samples)
+    q_samples_out = q_filter.process_block(q_samples)
+    iq_vect = np.empty(i_samples_out.shape, dtype=np.result_type(i_samples_out, np.complex64))
+    iq_vect.real = i_samples_out
+    iq_vect.imag = q_samples_out
+
+    return [iq_vect, i_samples_out, q_samples_out]
+
+# Length of the blocks of lpf_iir_blocked
+LPF_BLOCK_SIZE = 64
+
+# Reference LPF: difference equation of every section in direct form I, sample by sample loop.
+# It does not use SosFilter and is slow, it serves for equivalence checks of the vectorized filters.
+# Sections are [b0, b1, b2, a0, a1, a2] (see sos_filter.py), filter starts from zero state.
+# Samples go along the last axis and are converted to dtype.
+def lpf_iir_direct(sos, samples, dtype=np.float64):
+    sos = np.atleast_2d(np.asarray(sos, dtype=float))
+    sos = (sos / sos[:, 3:4]).astype(dtype)
+    samples = np.asarray(samples, dtype=dtype)
+    for b0, b1, b2, _, a1, a2 in sos:
+        output = np.empty_like(samples)
+        x1 = x2 = y1 = y2 = np.zeros(samples.shape[:-1], dtype=dtype)
+        for idx in range(samples.shape[-1]):
+            x0 = samples[..., idx]
+            y0 = b0 * x0 + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            output[..., idx] = y0
+            x2, x1, y2, y1 = x1, x0, y1, y0
+        samples = output
+
+    return samples
+
+# Vectorized LPF with the same difference equation as lpf_iir_direct, independent of SosFilter.
+# FIR part of every section is applied to the whole array. Output is split into blocks of LPF_BLOCK_SIZE:
+# response of all blocks to their own input is one product with the matrix of the impulse response,
+# then the response to the two last outputs of the previous block is added block by block.
+def lpf_iir_blocked(sos, samples, dtype=np.float64):
+    sos = np.atleast_2d(np.asarray(sos, dtype=float))
+    sos = sos / sos[:, 3:4]
+    samples = np.asarray(samples, dtype=dtype)
+    samples_cnt = samples.shape[-1]
+    lead_shape = samples.shape[:-1]
+    block_size = min(LPF_BLOCK_SIZE, max(samples_cnt, 1))
+    blocks_cnt = -(-samples_cnt // block_size)
+    for b0, b1, b2, _, a1, a2 in sos:
+        b0, b1, b2 = (dtype(value) for value in (b0, b1, b2))
+        line = np.concatenate((np.zeros(lead_shape + (2,), dtype=dtype), samples), axis=-1)
+        fir_out = b0 * samples + b1 * line[..., 1:-1] + b2 * line[..., :-2]
+
+        # Impulse response of the recursion y[n] = v[n] - a1 * y[n-1] - a2 * y[n-2] (in float64).
+        # Response to y[-1] = 1 is the impulse response shifted by one sample, response to y[-2] = 1 is -a2 times it.
+        response = np.zeros(block_size + 1)
+        response[0] = 1.0
+        response[1] = -a1
+        for idx in range(2, block_size + 1):
+            response[idx] = -a1 * response[idx - 1] - a2 * response[idx - 2]
+        impulse = response[:block_size].astype(dtype)
+        from_y1 = response[1:].astype(dtype)
+        from_y2 = (-a2 * response[:block_size]).astype(dtype)
+        lag = np.arange(block_size)[:, None] - np.arange(block_size)[None, :]
+        transfer = np.where(lag >= 0, impulse[np.clip(lag, 0, None)], 0).astype(dtype)
+
+        padded = np.zeros(lead_shape + (blocks_cnt * block_size,), dtype=dtype)
+        padded[..., :samples_cnt] = fir_out
+        blocks = padded.reshape(lead_shape + (blocks_cnt, block_size)) @ transfer.T
+        y1 = y2 = np.zeros(lead_shape + (1,), dtype=dtype)
+        for block_idx in range(blocks_cnt):
+            block = blocks[..., block_idx, :]
+            block += y1 * from_y1 + y2 * from_y2
+            y1, y2 = block[..., -1:], block[..., -2:-1]
+        samples = blocks.reshape(lead_shape + (-1,))[..., :samples_cnt]
+
+    return samples
+
+# Apply reference LPF (see lpf_iir_blocked) to the IQ samples, result has the same form as apply_lpf_iir
+def apply_lpf_reference(i_samples, q_samples, sos, dtype=np.float64):
+    i_samples_out = lpf_iir_blocked(sos, i_samples, dtype)
+    q_samples_out = lpf_iir_blocked(sos, q_samples, dtype)
+    iq_vect = np.empty(i_samples_out.shape, dtype=np.result_type(i_samples_out, np.complex64))
+    iq_vect.real = i_samples_out
+    iq_vect.imag = q_samples_out
+
+    return [iq_vect, i_samples_out, q_samples_out]
+
+# Simplified polar frequency discriminator: product of the delayed complex sample with the conjugated
+# current one. Delayed and current samples are the same arrays shifted by offset samples,
+# so the output is offset samples shorter than the input.
+def apply_pfd_simple(i_vect, q_vect, offset):
+    samples_to_process = i_vect.shape[-1] - offset
+    i_delayed = i_vect[..., :samples_to_process]
+    q_delayed = q_vect[..., :samples_to_process]
+    i_current = i_vect[..., offset:]
+    q_current = q_vect[..., offset:]
+    re_vect = (i_delayed * i_current) + (q_delayed * q_current)
+    im_vect = (i_delayed * q_current) - (q_delayed * i_current)
+
+    return ([re_vect, im_vect])
@@ -0,0 +1,256 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from demodulator_nfm import DemodulatorNFM
+from nfm_reference import generate_modulation_signal, modulate_fm, scale_signal
+from quality_metrics import measure_quality
+from result_store import CODE_MODULES, code_version
+
+# Parameters which are the same for all configurations unless overridden
+DEFAULT_CONFIG = {
+    'receiver_sampling_freq': 100.0e3,   # Hz - Frequency of local oscillator
+    'oversampling_ratio': 4,             # Ratio between ADC sampling frequency and local oscillator frequency
+    'carrier_amplitude': 1,              # Amplitude of carrier frequency in FM signal
+    'number_of_samples': 4000,           # Number of samples for simulation
+    'cut_samples_cnt': 150,              # Number of samples at the beginning to skip transient process
+    'decimation_factor': 1,              # Decimation after I/Q LPF
+    'dtype': 'float64',                  # Precision of signal generation and demodulation, float64 or float32
+}
+
+# Parameter sets used in the experiments (see demodulator_testbench.py)
+TESTBENCH_PARAMETER_SETS = [
+    # set #1 (Fig.6 Left)
+    {'carrier_freq': 108.9e3, 'freq_sensitivity': 1000, 'mod_freq_list': [370, 962], 'mod_amp_list': [0.5, 0.5],
+     'discriminator_delay_ratio': 2},
+    # set #2 (Fig.7 Left)
+    {'carrier_freq': 103.2e3, 'freq_sensitivity': 1000, 'mod_freq_list': [1040, 1490], 'mod_amp_list': [0.6, 0.4],
+     'discriminator_delay_ratio': 1},
+    # set #3 (Fig.7 Right)
+    {'carrier_freq': 154.3e3, 'freq_sensitivity': 1000, 'mod_freq_list': [1040, 1490], 'mod_amp_list': [0.6, 0.4],
+     'discriminator_delay_ratio': 14},
+    # set #4 (Fig.6 Right)
+    {'carrier_freq': 104.0e3, 'freq_sensitivity': 1000, 'mod_freq_list': [280, 690], 'mod_amp_list': [0.5, 0.5],
+     'discriminator_delay_ratio': 1},
+    # set #5
+    {'carrier_freq': 145.4e3, 'freq_sensitivity': 1000, 'mod_freq_list': [280, 690], 'mod_amp_list': [0.5, 0.5],
+     'discriminator_delay_ratio': 20},
+    # set #6
+    {'carrier_freq': 79.4e3, 'freq_sensitivity': 1000, 'mod_freq_list': [880, 1290], 'mod_amp_list': [0.7, 0.3],
+     'discriminator_delay_ratio': 5},
+]
+
+# Extra lag allowed in addition to the discriminator delay when output is aligned to the modulation signal
+LAG_SEARCH_MARGIN = 64
+
+# Shared read-only inputs of the worker process, memory-mapped from files written by run_sweep
+_shared_inputs = {}
+
+
+# This function builds list of configurations as cartesian product of parameter values.
+# Every keyword argument is a list of values of one parameter.
+def expand_grid(**axes):
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[name] for name in names))]
+
+
+# Configuration completed with default parameters
+def complete_config(config):
+    full_config = dict(DEFAULT_CONFIG)
+    full_config.update(config)
+    return full_config
+
+
+# Hash of the array contents, used to key results which depend on shared inputs
+def array_digest(array):
+    array = np.ascontiguousarray(array)
+    return hashlib.sha256(str((array.dtype.str, array.shape)).encode() + array.tobytes()).hexdigest()
+
+
+# Version of the code which produces results of the sweep (see result_store.code_version)
+def sweep_code_version():
+    return code_version(CODE_MODULES + ('parameter_sweep',))
+
+
+# Key of configuration in the results cache: hash of all parameters, of the shared inputs and of the code version,
+# so results of the previous code are not taken from the cache
+def config_key(config, shared_digest='', version=None):
+    version = sweep_code_version() if version is None else version
+    text = json.dumps(complete_config(config), sort_keys=True) + shared_digest + version
+    return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+
+# This function runs demodulator for one configuration.
+# Input signal and modulation signal are taken from shared inputs ('signal', 'modulation_signal')
+# if they are given, otherwise they are generated from the configuration.
+# Returns output arrays and dictionary of metrics.
+def run_config(config, shared_inputs=None):
+    config = complete_config(config)
+    shared_inputs = {} if shared_inputs is None else shared_inputs
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+
+    if 'signal' in shared_inputs:
+        signal = shared_inputs['signal']
+        modulation_signal = shared_inputs['modulation_signal']
+    else:
+        t_observation = config['number_of_samples'] / sampling_freq
+        time_vector = np.linspace(0, t_observation, config['number_of_samples'] + 1)
+        modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'],
+                                                       config['dtype'])
+        [signal, _] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                                  config['freq_sensitivity'], modulation_signal, config['dtype'])
+
+    demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=False, dtype=config['dtype'])
+    discriminator_delay = demodulator.init(config['discriminator_delay_ratio'],
+                                           config['carrier_freq'],
+                                           sum(config['mod_amp_list']),
+                                           config['freq_sensitivity'],
+                                           config['decimation_factor'])
+    out_signal = demodulator.demodulate_block(signal)
+
+    # Reference is taken at the output rate. Metrics are measured after the output is aligned to it,
+    # the lag is searched up to the discriminator delay plus margin for group delay of the filters.
+    reference = np.asarray(modulation_signal)[::config['decimation_factor']][:len(out_signal)]
+    cut_samples_cnt = config['cut_samples_cnt'] // config['decimation_factor']
+    invert = not (config['discriminator_delay_ratio'] % 2)
+    scaled_output = scale_signal(reference[cut_samples_cnt:], out_signal[cut_samples_cnt:], invert)
+    quality = measure_quality(out_signal, reference, sampling_freq / config['decimation_factor'],
+                              config['mod_freq_list'], max_lag=discriminator_delay + LAG_SEARCH_MARGIN,
+                              cut_samples_cnt=cut_samples_cnt)
+    metrics = {'discriminator_delay': int(discriminator_delay)}
+    metrics.update({name: value.item() for name, value in quality.items()})
+    outputs = {'out_signal': out_signal, 'scaled_output': scaled_output}
+
+    return outputs, metrics
+
+
+def _init_worker(shared_files):
+    for name, file_name in shared_files.items():
+        _shared_inputs[name] = np.load(file_name, mmap_mode='r')
+
+
+# Writes the file by save(file object) to a temporary file in the same directory and renames it,
+# so a killed process never leaves a partial file under the final name (it would be taken as cached)
+def _write_atomically(file_name, save):
+    temp_name = f'{file_name}.{os.getpid()}.tmp'
+    try:
+        with open(temp_name, 'wb') as temp_file:
+            save(temp_file)
+        os.replace(temp_name, file_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+# Worker task: runs configuration and stores result in the cache
+def _run_and_store(config, cache_file):
+    outputs, metrics = run_config(config, _shared_inputs)
+    _write_atomically(cache_file, lambda cache: np.savez_compressed(cache, config=json.dumps(config),
+                                                                    metrics=json.dumps(metrics), **outputs))
+    return metrics
+
+
+# Loads outputs and metrics of one configuration from the cache
+def load_result(cache_dir, key):
+    with np.load(os.path.join(cache_dir, key + '.npz')) as data:
+        metrics = json.loads(str(data['metrics']))
+        outputs = {name: data[name] for name in data.files if name not in ('config', 'metrics')}
+    return outputs, metrics
+
+
+# This function runs all configurations on the process pool and returns table of results:
+# one row (dictionary) per configuration with its parameters, cache key and metrics.
+# Results are stored in cache_dir, configurations found in the cache are not run again.
+# Shared inputs (dictionary of arrays) are written to the cache once and memory-mapped by every worker.
+def run_sweep(configs, cache_dir, workers=None, shared_inputs=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    shared_inputs = {} if shared_inputs is None else shared_inputs
+    shared_digest = ''.join(name + array_digest(shared_inputs[name]) for name in sorted(shared_inputs))
+    shared_files = {}
+    for name, array in shared_inputs.items():
+        file_name = os.path.join(cache_dir, f'shared_{name}_{array_digest(array)[:24]}.npy')
+        if not os.path.exists(file_name):
+            _write_atomically(file_name, lambda shared_file: np.save(shared_file, array))
+        shared_files[name] = file_name
+
+    version = sweep_code_version()
+    keys = [config_key(config, shared_digest, version) for config in configs]
+    rows = [None] * len(configs)
+    pending = {}
+    for idx, (config, key) in enumerate(zip(configs, keys)):
+        if os.path.exists(os.path.join(cache_dir, key + '.npz')):
+            _, metrics = load_result(cache_dir, key)
+            rows[idx] = dict(complete_config(config), key=key, cached=True, **metrics)
+        else:
+            pending.setdefault(key, []).append(idx)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shared_files,)) as executor:
+            futures = {key: executor.submit(_run_and_store, configs[indexes[0]], os.path.join(cache_dir, key + '.npz'))
+                       for key, indexes in pending.items()}
+            for key, future in futures.items():
+                metrics = future.result()
+                for idx in pending[key]:
+                    rows[idx] = dict(complete_config(configs[idx]), key=key, cached=False, **metrics)
+
+    return rows
+
+
+# Writes table of results to CSV file, lists are written as space separated values
+def write_table_csv(rows, file_name):
+    columns = []
+    for row in rows:
+        columns += [name for name in row if name not in columns]
+    with open(file_name, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({name: ' '.join(map(str, value)) if isinstance(value, list) else value
+                             for name, value in row.items()})
+
+
+def print_table(rows, columns=('carrier_freq', 'discriminator_delay_ratio', 'oversampling_ratio',
+                               'discriminator_delay', 'correlation', 'sinad_db', 'thd_db', 'rms_error', 'cached')):
+    widths = [max(len(name), 12) for name in columns]
+    print(' | '.join(f'{name:>{width}}' for name, width in zip(columns, widths)))
+    for row in rows:
+        print(' | '.join(f'{row[name]:>{width}.6g}' if isinstance(row.get(name), float)
+                         else f'{str(row.get(name, "")):>{width}}' for name, width in zip(columns, widths)))
+
+
+# Parses "name=value1,value2,..." into name and list of values.
+# Values separated by ":" are lists themselves, e.g. mod_freq_list=370:962,1040:1490
+def parse_axis(text):
+    name, values = text.split('=', 1)
+    parsed = []
+    for value in values.split(','):
+        items = [json.loads(item) for item in value.split(':')]
+        parsed.append(items if ':' in value else items[0])
+    return name, parsed
+
+
+if __name__ == '__main__':
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Run NFM demodulator for many parameter sets in parallel')
+    parser.add_argument('--sets', type=int, nargs='*',
+                        help='Indexes (from 1) of testbench parameter sets to run, all by default')
+    parser.add_argument('--grid', nargs='*', default=[],
+                        help='Parameter axes as name=value1,value2. Grid is applied to every selected set')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--cache-dir', default=os.path.join(script_dir, 'results', 'sweep_cache'))
+    parser.add_argument('--csv', default=None, help='Write table of results to this file')
+    args = parser.parse_args()
+
+    sets = TESTBENCH_PARAMETER_SETS if not args.sets else [TESTBENCH_PARAMETER_SETS[idx - 1] for idx in args.sets]
+    grid = expand_grid(**dict(parse_axis(axis) for axis in args.grid))
+    configs = [dict(base, **overrides) for base in sets for overrides in grid]
+
+    rows = run_sweep(configs, args.cache_dir, args.workers)
+    print_table(rows)
+    if args.csv:
+        write_table_csv(rows, args.csv)
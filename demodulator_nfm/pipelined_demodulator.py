@@ -0,0 +1,168 @@
+import queue
+import threading
+import time
+import numpy as np
+
+# Number of input samples processed by every stage at once
+DEFAULT_CHUNK_SIZE = 1 << 16
+# Number of chunks waiting between two stages
+DEFAULT_QUEUE_SIZE = 4
+
+# Marker of the end of the stream passed through the queues
+_END = None
+
+
+# Pipelined execution of DemodulatorNFM (or DemodulatorBankNFM, DemodulatorNFMFixed) on several threads.
+# Signal is split into chunks, every stage works on its own thread and passes chunks to the next stage
+# through bounded queues by reference:
+#   mix            - multiplication with local oscillator into preallocated I and Q buffers
+#   i_path, q_path - LPF (and decimation) of I and Q, in parallel
+#   discriminator  - polar discriminator
+#   output_lpf     - LPF of discriminator output
+# I and Q buffers of the mixer are a ring of queue_size + 2 buffers reused in rotation, a buffer returns
+# to the mixer when the LPF is done with it. Buffers have the type of the converted input (float or the integer
+# type of the fixed-point data format), the mixer keeps this type. Stage kernels are NumPy operations which release GIL
+# on large arrays, so the stages overlap on several cores (the longest stage, usually one of the LPFs,
+# limits the throughput, see stage_time). Every stage calls the same methods of the demodulator
+# in the same order as demodulate_block, so the output is exactly the same as of demodulate_block
+# called chunk by chunk. State of the demodulator is kept, calls may be mixed with demodulate_block.
+class PipelinedDemodulator():
+
+    def __init__(self, demodulator, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        self.demodulator = demodulator
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.buffers_cnt = queue_size + 2
+        self.__buffers_key = None
+        # Time spent by every stage in the last call of demodulate on processing (without waiting), seconds
+        self.stage_time = {}
+
+    # Ring of mixer output buffers, allocated for the shape of channels and the type of the input
+    # and reused between calls
+    def __allocate_buffers(self, channels_shape, dtype):
+        buffers_shape = channels_shape + (self.chunk_size,)
+        if (buffers_shape, dtype) != self.__buffers_key:
+            self.__buffers_key = (buffers_shape, dtype)
+            self.__i_buffers = [np.empty(buffers_shape, dtype=dtype) for _ in range(self.buffers_cnt)]
+            self.__q_buffers = [np.empty(buffers_shape, dtype=dtype) for _ in range(self.buffers_cnt)]
+
+    # Demodulate samples (along the last axis), returns output of the demodulator
+    def demodulate(self, samples):
+        samples = self.demodulator._convert_input(samples)
+        if hasattr(self.demodulator, 'channels_cnt'):
+            samples = np.broadcast_to(samples, (self.demodulator.channels_cnt, samples.shape[-1]))
+        samples_cnt = samples.shape[-1]
+        if samples_cnt == 0:
+            return self.demodulator.demodulate_block(samples)
+        self.__allocate_buffers(samples.shape[:-1], samples.dtype)
+
+        demodulator = self.demodulator
+        i_free = queue.Queue()
+        q_free = queue.Queue()
+        for idx in range(self.buffers_cnt):
+            i_free.put(idx)
+            q_free.put(idx)
+        i_mixed, q_mixed = queue.Queue(self.queue_size), queue.Queue(self.queue_size)
+        i_filtered, q_filtered = queue.Queue(self.queue_size), queue.Queue(self.queue_size)
+        discriminated = queue.Queue(self.queue_size)
+        outputs = []
+        errors = []
+        self.stage_time = dict.fromkeys(('mix', 'i_path', 'q_path', 'discriminator', 'output_lpf'), 0.0)
+
+        # Calls stage kernel and adds its time to the stage time
+        def timed(name, kernel, *args, **kwargs):
+            start_time = time.perf_counter()
+            result = kernel(*args, **kwargs)
+            self.stage_time[name] += time.perf_counter() - start_time
+            return result
+
+        def mix():
+            for chunk_start in range(0, samples_cnt, self.chunk_size):
+                if errors:
+                    break
+                chunk = samples[..., chunk_start:chunk_start + self.chunk_size]
+                chunk_len = chunk.shape[-1]
+                i_idx, q_idx = i_free.get(), q_free.get()
+                out = (self.__i_buffers[i_idx][..., :chunk_len], self.__q_buffers[q_idx][..., :chunk_len])
+                i_samples, q_samples = timed('mix', demodulator._mix_block, chunk, out=out)
+                i_mixed.put((i_idx, i_samples))
+                q_mixed.put((q_idx, q_samples))
+
+        def filter_path(name, mixed, filtered, free, iq_filter, decimator):
+            def run():
+                while True:
+                    item = mixed.get()
+                    if item is _END:
+                        break
+                    buffer_idx, samples_chunk = item
+                    output = timed(name, iq_filter.process_block, samples_chunk)
+                    free.put(buffer_idx)
+                    if decimator is not None:
+                        output = timed(name, decimator.process_block, output)
+                    filtered.put(output)
+            return run
+
+        def discriminate():
+            while True:
+                i_samples, q_samples = i_filtered.get(), q_filtered.get()
+                if i_samples is _END or q_samples is _END:
+                    # The other path is drained by run_stage
+                    for stage_queue, item in ((i_filtered, i_samples), (q_filtered, q_samples)):
+                        if item is not _END:
+                            drain(stage_queue)
+                    break
+                discriminated.put(timed('discriminator', demodulator._discriminate_block, i_samples, q_samples))
+
+        def output_lpf():
+            while True:
+                polar_det_out = discriminated.get()
+                if polar_det_out is _END:
+                    break
+                outputs.append(timed('output_lpf', demodulator.output_filter.process_block, polar_det_out))
+
+        # Stage function, queues it reads until end of stream (with queues of free buffers to return them to),
+        # queues it writes
+        stages = {
+            'mix': (mix, [], [i_mixed, q_mixed]),
+            'i_path': (filter_path('i_path', i_mixed, i_filtered, i_free, demodulator.i_filter,
+                                     demodulator.i_decimator),
+                       [(i_mixed, i_free)], [i_filtered]),
+            'q_path': (filter_path('q_path', q_mixed, q_filtered, q_free, demodulator.q_filter,
+                                     demodulator.q_decimator),
+                       [(q_mixed, q_free)], [q_filtered]),
+            'discriminator': (discriminate, [(i_filtered, None), (q_filtered, None)], [discriminated]),
+            'output_lpf': (output_lpf, [(discriminated, None)], []),
+        }
+
+        # Reads queue until end of stream, mixer buffers are returned to the free queue
+        def drain(stage_queue, free=None):
+            while True:
+                item = stage_queue.get()
+                if item is _END:
+                    return
+                if free is not None:
+                    free.put(item[0])
+
+        # On error the stage stores exception, drains its input queues, so the previous stages are not blocked,
+        # and passes end of stream to the next stages. The mixer stops at the next chunk.
+        def run_stage(stage, inputs, outputs_queues):
+            try:
+                stage()
+            except BaseException as exc:
+                errors.append(exc)
+                for stage_queue, free in inputs:
+                    drain(stage_queue, free)
+            finally:
+                for stage_queue in outputs_queues:
+                    stage_queue.put(_END)
+
+        threads = [threading.Thread(target=run_stage, args=stage, name=f'demodulator-{name}', daemon=True)
+                   for name, stage in stages.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        return np.concatenate(outputs, axis=-1)
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Number of FIR taps per polyphase branch used by default
+DEFAULT_TAPS_PER_PHASE = 8
+# Cutoff of default anti-aliasing filter relative to the Nyquist frequency after decimation
+DEFAULT_CUTOFF_RATIO = 0.8
+
+# This function designs linear phase FIR LPF using windowed sinc (Hamming window).
+# Cutoff frequency is given relative to the sampling frequency (0 .. 0.5), gain at DC is 1.
+def lowpass_fir_taps(taps_cnt, relative_cutoff):
+    n = np.arange(taps_cnt) - (taps_cnt - 1) / 2
+    taps = 2 * relative_cutoff * np.sinc(2 * relative_cutoff * n) * np.hamming(taps_cnt)
+    return taps / taps.sum()
+
+# Decimator by integer factor with FIR anti-aliasing filter in polyphase form.
+# Input samples are split into frames of decimation_factor samples, each column of the frames
+# is one polyphase branch, and only the samples kept after decimation are calculated.
+# History of input samples and position of the next kept sample are stored between calls,
+# so the signal may be processed by blocks of any length. Samples go along the last axis,
+# leading axes are independent channels. Parameter dtype is the floating point type of taps, history and output.
+class PolyphaseDecimator():
+
+    def __init__(self, decimation_factor, taps=None, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.decimation_factor = decimation_factor
+        if taps is None:
+            taps = lowpass_fir_taps(DEFAULT_TAPS_PER_PHASE * decimation_factor,
+                                    DEFAULT_CUTOFF_RATIO * 0.5 / decimation_factor)
+        # Pad taps with zeros to the multiple of decimation factor
+        branch_len = -(-len(taps) // decimation_factor)
+        padded_taps = np.zeros(branch_len * decimation_factor, dtype=self.dtype)
+        padded_taps[:len(taps)] = taps
+        self.taps = np.asarray(taps, dtype=self.dtype)
+        self.branch_len = branch_len
+        # Row j holds taps of all branches applied to the frame j frames back from the newest one,
+        # reversed to match the order of samples in the frame.
+        self.branch_taps = padded_taps[::-1].reshape(branch_len, decimation_factor)
+        self.reset()
+
+    def reset(self, channels_shape=()):
+        channels_shape = (channels_shape,) if np.isscalar(channels_shape) else tuple(channels_shape)
+        self.history = np.zeros(channels_shape + (self.branch_len * self.decimation_factor - 1,), dtype=self.dtype)
+        # Index of the next kept sample in the next block
+        self.phase = 0
+
+    def process_block(self, samples):
+        samples = np.asarray(samples, dtype=self.dtype)
+        samples_cnt = samples.shape[-1]
+        lead_shape = samples.shape[:-1]
+        line = np.concatenate((np.broadcast_to(self.history, lead_shape + self.history.shape[-1:]), samples),
+                              axis=-1)
+        self.history = line[..., samples_cnt:].copy()
+
+        outputs_cnt = max(0, -(-(samples_cnt - self.phase) // self.decimation_factor))
+        if outputs_cnt == 0:
+            self.phase -= samples_cnt
+            return np.empty(lead_shape + (0,), dtype=self.dtype)
+
+        # Output m uses frames m .. m + branch_len - 1 counted from the position of the current phase
+        frames_cnt = outputs_cnt + self.branch_len - 1
+        frames = line[..., self.phase:self.phase + frames_cnt * self.decimation_factor]
+        frames = frames.reshape(lead_shape + (frames_cnt, self.decimation_factor))
+        output = frames[..., :outputs_cnt, :] @ self.branch_taps[0]
+        for frame_shift in range(1, self.branch_len):
+            output += frames[..., frame_shift:frame_shift + outputs_cnt, :] @ self.branch_taps[frame_shift]
+
+        self.phase += outputs_cnt * self.decimation_factor - samples_cnt
+        return output
@@ -0,0 +1,79 @@
+import argparse
+import json
+import numpy as np
+from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config, run_config
+
+# Precision every other one is compared to
+REFERENCE_DTYPE = 'float64'
+DTYPES = ('float32',)
+COLUMNS = ('set', 'dtype', 'output_dtype', 'max_abs_error', 'relative_error_db', 'sinad_db', 'sinad_loss_db',
+           'correlation', 'bytes_per_sample')
+
+
+# This function runs the parameter set in the reference precision and in dtype, the whole pipeline
+# (signal generation and demodulation) runs in the given precision, see parameter_sweep.run_config.
+# Returns dictionary with the difference of outputs after the transient process:
+#   max_abs_error     - largest absolute difference from the float64 output
+#   relative_error_db - RMS of the difference relative to RMS of the float64 output
+#   sinad_db          - SINAD of the output against the modulation signal, sinad_loss_db is its decrease
+#   output_dtype      - type of the demodulator output, must be dtype (no upcast inside the pipeline)
+def compare_precision(parameter_set, dtype, set_idx=None):
+    config = complete_config(parameter_set)
+    reference_outputs, reference_metrics = run_config(dict(config, dtype=REFERENCE_DTYPE))
+    outputs, metrics = run_config(dict(config, dtype=dtype))
+    cut_samples_cnt = config['cut_samples_cnt'] // config['decimation_factor']
+    reference = reference_outputs['out_signal'][cut_samples_cnt:]
+    output = outputs['out_signal']
+    error = output[cut_samples_cnt:].astype(REFERENCE_DTYPE) - reference
+    rms_reference = np.sqrt(np.mean(reference ** 2))
+    rms_error = np.sqrt(np.mean(error ** 2))
+
+    return {
+        'set': set_idx,
+        'dtype': dtype,
+        'output_dtype': str(output.dtype),
+        'max_abs_error': float(np.max(np.abs(error))),
+        'relative_error_db': float(20 * np.log10(max(rms_error, np.finfo(float).tiny) / rms_reference)),
+        'sinad_db': metrics['sinad_db'],
+        'reference_sinad_db': reference_metrics['sinad_db'],
+        'sinad_loss_db': reference_metrics['sinad_db'] - metrics['sinad_db'],
+        'correlation': metrics['correlation'],
+        'bytes_per_sample': np.dtype(dtype).itemsize,
+    }
+
+
+# Report for all testbench parameter sets (or the given indexes of them, from 1) and all dtypes
+def precision_report(dtypes=DTYPES, sets=None, number_of_samples=None):
+    set_indexes = range(1, len(TESTBENCH_PARAMETER_SETS) + 1) if not sets else sets
+    rows = []
+    for set_idx in set_indexes:
+        parameter_set = dict(TESTBENCH_PARAMETER_SETS[set_idx - 1])
+        if number_of_samples is not None:
+            parameter_set['number_of_samples'] = number_of_samples
+        for dtype in dtypes:
+            rows.append(compare_precision(parameter_set, dtype, set_idx))
+    return rows
+
+
+def print_report(rows, columns=COLUMNS):
+    widths = [max(len(name), 12) for name in columns]
+    print(' | '.join(f'{name:>{width}}' for name, width in zip(columns, widths)))
+    for row in rows:
+        print(' | '.join(f'{row[name]:>{width}.4g}' if isinstance(row[name], float)
+                         else f'{str(row[name]):>{width}}' for name, width in zip(columns, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of reduced precision demodulation against float64 '
+                                                 'on the testbench parameter sets')
+    parser.add_argument('--dtypes', nargs='*', default=list(DTYPES), help='Precisions to compare with float64')
+    parser.add_argument('--sets', type=int, nargs='*', help='Indexes (from 1) of testbench parameter sets')
+    parser.add_argument('--samples', type=int, default=None, help='Number of samples, default of the sets if omitted')
+    parser.add_argument('--output', default=None, help='Write report to this JSON file')
+    args = parser.parse_args()
+
+    report = precision_report(args.dtypes, args.sets, args.samples)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
@@ -0,0 +1,117 @@
+import numpy as np
+
+# Number of harmonics of every modulation tone taken into account by THD
+DEFAULT_HARMONICS_CNT = 5
+# Half-width (in FFT bins) of the band around every tone which is counted as the tone power
+TONE_HALF_WIDTH_BINS = 3
+
+# All functions below work on the last axis of the arrays, leading axes (e.g. channels of
+# DemodulatorBankNFM or noise realizations) are processed at once. Reference may be 1-D array
+# shared by all rows of the demodulated output.
+
+
+# This function finds delay of the output relative to the reference in range 0..max_lag samples.
+# Parameter max_lag may be given per row of the output.
+# Lag with maximum absolute cross-correlation is taken, so the inverted output is aligned as well.
+# Returns lags and both signals cut to the common length (len - max(max_lag)).
+def align_to_reference(output, reference, max_lag):
+    output = np.asarray(output, dtype=float)
+    reference = np.asarray(reference, dtype=float)
+    max_lag = np.asarray(max_lag)
+    samples_cnt = output.shape[-1]
+    aligned_len = samples_cnt - int(max_lag.max())
+    if aligned_len <= 0:
+        raise ValueError(f'Signal of {samples_cnt} samples is too short for lag search up to {max_lag}')
+
+    # Cross-correlation via FFT: xcorr[lag] = sum(output[n + lag] * reference[n])
+    fft_len = 1 << int(np.ceil(np.log2(2 * samples_cnt)))
+    output_centered = output - output.mean(axis=-1, keepdims=True)
+    reference_centered = reference[..., :aligned_len] - reference[..., :aligned_len].mean(axis=-1, keepdims=True)
+    xcorr = np.fft.irfft(np.fft.rfft(output_centered, fft_len) * np.conj(np.fft.rfft(reference_centered, fft_len)),
+                         fft_len)[..., :int(max_lag.max()) + 1]
+    out_of_range = np.arange(xcorr.shape[-1]) > max_lag[..., None]
+    lags = np.argmax(np.where(out_of_range, 0, np.abs(xcorr)), axis=-1)
+
+    idx = lags[..., None] + np.arange(aligned_len)
+    aligned_output = np.take_along_axis(output, np.broadcast_to(idx, output.shape[:-1] + (aligned_len,)), axis=-1)
+    aligned_reference = np.broadcast_to(reference[..., :aligned_len], aligned_output.shape)
+
+    return lags, aligned_output, aligned_reference
+
+
+# Least squares fit of the output to the reference: reference ~ gain * output + offset.
+# Returns fitted output (in units of the reference), gain and offset.
+def fit_to_reference(output, reference):
+    output_centered = output - output.mean(axis=-1, keepdims=True)
+    reference_mean = reference.mean(axis=-1, keepdims=True)
+    gain = np.sum(output_centered * (reference - reference_mean), axis=-1, keepdims=True) / \
+        np.maximum(np.sum(output_centered ** 2, axis=-1, keepdims=True), np.finfo(float).tiny)
+    fitted = gain * output_centered + reference_mean
+    return fitted, gain[..., 0], reference_mean[..., 0]
+
+
+# Pearson correlation between aligned output and reference. Negative value means inverted output.
+def correlation(output, reference):
+    output_centered = output - output.mean(axis=-1, keepdims=True)
+    reference_centered = reference - reference.mean(axis=-1, keepdims=True)
+    norm = np.sqrt(np.sum(output_centered ** 2, axis=-1) * np.sum(reference_centered ** 2, axis=-1))
+    return np.sum(output_centered * reference_centered, axis=-1) / np.maximum(norm, np.finfo(float).tiny)
+
+
+# Signal to noise and distortion ratio in dB: power of the part of output which follows the reference
+# over the power of the rest of output (noise, distortion and interference).
+def sinad_db(output, reference):
+    # Share of the output power explained by the reference is the squared correlation
+    explained = correlation(output, reference) ** 2
+    return 10 * np.log10(np.maximum(explained, np.finfo(float).tiny) /
+                         np.maximum(1 - explained, np.finfo(float).tiny))
+
+
+# RMS error between reference and the output fitted to it (gain, offset and sign are fitted)
+def rms_error(output, reference):
+    fitted, _, _ = fit_to_reference(output, reference)
+    return np.sqrt(np.mean((reference - fitted) ** 2, axis=-1))
+
+
+# Total harmonic distortion in dB: power of harmonics 2..harmonics_cnt of all modulation tones
+# over power of the tones themselves. Power is measured in the spectrum with Hann window.
+def thd_db(output, sampling_freq, tone_freqs, harmonics_cnt=DEFAULT_HARMONICS_CNT):
+    output = np.asarray(output, dtype=float)
+    samples_cnt = output.shape[-1]
+    window = np.hanning(samples_cnt)
+    spectrum = np.abs(np.fft.rfft((output - output.mean(axis=-1, keepdims=True)) * window, axis=-1)) ** 2
+    bins_cnt = spectrum.shape[-1]
+    bin_freq = sampling_freq / samples_cnt
+
+    def band_mask(freqs):
+        mask = np.zeros(bins_cnt, dtype=bool)
+        for freq in freqs:
+            center = int(round(freq / bin_freq))
+            mask[max(0, center - TONE_HALF_WIDTH_BINS):min(bins_cnt, center + TONE_HALF_WIDTH_BINS + 1)] = True
+        return mask
+
+    tones_mask = band_mask(tone_freqs)
+    harmonic_freqs = [k * freq for freq in tone_freqs for k in range(2, harmonics_cnt + 1)
+                      if k * freq < sampling_freq / 2]
+    harmonics_mask = band_mask(harmonic_freqs) & ~tones_mask
+    tones_power = spectrum[..., tones_mask].sum(axis=-1)
+    harmonics_power = spectrum[..., harmonics_mask].sum(axis=-1)
+    return 10 * np.log10(np.maximum(harmonics_power, np.finfo(float).tiny) /
+                         np.maximum(tones_power, np.finfo(float).tiny))
+
+
+# This function calculates all metrics of demodulated output against known modulation signal.
+# Both signals must be at the same sampling rate, samples before cut_samples_cnt are skipped
+# (transient process of filters). Output is searched for lag up to max_lag samples (scalar or per row).
+# Returns dictionary of arrays (scalars for 1-D output).
+def measure_quality(output, modulation_signal, sampling_freq, tone_freqs, max_lag, cut_samples_cnt=0):
+    output = np.asarray(output, dtype=float)[..., cut_samples_cnt:]
+    reference = np.asarray(modulation_signal, dtype=float)[..., cut_samples_cnt:cut_samples_cnt + output.shape[-1]]
+    lags, aligned_output, aligned_reference = align_to_reference(output, reference, max_lag)
+    return {
+        'lag': lags,
+        'correlation': correlation(aligned_output, aligned_reference),
+        'sinad_db': sinad_db(aligned_output, aligned_reference),
+        'thd_db': thd_db(aligned_output, sampling_freq, tone_freqs),
+        'rms_error': rms_error(aligned_output, aligned_reference),
+    }
@@ -0,0 +1,187 @@
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+# Total size of arrays kept in the store by default, least recently used results are evicted above it
+DEFAULT_MAX_BYTES = 1 << 30
+# Modules whose source determines the stored results: the demodulator, the signal generation and metrics
+# and the testbench which runs them, their contents are part of the key
+CODE_MODULES = ('demodulator_nfm', 'sos_filter', 'polyphase_decimator', 'nco', 'nfm_reference', 'quality_metrics',
+                'instrumentation', 'demodulator_testbench')
+INDEX_FILE = 'index.json'
+OBJECTS_DIR = 'objects'
+
+
+# Version of the code: hash of the source files of the modules
+def code_version(modules=CODE_MODULES):
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(importlib.util.find_spec(module).origin, 'rb') as source_file:
+            digest.update(module.encode() + b'\0' + source_file.read())
+    return digest.hexdigest()[:16]
+
+
+# Key of the result: hash of the parameters (any JSON serializable object) and of the code version
+def result_key(params, version=None):
+    version = code_version() if version is None else version
+    text = json.dumps(params, sort_keys=True) + version
+    return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+
+# Result loaded from the store. Arrays are read only when accessed, every array is memory-mapped
+# from its own .npy file, so a part of a long array may be read without loading the whole file.
+# Object holds only file names, it may be passed to other processes.
+class StoredResult():
+
+    def __init__(self, directory, entry):
+        self.directory = directory
+        self.key = entry['key']
+        self.params = entry['params']
+        self.metadata = entry['metadata']
+        self.array_names = list(entry['arrays'])
+
+    def __getitem__(self, name):
+        if name not in self.array_names:
+            raise KeyError(name)
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+    def __contains__(self, name):
+        return name in self.array_names
+
+    def keys(self):
+        return list(self.array_names)
+
+    # All arrays loaded into memory
+    def load(self):
+        return {name: np.array(self[name]) for name in self.array_names}
+
+
+# Content-addressed store of results of runs. Every result is a set of named arrays plus metadata,
+# stored under the key calculated from the run parameters and the code version (see result_key).
+# Layout of the root directory:
+#   index.json                  - parameters, metadata, array names, size and last access time of every result
+#   objects/<k[:2]>/<key>/*.npy - one file per array
+# A result is written to a temporary directory and renamed, so it appears in the store completely or not at all.
+# Size of the store is kept under max_bytes (None for no limit) by eviction of least recently used results.
+# Access times updated by get are kept in memory and written with the index on put, remove, evict and flush
+# (or at the end of the with block), so reads do not rewrite the index.
+# Store may be used by one process at a time.
+class ResultStore():
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, OBJECTS_DIR), exist_ok=True)
+        index_file = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as index:
+                self.__entries = json.load(index)
+        else:
+            self.__entries = {}
+        self.__index_changed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def __write_index(self):
+        index_file = os.path.join(self.root, INDEX_FILE)
+        with open(index_file + '.tmp', 'w') as index:
+            json.dump(self.__entries, index, indent=1)
+        os.replace(index_file + '.tmp', index_file)
+        self.__index_changed = False
+
+    # Writes access times changed since the last write of the index
+    def flush(self):
+        if self.__index_changed:
+            self.__write_index()
+
+    def __directory(self, key):
+        return os.path.join(self.root, OBJECTS_DIR, key[:2], key)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def keys(self):
+        return list(self.__entries)
+
+    # Total size of the stored arrays, bytes
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self.__entries.values())
+
+    # Stores arrays (dictionary name -> array) of the result, replaces the result with the same key.
+    # Parameters params and metadata are JSON serializable objects kept in the index.
+    def put(self, key, arrays, params=None, metadata=None):
+        directory = self.__directory(key)
+        temp_directory = directory + '.tmp'
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        os.makedirs(temp_directory)
+        arrays_info = {}
+        total_bytes = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            np.save(os.path.join(temp_directory, name + '.npy'), array)
+            arrays_info[name] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+            total_bytes += os.path.getsize(os.path.join(temp_directory, name + '.npy'))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temp_directory, directory)
+
+        self.__entries[key] = {'key': key, 'params': params, 'metadata': metadata if metadata is not None else {},
+                               'arrays': arrays_info, 'bytes': total_bytes, 'created': time.time(),
+                               'last_access': time.time()}
+        self.evict(keep=key)
+        return StoredResult(self.__directory(key), self.__entries[key])
+
+    # Returns StoredResult or None if there is no result with the key
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        entry['last_access'] = time.time()
+        self.__index_changed = True
+        return StoredResult(self.__directory(key), entry)
+
+    def remove(self, key):
+        if self.__entries.pop(key, None) is not None:
+            shutil.rmtree(self.__directory(key), ignore_errors=True)
+            self.__write_index()
+
+    # Removes least recently used results until the total size is not above max_bytes.
+    # Result with key keep is not removed. Returns list of removed keys.
+    def evict(self, max_bytes=None, keep=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        if max_bytes is not None:
+            total_bytes = self.total_bytes()
+            for entry in sorted(self.__entries.values(), key=lambda entry: entry['last_access']):
+                if total_bytes <= max_bytes:
+                    break
+                if entry['key'] == keep:
+                    continue
+                total_bytes -= entry['bytes']
+                removed.append(entry['key'])
+        for key in removed:
+            del self.__entries[key]
+            shutil.rmtree(self.__directory(key), ignore_errors=True)
+        self.__write_index()
+        return removed
+
+    # Returns stored result of the parameters, computes and stores it if it is missing.
+    # Function compute(params) returns dictionary of arrays or pair (arrays, metadata).
+    def get_or_compute(self, params, compute, version=None):
+        key = result_key(params, version)
+        result = self.get(key)
+        if result is None:
+            computed = compute(params)
+            arrays, metadata = computed if isinstance(computed, tuple) else (computed, None)
+            result = self.put(key, arrays, params, metadata)
+        return result
@@ -0,0 +1,227 @@
+import numpy as np
+
+# Length of the blocks used to split long recursions into matrix products
+RECURSION_BLOCK_SIZE = 64
+
+# This function solves first order linear recursion y[n] = pole * y[n-1] + u[n] for the whole array at once.
+# Parameter initial is the value y[-1] left from the previous call.
+# The recursion runs along the last axis of u. Samples are split into blocks of RECURSION_BLOCK_SIZE,
+# the zero-state response of every block is obtained with one matrix product and the values carried
+# from block to block are obtained by the same recursion with pole ** RECURSION_BLOCK_SIZE.
+def solve_linear_recursion(u, pole, initial):
+    u = np.asarray(u)
+    dtype = np.result_type(u, pole, initial)
+    samples_cnt = u.shape[-1]
+    lead_shape = u.shape[:-1]
+    initial = np.broadcast_to(np.asarray(initial, dtype=dtype), lead_shape)
+    if samples_cnt == 0:
+        return np.empty(u.shape, dtype=dtype)
+
+    block_size = min(RECURSION_BLOCK_SIZE, samples_cnt)
+    blocks_cnt = -(-samples_cnt // block_size)
+    powers = (np.asarray(pole, dtype=dtype) ** np.arange(block_size + 1)).astype(dtype)
+    lag = np.arange(block_size)[:, None] - np.arange(block_size)[None, :]
+    transfer = np.where(lag >= 0, powers[np.clip(lag, 0, None)], 0).astype(dtype)
+
+    padded = np.zeros(lead_shape + (blocks_cnt * block_size,), dtype=dtype)
+    padded[..., :samples_cnt] = u
+    blocks = padded.reshape(lead_shape + (blocks_cnt, block_size))
+    # Response of every block to its own input only
+    zero_state = blocks @ transfer.T
+    # Value of y right before every block
+    if blocks_cnt == 1:
+        carry_in = initial[..., None]
+    else:
+        block_ends = solve_linear_recursion(zero_state[..., -1], powers[block_size], initial)
+        carry_in = np.concatenate((initial[..., None], block_ends[..., :-1]), axis=-1)
+    output = zero_state + carry_in[..., None] * powers[1:]
+
+    return output.reshape(lead_shape + (-1,))[..., :samples_cnt]
+
+# This function designs digital Butterworth LPF of any order as cascade of second order sections.
+# Bilinear transform with prewarping at cutoff_freq is used, every section has unity gain at DC.
+# Returns array of sections, each row is [b0, b1, b2, a0, a1, a2].
+def butterworth_lowpass_sos(order, cutoff_freq, sampling_freq):
+    if not 0 < cutoff_freq < sampling_freq / 2:
+        raise ValueError(f'Cutoff frequency {cutoff_freq} Hz must be between 0 and {sampling_freq / 2} Hz')
+    # Prewarped analog cutoff, normalized to 2 * sampling_freq
+    warped = np.tan(np.pi * cutoff_freq / sampling_freq)
+    sections = []
+    # Poles of analog Butterworth filter in upper half-plane, each one gives a pair with its conjugate
+    for k in range(order // 2):
+        analog_pole = warped * np.exp(1j * np.pi * (2 * k + order + 1) / (2 * order))
+        pole = (1 + analog_pole) / (1 - analog_pole)
+        a1, a2 = -2 * pole.real, abs(pole) ** 2
+        gain = (1 + a1 + a2) / 4
+        sections.append([gain, 2 * gain, gain, 1.0, a1, a2])
+    # Odd order has one real pole
+    if order % 2:
+        pole = (1 - warped) / (1 + warped)
+        gain = (1 - pole) / 2
+        sections.append([gain, gain, 0.0, 1.0, -pole, 0.0])
+
+    return np.array(sections)
+
+# This function recalculates second order sections designed for sampling frequency fs
+# to be used at sampling frequency fs * rate_ratio. Frequency response in Hz is kept the same
+# up to the warping of bilinear transform: substitution z^-1 -> (z^-1 + alpha) / (1 + alpha * z^-1)
+# maps filter through its analog prototype to the new rate, gain at DC and at Nyquist does not change.
+def rescale_sos(sos, rate_ratio):
+    alpha = (1 - rate_ratio) / (1 + rate_ratio)
+    rescaled = []
+    for b0, b1, b2, a0, a1, a2 in np.atleast_2d(np.asarray(sos, dtype=float)):
+        if b2 == 0 and a2 == 0:
+            # First order section stays first order
+            section = [b0 + alpha * b1, alpha * b0 + b1, 0.0, a0 + alpha * a1, alpha * a0 + a1, 0.0]
+        else:
+            section = []
+            for c0, c1, c2 in ((b0, b1, b2), (a0, a1, a2)):
+                section += [c0 + alpha * c1 + alpha * alpha * c2,
+                            2 * alpha * c0 + (1 + alpha * alpha) * c1 + 2 * alpha * c2,
+                            alpha * alpha * c0 + alpha * c1 + c2]
+        rescaled.append(np.array(section) / section[3])
+
+    return np.array(rescaled)
+
+# IIR digital filter built as cascade of second order sections (biquads).
+# Every section is [b0, b1, b2, a0, a1, a2], first order section has b2 = a2 = 0.
+# Filter keeps its state (two last input and output samples of each section, direct form I),
+# so signal may be processed by blocks of any length. Parameter channels_shape allows
+# to filter several independent channels at once, the samples go along the last axis.
+# Parameter dtype is the floating point type of coefficients, state and output (float64 or float32),
+# input of other types is converted to it.
+# Single channel float64 filter processed sample by sample keeps its state in Python floats (numpy indexing
+# per sample is about ten times slower), the state arrays are updated from them when they are accessed.
+class SosFilter():
+
+    def __init__(self, sos, channels_shape=(), dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        sos = np.atleast_2d(np.asarray(sos, dtype=float))
+        if sos.shape[1] != 6:
+            raise ValueError(f'Second order sections must have 6 coefficients, got shape {sos.shape}')
+        # Normalize sections so that a0 = 1
+        self.sos = (sos / sos[:, 3:4]).astype(self.dtype)
+        self.sections_cnt = len(self.sos)
+        complex_dtype = np.result_type(self.dtype, np.complex64)
+
+        # Poles of every section: roots of z^2 + a1*z + a2.
+        # Pole with the smaller magnitude goes second, for first order section it is exactly 0.
+        # Poles are calculated in float64 and stored in dtype (or its complex counterpart).
+        self.poles = []
+        for _, _, _, _, a1, a2 in self.sos.astype(float):
+            discriminant = a1 * a1 - 4 * a2
+            root = np.sqrt(discriminant) if discriminant >= 0 else 1j * np.sqrt(-discriminant)
+            pole1, pole2 = (-a1 + root) / 2, (-a1 - root) / 2
+            if abs(pole1) < abs(pole2):
+                pole1, pole2 = pole2, pole1
+            if a2 == 0:
+                pole2 = 0
+            pole_dtype = complex_dtype if np.iscomplexobj(pole1) else self.dtype
+            self.poles.append((pole_dtype.type(pole1), pole_dtype.type(pole2)))
+
+        # Coefficients [b0, b1, b2, a1, a2] of every section as Python floats for process_sample
+        self.__sample_sos = [tuple(float(value) for value in section[[0, 1, 2, 4, 5]]) for section in self.sos]
+        self.reset(channels_shape)
+
+    # State arrays, see reset. State kept in Python floats by process_sample is written to them first.
+    @property
+    def x_state(self):
+        self.__store_sample_state()
+        return self.__x_state
+
+    @property
+    def y_state(self):
+        self.__store_sample_state()
+        return self.__y_state
+
+    def __store_sample_state(self):
+        if self.__sample_sections is not None:
+            for section_idx, section in enumerate(self.__sample_sections):
+                self.__x_state[section_idx] = section[5:7]
+                self.__y_state[section_idx] = section[7:9]
+            self.__sample_sections = None
+
+    # Clear filter state. Parameter channels_shape sets number of channels filtered at once.
+    def reset(self, channels_shape=()):
+        self.channels_shape = (channels_shape,) if np.isscalar(channels_shape) else tuple(channels_shape)
+        # x_state[section, ..., 0] is x[n-1], x_state[section, ..., 1] is x[n-2]. Same for y_state.
+        self.__x_state = np.zeros((self.sections_cnt,) + self.channels_shape + (2,), dtype=self.dtype)
+        self.__y_state = np.zeros((self.sections_cnt,) + self.channels_shape + (2,), dtype=self.dtype)
+        # [b0, b1, b2, a1, a2, x[n-1], x[n-2], y[n-1], y[n-2]] of every section while the filter is processed
+        # sample by sample
+        self.__sample_sections = None
+        self.__float_samples = not self.channels_shape and self.dtype == np.float64
+
+    # Process one sample (or one sample per channel). This is straightforward implementation
+    # of difference equation used as reference for process_block.
+    def process_sample(self, sample):
+        if not self.__float_samples:
+            return self.__process_sample_array(sample)
+        sections = self.__sample_sections
+        if sections is None:
+            sections = self.__sample_sections = [list(coefficients) + x_state.tolist() + y_state.tolist() for
+                                                 coefficients, x_state, y_state in
+                                                 zip(self.__sample_sos, self.__x_state, self.__y_state)]
+        sample = float(sample)
+        for section in sections:
+            b0, b1, b2, a1, a2, x1, x2, y1, y2 = section
+            output = b0 * sample + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            section[5:] = sample, x1, output, y1
+            sample = output
+
+        return sample
+
+    # The same difference equation on the state arrays, for several channels and float32
+    def __process_sample_array(self, sample):
+        for section_idx in range(self.sections_cnt):
+            b0, b1, b2, _, a1, a2 = self.sos[section_idx]
+            x_state = self.x_state[section_idx]
+            y_state = self.y_state[section_idx]
+            output = b0 * sample + b1 * x_state[..., 0] + b2 * x_state[..., 1] \
+                - a1 * y_state[..., 0] - a2 * y_state[..., 1]
+            x_state[..., 1] = x_state[..., 0]
+            x_state[..., 0] = sample
+            y_state[..., 1] = y_state[..., 0]
+            y_state[..., 0] = output
+            sample = output
+
+        return sample
+
+    # Process the whole block of samples (along the last axis) without Python loop over samples.
+    # Every section is split into FIR part and two first order recursions, one per pole:
+    # w[n] = pole1 * w[n-1] + v[n], y[n] = pole2 * y[n-1] + w[n], where v is output of FIR part.
+    def process_block(self, samples):
+        samples = np.asarray(samples, dtype=self.dtype)
+        samples_cnt = samples.shape[-1]
+        if samples_cnt == 0:
+            return np.empty(samples.shape, dtype=self.dtype)
+
+        for section_idx in range(self.sections_cnt):
+            b0, b1, b2, _, a1, a2 = self.sos[section_idx]
+            pole1, pole2 = self.poles[section_idx]
+            x_state = self.x_state[section_idx]
+            y_state = self.y_state[section_idx]
+
+            # FIR part, two previous inputs are taken from the state
+            line = np.concatenate((x_state[..., ::-1], samples), axis=-1)
+            fir_out = b0 * samples + b1 * line[..., 1:-1] + b2 * line[..., :-2]
+
+            # Recursive part
+            if pole2 == 0:
+                output = solve_linear_recursion(fir_out, pole1, y_state[..., 0])
+            else:
+                initial = y_state[..., 0] - pole2 * y_state[..., 1]
+                intermediate = solve_linear_recursion(fir_out, pole1, initial)
+                output = solve_linear_recursion(intermediate, pole2, y_state[..., 0])
+                if np.iscomplexobj(output):
+                    output = output.real
+
+            x_state[...] = line[..., -1:-3:-1]
+            if samples_cnt == 1:
+                y_state[..., 1] = y_state[..., 0]
+                y_state[..., 0] = output[..., 0]
+            else:
+                y_state[...] = output[..., -1:-3:-1]
+            samples = output
+
+        return samples
@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import functools
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from capture_io import SAMPLE_FORMATS
+from demodulator_nfm import DemodulatorNFM
+from nfm_reference import generate_modulation_signal, modulate_fm
+
+# Number of input samples in one frame, demodulator processes one frame per call
+DEFAULT_FRAME_SIZE = 4096
+# Number of preallocated frames per stream, it bounds the number of frames waiting for demodulation
+DEFAULT_QUEUE_SIZE = 8
+# What to do when all frames are busy:
+# 'block' - stop reading the input (the sender is paused by the flow control of the socket or pipe)
+# 'drop'  - keep reading and drop new frames (overrun), for sources which can not be paused
+OVERFLOW_POLICIES = ('block', 'drop')
+# Upper edges of latency histogram buckets, ms. The last bucket counts everything above.
+LATENCY_BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Demodulated samples are sent as float32
+OUTPUT_DTYPE = np.float32
+
+
+# Histogram of latencies with fixed buckets
+class LatencyHistogram():
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = np.asarray(buckets_ms, dtype=float)
+        self.counts = np.zeros(len(self.buckets_ms) + 1, dtype=np.int64)
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.counts[np.searchsorted(self.buckets_ms, seconds * 1e3)] += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    # Upper edge of the bucket where the given percentile falls, ms, not above the maximum latency
+    def percentile_ms(self, percent):
+        count = int(self.counts.sum())
+        if count == 0:
+            return None
+        bucket_idx = int(np.searchsorted(np.cumsum(self.counts), percent / 100 * count))
+        if bucket_idx >= len(self.buckets_ms):
+            return self.max_seconds * 1e3
+        return min(float(self.buckets_ms[bucket_idx]), self.max_seconds * 1e3)
+
+    def snapshot(self):
+        count = int(self.counts.sum())
+        return {
+            'count': count,
+            'mean_ms': self.total_seconds / count * 1e3 if count else None,
+            'max_ms': self.max_seconds * 1e3,
+            'p50_ms': self.percentile_ms(50),
+            'p99_ms': self.percentile_ms(99),
+            'buckets_ms': self.buckets_ms.tolist(),
+            'counts': self.counts.tolist(),
+        }
+
+
+# Counters of the service, cumulative over all streams
+class StreamStats():
+
+    def __init__(self):
+        self.streams = 0
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.reading_pauses = 0
+        self.trailing_bytes = 0
+        self.stream_errors = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            'streams': self.streams,
+            'frames_received': self.frames_received,
+            'frames_processed': self.frames_processed,
+            'frames_dropped': self.frames_dropped,
+            'reading_pauses': self.reading_pauses,
+            'trailing_bytes': self.trailing_bytes,
+            'stream_errors': self.stream_errors,
+            'latency': self.latency.snapshot(),
+        }
+
+
+# Preallocated frame: raw input bytes with the view of them as samples and buffer for the output
+class _Frame():
+
+    def __init__(self, frame_size, input_dtype):
+        self.raw = bytearray(frame_size * np.dtype(input_dtype).itemsize)
+        self.samples = np.frombuffer(self.raw, dtype=input_dtype)
+        self.output = np.empty(frame_size, dtype=OUTPUT_DTYPE)
+        self.output_bytes = memoryview(self.output).cast('B')
+        self.arrival_time = 0.0
+
+
+# One input stream with its own demodulator. Sockets fill the frames directly (BufferedProtocol),
+# pipes deliver bytes which are copied into the frames (data_received).
+# Frames go from the pool to the queue, are demodulated on the worker thread, written out and returned to the pool.
+class _StreamSession(asyncio.BufferedProtocol):
+
+    def __init__(self, service, demodulator):
+        self.service = service
+        self.stats = service.stats
+        self.demodulator = demodulator
+        self.scale = service.scale
+        self.free_frames = deque(_Frame(service.frame_size, service.input_dtype) for _ in range(service.queue_size))
+        self.scratch_frame = _Frame(service.frame_size, service.input_dtype)
+        self.current_frame = None
+        self.current_dropped = False
+        self.filled = 0
+        # Bytes of pipe input received while all frames are busy
+        self.backlog = bytearray()
+        self.queue = asyncio.Queue()
+        self.transport = None
+        self.output_transport = None
+        self.reading_paused = False
+        self.closed = False
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.finished = asyncio.get_running_loop().create_future()
+        self.consumer = asyncio.get_running_loop().create_task(self._consume())
+        self.stats.streams += 1
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.output_transport is None:
+            self.output_transport = transport
+
+    def _take_frame(self):
+        if self.free_frames:
+            self.current_frame = self.free_frames.popleft()
+            self.current_dropped = False
+        elif self.service.overflow == 'drop':
+            self.current_frame = self.scratch_frame
+            self.current_dropped = True
+        else:
+            return False
+        return True
+
+    def get_buffer(self, sizehint):
+        if self.current_frame is None and not self._take_frame():
+            # Reading is paused when the last free frame is queued, so the transport should not ask for a buffer.
+            # If it still does, the data goes to the scratch frame and the frame is counted as dropped.
+            self.current_frame = self.scratch_frame
+            self.current_dropped = True
+            if not self.reading_paused:
+                self.transport.pause_reading()
+                self.reading_paused = True
+                self.stats.reading_pauses += 1
+        return memoryview(self.current_frame.raw)[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        if self.filled == len(self.current_frame.raw):
+            self._frame_complete()
+
+    def data_received(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self.current_frame is None and not self._take_frame():
+                self.backlog += view
+                return
+            buffer = memoryview(self.current_frame.raw)[self.filled:]
+            chunk_len = min(len(buffer), len(view))
+            buffer[:chunk_len] = view[:chunk_len]
+            view = view[chunk_len:]
+            self.buffer_updated(chunk_len)
+
+    def _frame_complete(self):
+        frame = self.current_frame
+        self.current_frame = None
+        self.filled = 0
+        frame.arrival_time = time.perf_counter()
+        self.stats.frames_received += 1
+        if self.current_dropped:
+            self.stats.frames_dropped += 1
+            return
+        self.queue.put_nowait(frame)
+        if not self.free_frames and self.service.overflow == 'block' and not self.reading_paused:
+            self.transport.pause_reading()
+            self.reading_paused = True
+            self.stats.reading_pauses += 1
+
+    def _release(self, frame):
+        self.free_frames.append(frame)
+        if self.backlog:
+            backlog = bytes(self.backlog)
+            self.backlog.clear()
+            self.data_received(backlog)
+        if self.reading_paused and self.free_frames and not self.closed:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        self._finish_input()
+        # Keep the socket open for the output which is still being demodulated
+        return True
+
+    def connection_lost(self, exc):
+        self._finish_input()
+
+    def _finish_input(self):
+        if not self.closed:
+            self.closed = True
+            self.stats.trailing_bytes += self.filled + len(self.backlog)
+            self.queue.put_nowait(None)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    # Runs on the worker thread
+    def _demodulate(self, frame):
+        output = self.demodulator.demodulate_block(np.multiply(frame.samples, self.scale,
+                                                               dtype=self.demodulator.dtype))
+        np.copyto(frame.output, output, casting='same_kind')
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frame = await self.queue.get()
+                if frame is None:
+                    break
+                await loop.run_in_executor(self.executor, self._demodulate, frame)
+                await self.can_write.wait()
+                # Transports may keep the written buffer without copying it (sockets since Python 3.12),
+                # the output buffer of the frame is reused, so its copy is written
+                if not self.output_transport.is_closing():
+                    self.output_transport.write(bytes(frame.output_bytes))
+                self.stats.latency.add(time.perf_counter() - frame.arrival_time)
+                self.stats.frames_processed += 1
+                self._release(frame)
+            await self.can_write.wait()
+        except Exception as error:
+            # Failed stream is reported and its connection is reset, other streams keep running
+            self.stats.stream_errors += 1
+            print(f'Demodulation of the stream failed: {error!r}', file=sys.stderr)
+            self.closed = True
+            self.transport.abort()
+            if self.output_transport is not self.transport:
+                self.output_transport.abort()
+        finally:
+            self.executor.shutdown(wait=False)
+            if not self.output_transport.is_closing():
+                self.output_transport.close()
+            if self.transport is not self.output_transport and not self.transport.is_closing():
+                self.transport.close()
+            self.finished.set_result(None)
+            self.service.session_finished(self)
+
+
+# Protocol of the output pipe, passes flow control to the session
+class _OutputPipeProtocol(asyncio.Protocol):
+
+    def __init__(self, session):
+        self.session = session
+
+    def pause_writing(self):
+        self.session.pause_writing()
+
+    def resume_writing(self):
+        self.session.resume_writing()
+
+
+# Streaming demodulation service. Every incoming stream (TCP or Unix socket connection, or pipe) gets its own
+# demodulator from demodulator_factory. Input is a stream of samples in sample_format, read by frames of
+# frame_size samples into preallocated buffers. Frames are demodulated by demodulate_block on a worker thread
+# while the event loop keeps receiving. Output is the stream of float32 demodulated samples, one output frame
+# per input frame, written back to the socket (or to the output pipe).
+# Parameter on_stream_end is called with stats snapshot when a stream is finished.
+class DemodulationService():
+
+    def __init__(self, demodulator_factory, frame_size=DEFAULT_FRAME_SIZE, sample_format='int16',
+                 queue_size=DEFAULT_QUEUE_SIZE, overflow='block', on_stream_end=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}')
+        self.demodulator_factory = demodulator_factory
+        self.frame_size = frame_size
+        self.input_dtype, self.scale = SAMPLE_FORMATS[sample_format]
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.on_stream_end = on_stream_end
+        self.stats = StreamStats()
+
+    def _create_session(self):
+        return _StreamSession(self, self.demodulator_factory())
+
+    def session_finished(self, session):
+        if self.on_stream_end is not None:
+            self.on_stream_end(self.stats.snapshot())
+
+    async def serve_tcp(self, host, port):
+        return await asyncio.get_running_loop().create_server(self._create_session, host, port)
+
+    async def serve_unix(self, path):
+        return await asyncio.get_running_loop().create_unix_server(self._create_session, path)
+
+    # Demodulates one stream from input pipe to output pipe (file objects), returns when the input is over
+    async def serve_pipe(self, input_file, output_file):
+        loop = asyncio.get_running_loop()
+        session = self._create_session()
+        output_transport, _ = await loop.connect_write_pipe(lambda: _OutputPipeProtocol(session), output_file)
+        session.output_transport = output_transport
+        await loop.connect_read_pipe(lambda: session, input_file)
+        await session.finished
+
+
+# Demodulator for the configuration (see parameter_sweep.py), one per stream
+def create_demodulator(config):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    demodulator = DemodulatorNFM(sampling_freq, config['oversampling_ratio'], verbose=False)
+    demodulator.init(config['discriminator_delay_ratio'], config['carrier_freq'], sum(config['mod_amp_list']),
+                     config['freq_sensitivity'])
+    return demodulator
+
+
+# FM signal of the configuration as raw ADC samples in sample_format, stands in for the radio front end
+def generate_adc_samples(config, samples_cnt, sample_format='int16'):
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+    time_vector = np.arange(samples_cnt) / sampling_freq
+    modulation_signal = generate_modulation_signal(time_vector, config['mod_freq_list'], config['mod_amp_list'])
+    [signal, _] = modulate_fm(time_vector, config['carrier_freq'], config['carrier_amplitude'],
+                              config['freq_sensitivity'], modulation_signal)
+    dtype, scale = SAMPLE_FORMATS[sample_format]
+    if np.issubdtype(dtype, np.integer):
+        signal = np.clip(np.round(signal / scale), np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return signal.astype(dtype)
+
+
+# Generator client: sends samples to the service by frames and receives the demodulated output.
+# With realtime=True frames are sent at the sampling rate of the configuration, otherwise as fast as possible.
+# Returns demodulated samples.
+async def run_generator_client(config, samples_cnt, frame_size=DEFAULT_FRAME_SIZE, sample_format='int16',
+                               host=None, port=None, path=None, realtime=False):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    samples = generate_adc_samples(config, samples_cnt, sample_format)
+    sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+
+    async def send():
+        start_time = time.perf_counter()
+        for frame_start in range(0, len(samples), frame_size):
+            writer.write(samples[frame_start:frame_start + frame_size].tobytes())
+            await writer.drain()
+            if realtime:
+                await asyncio.sleep(max(0.0, start_time + (frame_start + frame_size) / sampling_freq -
+                                        time.perf_counter()))
+        writer.write_eof()
+
+    _, output = await asyncio.gather(send(), reader.read())
+    writer.close()
+    return np.frombuffer(output, dtype=OUTPUT_DTYPE)
+
+
+def _print_stats(snapshot):
+    print(json.dumps(snapshot), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    from parameter_sweep import TESTBENCH_PARAMETER_SETS, complete_config
+
+    parser = argparse.ArgumentParser(description='Streaming NFM demodulation service and generator client')
+    parser.add_argument('mode', choices=('serve', 'generate'))
+    parser.add_argument('--tcp', default=None, metavar='HOST:PORT')
+    parser.add_argument('--unix', default=None, metavar='PATH')
+    parser.add_argument('--pipe', action='store_true', help='Serve one stream from stdin to stdout')
+    parser.add_argument('--set', type=int, default=3, help='Index (from 1) of testbench parameter set')
+    parser.add_argument('--format', default='int16', choices=list(SAMPLE_FORMATS), help='Input sample format')
+    parser.add_argument('--frame-size', type=int, default=DEFAULT_FRAME_SIZE)
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='block')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Duration of generated signal')
+    parser.add_argument('--realtime', action='store_true', help='Send generated frames at the sampling rate')
+    parser.add_argument('--output', default=None, help='Write received output to this .npy file')
+    args = parser.parse_args()
+
+    config = complete_config(TESTBENCH_PARAMETER_SETS[args.set - 1])
+    host, port = (args.tcp.rsplit(':', 1) if args.tcp else (None, None))
+
+    async def main():
+        if args.mode == 'generate':
+            sampling_freq = config['oversampling_ratio'] * config['receiver_sampling_freq']
+            samples_cnt = int(args.seconds * sampling_freq) // args.frame_size * args.frame_size
+            start_time = time.perf_counter()
+            output = await run_generator_client(config, samples_cnt, args.frame_size, args.format, host,
+                                                int(port) if port else None, args.unix, args.realtime)
+            seconds = time.perf_counter() - start_time
+            print(f'Received {len(output)} samples in {seconds:.3f} s ({samples_cnt / seconds:.4g} samples/s)')
+            if args.output:
+                np.save(args.output, output)
+            return
+
+        service = DemodulationService(functools.partial(create_demodulator, config), args.frame_size, args.format,
+                                      args.queue_size, args.overflow, on_stream_end=_print_stats)
+        if args.pipe:
+            await service.serve_pipe(sys.stdin.buffer, sys.stdout.buffer)
+            return
+        server = await (service.serve_unix(args.unix) if args.unix else service.serve_tcp(host, int(port)))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,362 @@
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+import cryptography
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
+from ecdh_utils import generate_private_keys
+from group_key_engine import EXECUTORS, PROTOCOLS, GroupKeyEngine
+from multi_participant_ecdh import Participant
+
+# Timed operations, every one is done on a list of prepared inputs:
+# keygen             - X25519PrivateKey.generate (random bytes and the public key in OpenSSL)
+# private_from_bytes - X25519PrivateKey.from_private_bytes, key from batch generated bytes (see group_key_engine.py),
+#                      OpenSSL derives the public key here (scalar multiplication)
+# public_key         - public key object of the private key, the key is already derived, so it is only wrapped
+# serialize          - raw public bytes of the public key
+# parse              - X25519PublicKey.from_public_bytes
+# exchange           - X25519 exchange with parsed public key
+# participant_create - Participant object creation
+# participant_keygen - Participant.generate_key_pair
+# participant_round  - Participant.receive_public_key and finish_round (one round of the ring protocol)
+OPERATIONS = ('keygen', 'private_from_bytes', 'public_key', 'serialize', 'parse', 'exchange',
+              'participant_create', 'participant_keygen', 'participant_round')
+DEFAULT_OPERATIONS_COUNT = 2000
+DEFAULT_GROUP_SIZES = [4, 16, 64]
+DEFAULT_WORKERS = sorted({1, os.cpu_count() or 1})
+DEFAULT_REPEATS = 3
+# Allowed relative degradation of the rates before it is reported as regression
+DEFAULT_TOLERANCE = 0.1
+# Rates compared with the baseline
+RATE_METRICS = ('ops_per_s', 'agreements_per_s')
+
+
+def _openssl_version():
+    try:
+        from cryptography.hazmat.backends.openssl.backend import backend
+        return backend.openssl_version_text()
+    except ImportError:
+        return None
+
+
+# Inputs of the operation for count repetitions, created before the timing
+def _prepare(operation, count):
+    raw_keys = generate_private_keys(count)
+    private_keys = [X25519PrivateKey.from_private_bytes(raw_key) for raw_key in raw_keys]
+    public_keys = [private_key.public_key() for private_key in private_keys]
+    public_bytes = [public_key.public_bytes(Encoding.Raw, PublicFormat.Raw) for public_key in public_keys]
+    if operation in ('keygen', 'participant_create', 'participant_keygen'):
+        return [None] * count
+    if operation == 'private_from_bytes':
+        return raw_keys
+    if operation == 'public_key':
+        return private_keys
+    if operation == 'serialize':
+        return public_keys
+    if operation == 'parse':
+        return public_bytes
+    if operation == 'exchange':
+        return list(zip(private_keys, public_keys[1:] + public_keys[:1]))
+    # participant_round: participants with key pairs and the public bytes of the previous neighbour
+    participants = [Participant(idx) for idx in range(count)]
+    for participant, private_key in zip(participants, private_keys):
+        participant.generate_key_pair(private_key)
+    return list(zip(participants, public_bytes[-1:] + public_bytes[:-1]))
+
+
+def _run_operation(operation, inputs):
+    start_time = time.perf_counter()
+    if operation == 'keygen':
+        for _ in inputs:
+            X25519PrivateKey.generate()
+    elif operation == 'private_from_bytes':
+        for raw_key in inputs:
+            X25519PrivateKey.from_private_bytes(raw_key)
+    elif operation == 'public_key':
+        for private_key in inputs:
+            private_key.public_key()
+    elif operation == 'serialize':
+        for public_key in inputs:
+            public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+    elif operation == 'parse':
+        for public_bytes in inputs:
+            X25519PublicKey.from_public_bytes(public_bytes)
+    elif operation == 'exchange':
+        for private_key, public_key in inputs:
+            private_key.exchange(public_key)
+    elif operation == 'participant_create':
+        for idx, _ in enumerate(inputs):
+            Participant(idx)
+    elif operation == 'participant_keygen':
+        participant = Participant(0)
+        for _ in inputs:
+            participant.generate_key_pair()
+    elif operation == 'participant_round':
+        for participant, public_bytes in inputs:
+            participant.receive_public_key(public_bytes)
+            participant.finish_round()
+    return time.perf_counter() - start_time
+
+
+# Rate of count operations in seconds, None if the time is too short to be measured
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+
+# Overhead part of the breakdown: the rest of the measured time above the backend time.
+# Negative rest means the difference is within the measurement noise, it is reported as zero overhead
+# and its magnitude as noise.
+def _overhead_parts(name, rest):
+    return {name: rest} if rest >= 0 else {name: 0.0, 'noise': -rest}
+
+
+# Time of the empty loop over the inputs, it is subtracted from the time of the operations
+def _loop_time(inputs):
+    start_time = time.perf_counter()
+    for _ in inputs:
+        pass
+    return time.perf_counter() - start_time
+
+
+# This function times the operation count times, the fastest of repeats runs is reported.
+# participant_round changes the participants, so the inputs are prepared again for every run.
+def benchmark_operation(operation, count=DEFAULT_OPERATIONS_COUNT, repeats=DEFAULT_REPEATS):
+    best_seconds = None
+    for _ in range(repeats):
+        inputs = _prepare(operation, count)
+        seconds = max(_run_operation(operation, inputs) - _loop_time(inputs), 0.0)
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return {
+        'case': 'operation',
+        'operation': operation,
+        'count': count,
+        'seconds': best_seconds,
+        'seconds_per_op': best_seconds / count,
+        'ops_per_s': _rate(count, best_seconds),
+    }
+
+
+# Splits the time of the Participant methods into the time of the crypto backend (OpenSSL key generation
+# and exchange), serialization, parsing and the rest of Python overhead (object creation, calls),
+# seconds per operation from the results of benchmark_operation
+def operations_breakdown(operation_results):
+    per_op = {result['operation']: result['seconds_per_op'] for result in operation_results}
+    breakdown = {}
+    if {'participant_keygen', 'keygen', 'public_key', 'serialize'} <= per_op.keys():
+        backend = per_op['keygen'] + per_op['public_key']
+        breakdown['participant_keygen'] = {
+            'backend': backend,
+            'serialize': per_op['serialize'],
+        }
+        breakdown['participant_keygen'].update(
+            _overhead_parts('python_overhead', per_op['participant_keygen'] - backend - per_op['serialize']))
+    if {'participant_round', 'exchange', 'parse'} <= per_op.keys():
+        breakdown['participant_round'] = {
+            'backend': per_op['exchange'],
+            'parse': per_op['parse'],
+        }
+        breakdown['participant_round'].update(
+            _overhead_parts('python_overhead', per_op['participant_round'] - per_op['exchange'] - per_op['parse']))
+    for breakdown_case in breakdown.values():
+        total = sum(seconds for part, seconds in breakdown_case.items() if part != 'noise')
+        breakdown_case['backend_share'] = breakdown_case['backend'] / total if total > 0 else None
+    return breakdown
+
+
+# Number of workers whose backend operations run at the same time. X25519 operations of cryptography are too short
+# to gain from releasing the GIL, threads do not overlap them; processes overlap as far as there are cores.
+def _parallel_workers(executor, workers):
+    return min(workers, os.cpu_count() or 1) if executor == 'process' else 1
+
+
+# This function benchmarks full group key agreement of GroupKeyEngine, the fastest of repeats runs is reported.
+# Time of the rounds is split into the time the exchanges and key derivations would take in the crypto backend
+# (seconds per operation from operation_results) and the rest: parsing, Python overhead, scheduling of
+# the workers and passing the keys between them. Backend time includes key pairs derived again by process
+# workers (worker_key_derivations of GroupKeyEngine), it is divided by the number of workers running in parallel
+# (see _parallel_workers).
+def benchmark_group(participants_count, protocol, executor, workers, repeats=DEFAULT_REPEATS,
+                    operation_results=()):
+    engine = GroupKeyEngine(executor, workers, protocol=protocol)
+    best = None
+    for _ in range(repeats):
+        result = engine.run(participants_count)
+        if not result['agreed']:
+            raise RuntimeError(f'Group key is not agreed: {participants_count} {protocol} {executor} {workers}')
+        if best is None or result['total_seconds'] < best['total_seconds']:
+            best = result
+
+    result = {
+        'case': 'group',
+        'participants': participants_count,
+        'protocol': protocol,
+        'executor': executor,
+        'workers': engine.workers,
+        'rounds': best['rounds'],
+        'exchanges': best['exchanges'],
+        'key_derivations': best['key_derivations'],
+        'worker_key_derivations': best['worker_key_derivations'],
+        'messages': best['messages'],
+        'keygen_seconds': best['keygen_seconds'],
+        'rounds_seconds': best['rounds_seconds'],
+        'seconds': best['total_seconds'],
+        'ops_per_s': _rate(best['exchanges'], best['rounds_seconds']),
+        'ops_per_s_per_worker': _rate(best['exchanges'], best['rounds_seconds'] * engine.workers),
+        'agreements_per_s': _rate(1, best['total_seconds']),
+    }
+    per_op = {operation_result['operation']: operation_result['seconds_per_op']
+              for operation_result in operation_results}
+    if {'exchange', 'private_from_bytes', 'public_key', 'serialize'} <= per_op.keys():
+        # Key pair derived from raw bytes: the scalar multiplication is in private_from_bytes,
+        # public_key and serialize are the Python objects and bytes of its result
+        derivation = per_op['private_from_bytes'] + per_op['public_key'] + per_op['serialize']
+        derivations = best['key_derivations'] + best['worker_key_derivations']
+        backend = (best['exchanges'] * per_op['exchange'] + derivations * derivation) / \
+            _parallel_workers(executor, engine.workers)
+        result['breakdown'] = {'backend': backend}
+        result['breakdown'].update(_overhead_parts('overhead', best['rounds_seconds'] - backend))
+    return result
+
+
+# Runs benchmarks of the operations and of the group agreement for all combinations of group sizes,
+# protocols, executors and numbers of workers ('serial' executor runs once with one worker).
+# Returns report: dictionary with description of the environment, list of results and the breakdown.
+def run_benchmarks(operations=OPERATIONS, count=DEFAULT_OPERATIONS_COUNT, sizes=DEFAULT_GROUP_SIZES,
+                   protocols=PROTOCOLS, executors=EXECUTORS, workers=DEFAULT_WORKERS, repeats=DEFAULT_REPEATS,
+                   progress=None):
+    results = []
+    for operation in operations:
+        results.append(benchmark_operation(operation, count, repeats))
+        if progress is not None:
+            progress(results[-1])
+    operation_results = list(results)
+
+    for participants_count in sizes:
+        for protocol in protocols:
+            for executor in executors:
+                for workers_count in ([1] if executor == 'serial' else workers):
+                    results.append(benchmark_group(participants_count, protocol, executor, workers_count, repeats,
+                                                   operation_results))
+                    if progress is not None:
+                        progress(results[-1])
+
+    return {
+        'environment': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'cryptography': cryptography.__version__,
+            'openssl': _openssl_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'repeats': repeats,
+        'results': results,
+        'breakdown': operations_breakdown(operation_results),
+    }
+
+
+def _is_measured(rate):
+    return rate is not None and math.isfinite(rate) and rate > 0
+
+
+def _result_key(result):
+    if result['case'] == 'operation':
+        return result['case'], result['operation']
+    return result['case'], result['participants'], result['protocol'], result['executor'], result['workers']
+
+
+# This function compares results with baseline report. Results without counterpart in the baseline are ignored.
+# Every rate (see RATE_METRICS) of the result is compared with the baseline, ratio is current / baseline.
+# Rates lower than (1 - tolerance) of the baseline are regressions. Rates which could not be measured
+# (None, zero or not finite in either report, e.g. Infinity of old reports) are not compared.
+# Returns pair: list of comparisons of all rates and list of regressions.
+def compare_results(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    baseline_results = {_result_key(result): result for result in baseline['results']}
+    comparisons = []
+    regressions = []
+    for result in report['results']:
+        reference = baseline_results.get(_result_key(result))
+        if reference is None:
+            continue
+        for metric in RATE_METRICS:
+            if not _is_measured(result.get(metric)) or not _is_measured(reference.get(metric)):
+                continue
+            comparison = {'key': _result_key(result), 'metric': metric, 'baseline': reference[metric],
+                          'current': result[metric], 'ratio': result[metric] / reference[metric]}
+            comparisons.append(comparison)
+            if result[metric] < (1 - tolerance) * reference[metric]:
+                regressions.append(comparison)
+    return comparisons, regressions
+
+
+def _rate_text(rate, width):
+    return f'{"-":>{width}}' if rate is None else f'{rate:>{width}.0f}'
+
+
+def print_result(result):
+    if result['case'] == 'operation':
+        print(f'{result["operation"]:>20} | {result["count"]:>8} | {result["seconds_per_op"] * 1e6:>10.2f} us | '
+              f'{_rate_text(result["ops_per_s"], 12)} ops/s')
+    else:
+        breakdown = result.get('breakdown')
+        breakdown_text = '' if breakdown is None else \
+            f' | backend {breakdown["backend"] * 1e3:.1f} ms, overhead {breakdown["overhead"] * 1e3:.1f} ms'
+        if breakdown is not None and 'noise' in breakdown:
+            breakdown_text += f' (noise {breakdown["noise"] * 1e3:.1f} ms)'
+        print(f'{result["participants"]:>8} | {result["protocol"]:>4} | {result["executor"]:>7} | '
+              f'{result["workers"]:>3} | {result["seconds"] * 1e3:>10.1f} ms | {_rate_text(result["ops_per_s"], 9)} '
+              f'exchanges/s, {result["worker_key_derivations"]} worker keys{breakdown_text}')
+
+
+def print_breakdown(breakdown):
+    for name, parts in breakdown.items():
+        parts_text = ', '.join(f'{part} {seconds * 1e6:.2f} us' for part, seconds in parts.items()
+                               if part != 'backend_share')
+        share_text = '-' if parts['backend_share'] is None else f'{parts["backend_share"] * 100:.0f}'
+        print(f'{name}: {parts_text}, backend share {share_text} %')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of X25519 operations and group key agreement')
+    parser.add_argument('--operations', nargs='*', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--count', type=int, default=DEFAULT_OPERATIONS_COUNT, help='Repetitions of every operation')
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_GROUP_SIZES, help='Numbers of participants')
+    parser.add_argument('--protocols', nargs='*', choices=PROTOCOLS, default=list(PROTOCOLS))
+    parser.add_argument('--executors', nargs='*', choices=EXECUTORS, default=list(EXECUTORS))
+    parser.add_argument('--workers', type=int, nargs='*', default=DEFAULT_WORKERS,
+                        help='Numbers of threads or processes')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--output', default=None, help='Write report to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare with report stored in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative degradation against the baseline')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.operations, args.count, args.sizes, args.protocols, args.executors, args.workers,
+                            args.repeats, progress=print_result)
+    print_breakdown(report['breakdown'])
+
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+        comparisons, regressions = compare_results(report, baseline, args.tolerance)
+        report['baseline_comparison'] = {'baseline': args.baseline, 'tolerance': args.tolerance,
+                                         'comparisons': comparisons, 'regressions': regressions}
+        for regression in regressions:
+            print(f'REGRESSION {regression["key"]} {regression["metric"]}: '
+                  f'baseline {regression["baseline"]:.4g}, current {regression["current"]:.4g}')
+        if not regressions:
+            print('No regressions against the baseline')
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+    if args.baseline and regressions:
+        sys.exit(1)
@@ -0,0 +1,19 @@
+import os
+
+# Size of X25519 private key, bytes
+KEY_SIZE = 32
+PERCENTILES = (50, 90, 99)
+
+
+# Private keys (raw bytes) of count participants from one call of the OS random generator.
+# X25519PrivateKey.generate does the same per key, the bytes are clamped when the key is created.
+def generate_private_keys(count):
+    random_bytes = os.urandom(KEY_SIZE * count)
+    return [random_bytes[idx * KEY_SIZE:(idx + 1) * KEY_SIZE] for idx in range(count)]
+
+
+# Percentiles of values (nearest rank), dictionary 'p<percentile>' -> value
+def percentiles(values, levels=PERCENTILES):
+    ordered = sorted(values)
+    return {f'p{level}': ordered[min(len(ordered) - 1, max(0, -(-level * len(ordered) // 100) - 1))]
+            for level in levels}
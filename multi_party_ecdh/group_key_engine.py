@@ -0,0 +1,282 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from ecdh_utils import generate_private_keys
+from multi_participant_ecdh import Participant
+from tree_group_key import tree_rounds_count, sibling_sponsor, tree_step
+
+# 'serial' runs in the calling thread, 'thread' and 'process' on the pool of workers (see GroupKeyEngine)
+EXECUTORS = ('serial', 'thread', 'process')
+# 'ring' - protocol of multi_participant_ecdh.py, 'tree' - tree protocol of tree_group_key.py
+PROTOCOLS = ('ring', 'tree')
+# Every round is split into this number of chunks per worker, so the workers are loaded evenly
+DEFAULT_CHUNKS_PER_WORKER = 4
+DEFAULT_GROUP_SIZES = (4, 16, 64, 256)
+
+# Private keys of the process pool worker and participants created from them on first use
+_worker_keys = None
+_worker_participants = {}
+# Key pairs derived by the worker (scalar multiplications) since its last returned task
+_worker_derivations = 0
+
+
+# Creates key pairs of the participants, returns their public bytes
+def _generate_chunk(participants, raw_keys):
+    for participant, raw_key in zip(participants, raw_keys):
+        participant.generate_key_pair(X25519PrivateKey.from_private_bytes(raw_key))
+    return [participant.public_bytes for participant in participants]
+
+
+# One round of the ring protocol for the participants: received[k] is public bytes of the previous
+# neighbour of participants[k]. Returns the next public bytes of the participants.
+def _exchange_chunk(participants, received):
+    for participant, public_bytes in zip(participants, received):
+        participant.receive_public_key(public_bytes)
+        participant.finish_round()
+    return [participant.public_bytes for participant in participants]
+
+
+# One round of the tree protocol for the participants: received[k] is blinded key of the other half
+# for participants[k]. Returns list of pairs (secret, blinded key) of the merged nodes.
+def _tree_chunk(participants, received, derive):
+    return [tree_step(participant, public_bytes, derive) for participant, public_bytes in zip(participants, received)]
+
+
+def _init_worker(raw_keys):
+    global _worker_keys, _worker_derivations
+    _worker_keys = raw_keys
+    _worker_participants.clear()
+    _worker_derivations = 0
+
+
+def _worker_key_pair(participant, raw_key):
+    global _worker_derivations
+    _generate_chunk([participant], [raw_key])
+    _worker_derivations += 1
+
+
+# Results of the worker task and the number of key pairs the worker derived for it
+def _worker_result(items):
+    global _worker_derivations
+    derivations, _worker_derivations = _worker_derivations, 0
+    return items, derivations
+
+
+# Participant of the worker process, its key pair is created once per worker
+def _worker_participant(idx):
+    participant = _worker_participants.get(idx)
+    if participant is None:
+        participant = Participant(idx)
+        _worker_key_pair(participant, _worker_keys[idx])
+        _worker_participants[idx] = participant
+    return participant
+
+
+def _worker_generate_chunk(start, stop):
+    return _worker_result([_worker_participant(idx).public_bytes for idx in range(start, stop)])
+
+
+def _worker_exchange_chunk(start, received):
+    return _worker_result(_exchange_chunk([_worker_participant(start + offset) for offset in range(len(received))],
+                                          received))
+
+
+# Workers do not keep tree nodes between rounds (the next round of a member may run on another worker),
+# node of the member is created from its secret, member without secret is still at its leaf
+def _worker_tree_chunk(indexes, node_secrets, received, derive):
+    participants = []
+    for idx, node_secret in zip(indexes, node_secrets):
+        if node_secret is None:
+            participant = _worker_participant(idx)
+        else:
+            participant = Participant(idx)
+            _worker_key_pair(participant, node_secret)
+        participants.append(participant)
+    return _worker_result(_tree_chunk(participants, received, derive))
+
+
+# Group key agreement by the ring protocol of multi_participant_ecdh.py or by the tree protocol
+# of tree_group_key.py on many workers, so the protocols may be compared on the same group sizes.
+# Private keys of all participants are generated in one batch before the protocol starts.
+# Exchanges of one round are independent, so every round is split into chunks of participants
+# processed by the workers in parallel. Public bytes pass between rounds as raw bytes: every exchange
+# parses the received key once, its result is passed on without serialization (see Participant.finish_round).
+# With 'thread' executor participants are shared objects. With 'process' executor every worker gets raw private
+# keys once (initializer of the pool) and creates its participants on first use, only public bytes are sent
+# to the workers and back every round (tree nodes are passed as their secrets, see _worker_tree_chunk).
+# The price is extra scalar multiplications in the workers: participants are created again by every worker
+# which gets them in a chunk, tree nodes are rebuilt every round. They are counted in worker_key_derivations
+# (key pairs derived by the workers beyond the one per participant of the key generation), 0 for other executors.
+# X25519 operations of cryptography are too short to gain from releasing the GIL, so threads do not run
+# exchanges in parallel and 'thread' executor only adds the cost of scheduling (it is kept for comparison,
+# see _parallel_workers of benchmark.py). 'serial' is the default, processes scale with cores for large groups.
+class GroupKeyEngine():
+
+    def __init__(self, executor='serial', workers=None, chunks_per_worker=DEFAULT_CHUNKS_PER_WORKER, protocol='ring'):
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor {executor}, expected one of {EXECUTORS}')
+        if protocol not in PROTOCOLS:
+            raise ValueError(f'Unknown protocol {protocol}, expected one of {PROTOCOLS}')
+        self.executor = executor
+        self.protocol = protocol
+        self.workers = 1 if executor == 'serial' else (workers or os.cpu_count())
+        self.chunks_per_worker = chunks_per_worker
+
+    def __chunks(self, participants_count):
+        chunk_size = max(1, -(-participants_count // (self.workers * self.chunks_per_worker)))
+        return [(start, min(start + chunk_size, participants_count))
+                for start in range(0, participants_count, chunk_size)]
+
+    # Runs key agreement of participants_count participants.
+    # Returns dictionary with the group key, number of rounds, operations and messages and time of every phase.
+    def run(self, participants_count):
+        if participants_count < 2:
+            raise ValueError('Group must have at least 2 participants')
+        start_time = time.perf_counter()
+        raw_keys = generate_private_keys(participants_count)
+        chunks = self.__chunks(participants_count)
+
+        pool = None
+        if self.executor == 'thread':
+            pool = ThreadPoolExecutor(self.workers)
+        elif self.executor == 'process':
+            pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(raw_keys,))
+        participants = [Participant(idx) for idx in range(participants_count)]
+        worker_derivations = [0]
+
+        # Runs list of tasks (function, args), returns concatenated results in the order of the tasks.
+        # Process workers return results with the number of key pairs derived for them.
+        def run_chunks(tasks):
+            if pool is None:
+                return [item for function, args in tasks for item in function(*args)]
+            futures = [pool.submit(function, *args) for function, args in tasks]
+            if self.executor != 'process':
+                return [item for future in futures for item in future.result()]
+            items = []
+            for future in futures:
+                chunk_items, derivations = future.result()
+                items.extend(chunk_items)
+                worker_derivations[0] += derivations
+            return items
+
+        try:
+            setup_time = time.perf_counter()
+            if self.executor == 'process':
+                public_bytes = run_chunks([(_worker_generate_chunk, (start, stop)) for start, stop in chunks])
+            else:
+                public_bytes = run_chunks([(_generate_chunk, (participants[start:stop], raw_keys[start:stop]))
+                                           for start, stop in chunks])
+            keygen_time = time.perf_counter()
+
+            if self.protocol == 'ring':
+                group_keys, counts = self.__run_ring(run_chunks, participants, public_bytes)
+            else:
+                group_keys, counts = self.__run_tree(run_chunks, participants, public_bytes)
+            rounds_time = time.perf_counter()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        result = {
+            'participants': participants_count,
+            'protocol': self.protocol,
+            'executor': self.executor,
+            'workers': self.workers,
+        }
+        result.update(counts)
+        result.update({
+            'worker_key_derivations': worker_derivations[0] - participants_count if self.executor == 'process' else 0,
+            'group_key': group_keys[0].hex(),
+            'agreed': all(value == group_keys[0] for value in group_keys),
+            'setup_seconds': setup_time - start_time,
+            'keygen_seconds': keygen_time - setup_time,
+            'rounds_seconds': rounds_time - keygen_time,
+            'total_seconds': rounds_time - start_time,
+            'exchanges_per_second': counts['exchanges'] / (rounds_time - keygen_time),
+        })
+        return result
+
+    # Ring protocol, every member does one exchange per round in participants_count - 1 rounds.
+    # Returns group keys of the members and counters of the protocol.
+    def __run_ring(self, run_chunks, participants, public_bytes):
+        participants_count = len(participants)
+        rounds_count = participants_count - 1
+        for _ in range(rounds_count):
+            # Every participant receives public bytes of the previous neighbour
+            received = public_bytes[-1:] + public_bytes[:-1]
+            chunks = self.__chunks(participants_count)
+            if self.executor == 'process':
+                tasks = [(_worker_exchange_chunk, (start, received[start:stop])) for start, stop in chunks]
+            else:
+                tasks = [(_exchange_chunk, (participants[start:stop], received[start:stop])) for start, stop in chunks]
+            public_bytes = run_chunks(tasks)
+
+        exchanges_count = participants_count * rounds_count
+        return public_bytes, {'rounds': rounds_count, 'exchanges': exchanges_count, 'key_derivations': 0,
+                              'messages': exchanges_count, 'max_member_exchanges': rounds_count}
+
+    # Tree protocol, in every round members merge with the other half of their block (see tree_group_key.py).
+    # Returns group keys of the members and counters of the protocol.
+    def __run_tree(self, run_chunks, participants, public_bytes):
+        participants_count = len(participants)
+        rounds_count = tree_rounds_count(participants_count)
+        node_secrets = [None] * participants_count
+        member_exchanges = [0] * participants_count
+        counts = {'rounds': rounds_count, 'exchanges': 0, 'key_derivations': 0, 'messages': 0}
+        for round_idx in range(rounds_count):
+            derive = round_idx < rounds_count - 1
+            active = []
+            received = []
+            for member_idx in range(participants_count):
+                sponsor_idx = sibling_sponsor(member_idx, round_idx, participants_count)
+                if sponsor_idx is not None:
+                    active.append(member_idx)
+                    received.append(public_bytes[sponsor_idx])
+            chunks = self.__chunks(len(active))
+            if self.executor == 'process':
+                tasks = [(_worker_tree_chunk, (active[start:stop], [node_secrets[idx] for idx in active[start:stop]],
+                                               received[start:stop], derive)) for start, stop in chunks]
+            else:
+                tasks = [(_tree_chunk, ([participants[idx] for idx in active[start:stop]], received[start:stop],
+                                        derive)) for start, stop in chunks]
+            for member_idx, (secret, blinded_key) in zip(active, run_chunks(tasks)):
+                node_secrets[member_idx] = secret
+                public_bytes[member_idx] = blinded_key
+                member_exchanges[member_idx] += 1
+
+            counts['exchanges'] += len(active)
+            counts['key_derivations'] += len(active) if derive else 0
+            # Sponsor of every half which has pair broadcasts its blinded key
+            counts['messages'] += len({member_idx - member_idx % (1 << round_idx) for member_idx in active})
+
+        counts['max_member_exchanges'] = max(member_exchanges)
+        return node_secrets, counts
+
+
+def print_result(result):
+    print(f'{result["participants"]:>8} | {result["protocol"]:>8} | {result["executor"]:>8} | {result["workers"]:>7} | '
+          f'{result["rounds"]:>6} | {result["exchanges"]:>9} | {result["max_member_exchanges"]:>10} | '
+          f'{result["messages"]:>9} | {result["worker_key_derivations"]:>11} | '
+          f'{result["keygen_seconds"] * 1e3:>10.2f} | {result["rounds_seconds"] * 1e3:>10.1f} | '
+          f'{result["exchanges_per_second"]:>11.0f} | '
+          f'{"yes" if result["agreed"] else "NO":>6}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ring and tree group key agreement on thread or process pool')
+    parser.add_argument('--sizes', type=int, nargs='*', default=list(DEFAULT_GROUP_SIZES),
+                        help='Numbers of participants')
+    parser.add_argument('--protocols', nargs='*', choices=PROTOCOLS, default=list(PROTOCOLS))
+    parser.add_argument('--executors', nargs='*', choices=EXECUTORS, default=list(EXECUTORS))
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers, number of CPUs by default')
+    args = parser.parse_args()
+
+    print(f'{"members":>8} | {"protocol":>8} | {"executor":>8} | {"workers":>7} | {"rounds":>6} | {"exchanges":>9} | '
+          f'{"per member":>10} | {"messages":>9} | {"worker keys":>11} | {"keygen ms":>10} | {"rounds ms":>10} | '
+          f'{"exchanges/s":>11} | {"agreed":>6}')
+    for participants_count in args.sizes:
+        for protocol in args.protocols:
+            for executor in args.executors:
+                print_result(GroupKeyEngine(executor, args.workers, protocol=protocol).run(participants_count))
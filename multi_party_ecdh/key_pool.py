@@ -0,0 +1,222 @@
+import argparse
+import collections
+import threading
+import time
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
+from ecdh_utils import generate_private_keys, percentiles
+from multi_participant_ecdh import Participant
+
+# Pool is refilled up to the high-water mark when it gets below the low-water mark
+DEFAULT_HIGH_WATER = 256
+DEFAULT_LOW_WATER = 64
+# Key pairs generated from one call of the OS random generator (see generate_private_keys)
+DEFAULT_REFILL_BATCH = 32
+# Bursty load of the demo: bursts of sessions with idle time between them
+DEFAULT_BURSTS = 20
+DEFAULT_BURST_SIZE = 100
+DEFAULT_BURST_INTERVAL = 0.1
+
+
+# Key pairs of count participants: private key, public key and its raw public bytes
+def generate_key_pairs(count):
+    key_pairs = []
+    for raw_key in generate_private_keys(count):
+        private_key = X25519PrivateKey.from_private_bytes(raw_key)
+        public_key = private_key.public_key()
+        key_pairs.append((private_key, public_key, public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)))
+    return key_pairs
+
+
+# Pool of precomputed ephemeral X25519 key pairs, so the key generation is not on the critical path
+# of the session setup. Background thread refills the pool up to high_water key pairs in batches when
+# it gets below low_water. Key pair is taken by acquire in O(1) (deque.popleft), if the pool is empty the key pair
+# is generated in place (miss). Public bytes are serialized once, when the key pair is generated.
+# Every key pair is created once and removed from the pool under the lock when it is handed out, it never
+# returns to the pool, so no key is given twice even to concurrent threads.
+# Counters: hits, misses, generated key pairs, refills and latency of every refill (from the moment the pool
+# got below low_water until it reached high_water).
+class KeyPool():
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, low_water=DEFAULT_LOW_WATER,
+                 refill_batch=DEFAULT_REFILL_BATCH, start=True):
+        # Refill starts when the pool gets below low_water, with low_water = 0 it would never start
+        if not 1 <= low_water < high_water:
+            raise ValueError('Low-water mark must be at least 1 and below the high-water mark')
+        if refill_batch < 1:
+            raise ValueError('Refill batch must be at least 1 key pair')
+        self.high_water = high_water
+        self.low_water = low_water
+        self.refill_batch = refill_batch
+        self.__key_pairs = collections.deque()
+        # Key pairs being generated by fill or the refill thread, they are counted as being in the pool
+        self.__pending = 0
+        self.__condition = threading.Condition()
+        self.__refill_requested = None
+        self.__stopped = False
+        self.__thread = None
+        self.counters = {'hits': 0, 'misses': 0, 'generated': 0, 'refills': 0}
+        self.refill_seconds = []
+        if start:
+            self.start()
+
+    def __len__(self):
+        return len(self.__key_pairs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self.__thread is None:
+            self.__stopped = False
+            self.__thread = threading.Thread(target=self.__refill_loop, name='key-pool-refill', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            with self.__condition:
+                self.__stopped = True
+                self.__condition.notify_all()
+            self.__thread.join()
+            self.__thread = None
+
+    # Fills the pool up to the high-water mark in the calling thread (e.g. before the load starts),
+    # waits for the batch of the refill thread if it is being generated
+    def fill(self):
+        while self.__add_batch():
+            pass
+        with self.__condition:
+            while self.__pending:
+                self.__condition.wait()
+
+    # Size of the batch is reserved under the lock, so fill and the refill thread together do not go above
+    # the high-water mark. Key pairs are generated without the lock. Returns False if there is nothing to add.
+    def __add_batch(self):
+        with self.__condition:
+            count = min(self.refill_batch, self.high_water - len(self.__key_pairs) - self.__pending)
+            if count <= 0:
+                return False
+            self.__pending += count
+        key_pairs = []
+        try:
+            key_pairs = generate_key_pairs(count)
+        finally:
+            with self.__condition:
+                self.__pending -= count
+                self.__key_pairs.extend(key_pairs)
+                self.counters['generated'] += len(key_pairs)
+                self.__condition.notify_all()
+        return True
+
+    def __refill_loop(self):
+        while True:
+            with self.__condition:
+                while not self.__stopped and len(self.__key_pairs) + self.__pending >= self.low_water:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                if self.__refill_requested is None:
+                    self.__refill_requested = time.perf_counter()
+            while not self.__stopped and self.__add_batch():
+                pass
+            with self.__condition:
+                self.counters['refills'] += 1
+                self.refill_seconds.append(time.perf_counter() - self.__refill_requested)
+                self.__refill_requested = None
+
+    # Returns unused key pair (private key, public key, public bytes)
+    def acquire(self):
+        with self.__condition:
+            key_pair = self.__key_pairs.popleft() if self.__key_pairs else None
+            if key_pair is not None:
+                self.counters['hits'] += 1
+            else:
+                self.counters['misses'] += 1
+            if len(self.__key_pairs) < self.low_water and self.__thread is not None:
+                if self.__refill_requested is None:
+                    self.__refill_requested = time.perf_counter()
+                self.__condition.notify_all()
+        if key_pair is None:
+            key_pair = generate_key_pairs(1)[0]
+            with self.__condition:
+                self.counters['generated'] += 1
+        return key_pair
+
+    # Counters, size of the pool, hit rate and percentiles of the refill latency, seconds
+    def stats(self):
+        stats = dict(self.counters)
+        stats['size'] = len(self.__key_pairs)
+        requests_count = self.counters['hits'] + self.counters['misses']
+        stats['hit_rate'] = self.counters['hits'] / requests_count if requests_count else None
+        stats['refill_latency'] = percentiles(self.refill_seconds) if self.refill_seconds else None
+        return stats
+
+
+# Session of two participants (see two_participant_ecdh.py): both get key pairs, from the pool if it is given,
+# and exchange public bytes. Returns time of the setup, seconds.
+def setup_session(key_pool=None):
+    start_time = time.perf_counter()
+    participants = [Participant(0), Participant(1)]
+    for participant in participants:
+        if key_pool is None:
+            participant.generate_key_pair()
+        else:
+            participant.take_key_pair(key_pool)
+    alice, bob = participants
+    alice_public_bytes = alice.public_bytes
+    alice.receive_public_key(bob.public_bytes)
+    bob.receive_public_key(alice_public_bytes)
+    alice.finish_round()
+    bob.finish_round()
+    setup_time = time.perf_counter() - start_time
+    if alice.public_bytes != bob.public_bytes:
+        raise RuntimeError('Shared keys of the session differ')
+    return setup_time
+
+
+# Bursts of sessions with idle interval between them, returns list of setup times of all sessions
+def run_bursty_load(key_pool, bursts=DEFAULT_BURSTS, burst_size=DEFAULT_BURST_SIZE,
+                    burst_interval=DEFAULT_BURST_INTERVAL):
+    setup_times = []
+    for _ in range(bursts):
+        setup_times.extend(setup_session(key_pool) for _ in range(burst_size))
+        time.sleep(burst_interval)
+    return setup_times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Session setup latency with and without the key pool')
+    parser.add_argument('--bursts', type=int, default=DEFAULT_BURSTS)
+    parser.add_argument('--burst-size', type=int, default=DEFAULT_BURST_SIZE, help='Sessions in a burst')
+    parser.add_argument('--burst-interval', type=float, default=DEFAULT_BURST_INTERVAL * 1e3,
+                        help='Idle time between bursts, ms')
+    parser.add_argument('--high-water', type=int, default=DEFAULT_HIGH_WATER)
+    parser.add_argument('--low-water', type=int, default=DEFAULT_LOW_WATER)
+    args = parser.parse_args()
+
+    # Time of the exchanges alone, the lower bound of the setup with the pool
+    key_pairs = generate_key_pairs(2)
+    public_key = X25519PublicKey.from_public_bytes(key_pairs[1][2])
+    start_time = time.perf_counter()
+    for _ in range(1000):
+        key_pairs[0][0].exchange(public_key)
+    exchange_time = (time.perf_counter() - start_time) / 1000
+    print(f'Two exchanges: {2 * exchange_time * 1e6:.1f} us')
+
+    burst_interval = args.burst_interval * 1e-3
+    setup_times = run_bursty_load(None, args.bursts, args.burst_size, burst_interval)
+    print('Without pool, setup us: ' + ', '.join(f'{name} {value * 1e6:.1f}'
+                                                 for name, value in percentiles(setup_times).items()))
+    with KeyPool(args.high_water, args.low_water) as key_pool:
+        key_pool.fill()
+        setup_times = run_bursty_load(key_pool, args.bursts, args.burst_size, burst_interval)
+        stats = key_pool.stats()
+    print('With pool, setup us:    ' + ', '.join(f'{name} {value * 1e6:.1f}'
+                                                 for name, value in percentiles(setup_times).items()))
+    refill_text = 'none' if stats['refill_latency'] is None else \
+        ', '.join(f'{name} {value * 1e3:.2f}' for name, value in stats['refill_latency'].items())
+    print(f'Pool: hits {stats["hits"]}, misses {stats["misses"]}, hit rate {stats["hit_rate"]:.3f}, '
+          f'generated {stats["generated"]}, refills {stats["refills"]}, refill latency ms: {refill_text}')
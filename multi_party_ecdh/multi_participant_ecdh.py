@@ -13,7 +13,7 @@ class Participant():
     def reset(self):
         self.__prkey = None
         self.__pubkey = None
-        self.__rx_pubkey = None
+        self.__received_public_key = None
         self.public_bytes = None
 
     # Extracts bytes array from public key.
@@ -21,48 +21,68 @@ class Participant():
         self.public_bytes = \
             self.__pubkey.public_bytes(Encoding.Raw, PublicFormat.Raw)
 
-    # Generate key pair for ECDH
-    def generate_key_pair(self):
-        self.__prkey = X25519PrivateKey.generate()
+    # Generate key pair for ECDH.
+    # Private key generated beforehand (e.g. in a batch, see group_key_engine.py) may be given.
+    def generate_key_pair(self, private_key=None):
+        self.__prkey = X25519PrivateKey.generate() if private_key is None else private_key
         self.__pubkey = self.__prkey.public_key()
         self.__make_public_bytes()
 
+    # Take precomputed key pair from the key pool (see key_pool.py), its public bytes are already serialized
+    def take_key_pair(self, key_pool):
+        self.__prkey, self.__pubkey, self.public_bytes = key_pool.acquire()
+
     # Receive public key as byte array and store internal public key
     def receive_public_key(self, pubkey_bytes):
         self.__received_public_key = \
             X25519PublicKey.from_public_bytes(pubkey_bytes)
 
-    # Calculate next public key and shared secret
+    # Calculate next public key and shared secret.
+    # Result of the exchange is already the raw public bytes passed to the next participant,
+    # so it is not parsed and serialized again.
     def finish_round(self):
-        public_bytes = self.__prkey.exchange(self.__received_public_key)
-        self.__pubkey = X25519PublicKey.from_public_bytes(public_bytes)
-        self.__make_public_bytes()
+        self.public_bytes = self.__prkey.exchange(self.__received_public_key)
+
+
+# Ring protocol: in every round each participant receives public bytes from the previous neighbour
+# and calculates the next ones, after participants_count - 1 rounds all of them hold the shared secret.
+def run_ring_protocol(participants, verbose=True):
+    participants_count = len(participants)
+
+    # Number of rounds to obtain shared secret
+    rounds_count = participants_count - 1
 
-# Create list of participants
-participants = [Participant(n) for n in range(participants_count) ]
-
-# Number of rounds to obtain shared secret
-rounds_count = participants_count - 1
-
-# Each participant Generate Key pairs
-for cur_participant in participants:
-    print(f"Participant {cur_participant.id} generate key pair.")
-    cur_participant.generate_key_pair()
-
-# Perform rounds for shared secret distributions
-for cur_round_idx in range(rounds_count):
-    print(f"======== Start round {cur_round_idx} ========")
-    # First transfer public keys (public bytes) to the next neighbours
-    for cur_participant_idx in range(participants_count):
-        prev_participant_idx = \
-            (cur_participant_idx + participants_count - 1) % participants_count
-        participants[cur_participant_idx].receive_public_key(
-            participants[prev_participant_idx].public_bytes)
-        print(f"Transfer public key from participant"
-              f" {prev_participant_idx} to {cur_participant_idx}")
-    # Second calculate next public key and shared secret
+    # Perform rounds for shared secret distributions
+    for cur_round_idx in range(rounds_count):
+        if verbose:
+            print(f"======== Start round {cur_round_idx} ========")
+        # First transfer public keys (public bytes) to the next neighbours
+        for cur_participant_idx in range(participants_count):
+            prev_participant_idx = \
+                (cur_participant_idx + participants_count - 1) % participants_count
+            participants[cur_participant_idx].receive_public_key(
+                participants[prev_participant_idx].public_bytes)
+            if verbose:
+                print(f"Transfer public key from participant"
+                      f" {prev_participant_idx} to {cur_participant_idx}")
+        # Second calculate next public key and shared secret
+        for cur_participant in participants:
+            cur_participant.finish_round()
+            if verbose:
+                cur_public_bytes = cur_participant.public_bytes
+                print(f"Participant`s {cur_participant.id} shared secret: "
+                      f"{cur_public_bytes.hex()}")
+
+    return participants[0].public_bytes
+
+
+if __name__ == '__main__':
+    # Create list of participants
+    participants = [Participant(n) for n in range(participants_count) ]
+
+    # Each participant Generate Key pairs
     for cur_participant in participants:
-        cur_participant.finish_round()
-        cur_public_bytes =  cur_participant.public_bytes
-        print(f"Participant`s {cur_participant.id} shared secret: "
-              f"{cur_public_bytes.hex()}")
+        print(f"Participant {cur_participant.id} generate key pair.")
+        cur_participant.generate_key_pair()
+
+    run_ring_protocol(participants)
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import tempfile
+from ecdh_utils import PERCENTILES, percentiles
+from multi_participant_ecdh import Participant
+
+# 'queue' - in-process asyncio queues, 'tcp' - local TCP connections, 'unix' - Unix domain sockets
+TRANSPORTS = ('queue', 'tcp', 'unix')
+DEFAULT_GROUP_SIZES = (4, 16, 64, 256)
+# One way delay of a link and its random addition (uniform from 0 to jitter), seconds
+DEFAULT_LATENCY = 0.5e-3
+DEFAULT_JITTER = 0.1e-3
+# Lost message is sent again after this time, seconds
+DEFAULT_RETRANSMIT_TIMEOUT = 5e-3
+# Message of the protocol: round index and public bytes
+FRAME = struct.Struct('>I32s')
+# First message of a connection: index of the receiving participant
+HELLO = struct.Struct('>I')
+
+
+# Sockets of all links are open at once (two per link and the server)
+def _raise_open_files_limit(files_count):
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and soft_limit < files_count:
+        new_limit = files_count if hard_limit == resource.RLIM_INFINITY else min(files_count, hard_limit)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_limit, hard_limit))
+
+
+# Ring protocol of multi_participant_ecdh.py on a simulated network. Every participant is an asyncio task
+# which receives public bytes from the previous neighbour over its link and sends its result to the next one.
+# Every message goes through the transport (queues or real local sockets) after the link delay:
+# latency plus random jitter, every attempt is lost with probability loss and sent again after
+# retransmit_timeout (retransmission with ideal acknowledgements).
+# Pipelined rounds: participant starts the next round as soon as the key of the previous neighbour arrives,
+# messages carry the round index, early ones are kept until they are needed. With pipelined=False all
+# participants wait for each other at the end of every round (global round barrier), for comparison.
+# Exchanges run in the event loop thread, so with large groups the time of the computations of all
+# participants adds up as if they shared one CPU.
+class NetworkSimulation():
+
+    def __init__(self, transport='queue', latency=DEFAULT_LATENCY, jitter=DEFAULT_JITTER, loss=0.0,
+                 retransmit_timeout=DEFAULT_RETRANSMIT_TIMEOUT, pipelined=True, seed=None):
+        if transport not in TRANSPORTS:
+            raise ValueError(f'Unknown transport {transport}, expected one of {TRANSPORTS}')
+        if not 0 <= loss < 1:
+            raise ValueError('Loss probability must be in [0, 1)')
+        self.transport = transport
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.retransmit_timeout = retransmit_timeout
+        self.pipelined = pipelined
+        self.__random = random.Random(seed)
+        self.__retransmissions = 0
+
+    # Delay of the message on the link, including retransmissions of lost attempts
+    def __link_delay(self):
+        delay = self.latency + self.__random.uniform(0, self.jitter)
+        while self.__random.random() < self.loss:
+            self.__retransmissions += 1
+            delay += self.retransmit_timeout
+        return delay
+
+    # Runs the protocol for participants_count participants.
+    # Returns dictionary with the group key, numbers of messages and latency percentiles, seconds:
+    #   round_latency - time of one round of a participant (waiting for the key and the exchange)
+    #   end_to_end    - time from the start until the participant has the group key
+    #   group_round   - time between the moments when all participants have finished consecutive rounds
+    def run(self, participants_count):
+        if participants_count < 2:
+            raise ValueError('Group must have at least 2 participants')
+        return asyncio.run(self.__run(participants_count))
+
+    async def __run(self, participants_count):
+        loop = asyncio.get_running_loop()
+        self.__retransmissions = 0
+        participants = [Participant(idx) for idx in range(participants_count)]
+        for participant in participants:
+            participant.generate_key_pair()
+        inboxes = [asyncio.Queue() for _ in range(participants_count)]
+        senders, close = await self.__connect(inboxes)
+
+        rounds_count = participants_count - 1
+        round_latencies = []
+        finish_times = [[0.0] * participants_count for _ in range(rounds_count)]
+        round_done = [0] * rounds_count
+        round_events = [asyncio.Event() for _ in range(rounds_count)]
+
+        # Message of the round is written to the transport of the next participant after the link delay
+        def send(member_idx, round_idx, public_bytes):
+            loop.call_later(self.__link_delay(), senders[(member_idx + 1) % participants_count],
+                            FRAME.pack(round_idx, public_bytes))
+
+        async def member(member_idx, participant, start_time):
+            inbox = inboxes[member_idx]
+            early = {}
+            previous_time = start_time
+            send(member_idx, 0, participant.public_bytes)
+            for round_idx in range(rounds_count):
+                while round_idx not in early:
+                    frame_round, public_bytes = FRAME.unpack(await inbox.get())
+                    early[frame_round] = public_bytes
+                participant.receive_public_key(early.pop(round_idx))
+                participant.finish_round()
+                finish_time = loop.time()
+                round_latencies.append(finish_time - previous_time)
+                finish_times[round_idx][member_idx] = finish_time - start_time
+                previous_time = finish_time
+                if not self.pipelined:
+                    round_done[round_idx] += 1
+                    if round_done[round_idx] == participants_count:
+                        round_events[round_idx].set()
+                    await round_events[round_idx].wait()
+                if round_idx < rounds_count - 1:
+                    send(member_idx, round_idx + 1, participant.public_bytes)
+
+        try:
+            start_time = loop.time()
+            await asyncio.gather(*[member(idx, participant, start_time)
+                                   for idx, participant in enumerate(participants)])
+            total_time = loop.time() - start_time
+        finally:
+            await close()
+
+        completion_times = [max(times) for times in finish_times]
+        group_key = participants[0].public_bytes
+        messages_count = participants_count * rounds_count
+        return {
+            'participants': participants_count,
+            'transport': self.transport,
+            'pipelined': self.pipelined,
+            'latency': self.latency,
+            'jitter': self.jitter,
+            'loss': self.loss,
+            'rounds': rounds_count,
+            'messages': messages_count,
+            'retransmissions': self.__retransmissions,
+            'group_key': group_key.hex(),
+            'agreed': all(participant.public_bytes == group_key for participant in participants),
+            'total_seconds': total_time,
+            'round_latency': percentiles(round_latencies),
+            'end_to_end': percentiles(finish_times[-1]),
+            'group_round': percentiles([completion - previous for previous, completion
+                                        in zip([0.0] + completion_times[:-1], completion_times)]),
+        }
+
+    # Creates links of the transport. Returns list of functions writing a frame to the inbox of every participant
+    # and coroutine function closing the links.
+    async def __connect(self, inboxes):
+        if self.transport == 'queue':
+            async def close():
+                pass
+            return [inbox.put_nowait for inbox in inboxes], close
+
+        # Frames of the connection are read into the inbox of the participant given in the first message
+        async def handle_connection(reader, writer):
+            inbox = inboxes[HELLO.unpack(await reader.readexactly(HELLO.size))[0]]
+            try:
+                while True:
+                    inbox.put_nowait(await reader.readexactly(FRAME.size))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        _raise_open_files_limit(2 * len(inboxes) + 64)
+        socket_dir = None
+        if self.transport == 'tcp':
+            server = await asyncio.start_server(handle_connection, '127.0.0.1', 0, backlog=len(inboxes))
+            port = server.sockets[0].getsockname()[1]
+            open_connection = functools.partial(asyncio.open_connection, '127.0.0.1', port)
+        else:
+            socket_dir = tempfile.mkdtemp()
+            path = os.path.join(socket_dir, 'ecdh.sock')
+            server = await asyncio.start_unix_server(handle_connection, path, backlog=len(inboxes))
+            open_connection = functools.partial(asyncio.open_unix_connection, path)
+
+        writers = []
+        for member_idx in range(len(inboxes)):
+            _, writer = await open_connection()
+            writer.write(HELLO.pack(member_idx))
+            writers.append(writer)
+
+        async def close():
+            for writer in writers:
+                writer.close()
+            for writer in writers:
+                await writer.wait_closed()
+            server.close()
+            await server.wait_closed()
+            if socket_dir is not None:
+                shutil.rmtree(socket_dir, ignore_errors=True)
+
+        return [writer.write for writer in writers], close
+
+
+def print_result(result):
+    print(f'{result["participants"]:>8} | {result["transport"]:>9} | '
+          f'{"pipelined" if result["pipelined"] else "barrier":>9} | {result["rounds"]:>6} | '
+          f'{result["retransmissions"]:>7} | '
+          + ' | '.join(f'{result[name][f"p{level}"] * 1e3:>10.3f}' for name in ('round_latency', 'end_to_end')
+                       for level in PERCENTILES)
+          + f' | {result["total_seconds"]:>8.3f} | {"yes" if result["agreed"] else "NO":>6}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ring group key agreement over simulated network links')
+    parser.add_argument('--sizes', type=int, nargs='*', default=list(DEFAULT_GROUP_SIZES),
+                        help='Numbers of participants (from 4 to 1000 and more)')
+    parser.add_argument('--transports', nargs='*', choices=TRANSPORTS, default=list(TRANSPORTS))
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY * 1e3, help='Link latency, ms')
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER * 1e3, help='Link jitter, ms')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability of message loss')
+    parser.add_argument('--retransmit', type=float, default=DEFAULT_RETRANSMIT_TIMEOUT * 1e3,
+                        help='Retransmit timeout, ms')
+    parser.add_argument('--barrier', action='store_true', help='Also run with global round barrier')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    print(f'{"members":>8} | {"transport":>9} | {"mode":>9} | {"rounds":>6} | {"retrans":>7} | '
+          + ' | '.join(f'{f"{name} p{level}":>10}' for name in ('round', 'e2e') for level in PERCENTILES)
+          + f' | {"total s":>8} | {"agreed":>6}')
+    results = []
+    for participants_count in args.sizes:
+        for transport in args.transports:
+            for pipelined in ((True, False) if args.barrier else (True,)):
+                simulation = NetworkSimulation(transport, args.latency * 1e-3, args.jitter * 1e-3, args.loss,
+                                               args.retransmit * 1e-3, pipelined, args.seed)
+                results.append(simulation.run(participants_count))
+                print_result(results[-1])
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -0,0 +1,294 @@
+import argparse
+import random
+import time
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from multi_participant_ecdh import Participant
+
+# Tree-based group key agreement (TGDH) built on Participant of multi_participant_ecdh.py.
+#
+# Members are leaves of a binary tree. Every node has a secret key and a blinded key (its public bytes).
+# Secret of the parent is the X25519 exchange of the secret of one child with the blinded key of the other,
+# both children get the same value. The secret is used as the private key of the parent, so its blinded key
+# is the public key of this private key. Secret of the root is the group key.
+#
+# Leaves are grouped into blocks of 2**(round + 1) consecutive members. In every round the two halves of
+# each block are merged: every member receives the blinded key of the other half from its sponsor (the first
+# member of the half) and computes the secret and the blinded key of the merged node. A half without pair
+# (the group size is not a power of two) is promoted to the next round unchanged.
+# The protocol takes ceil(log2(n)) rounds, every member does at most one exchange per round.
+
+
+# Number of rounds of the tree protocol for the group of participants_count members
+def tree_rounds_count(participants_count):
+    return (participants_count - 1).bit_length()
+
+
+# Index of the member whose blinded key member_idx receives in the round (from 0),
+# None if the member has no pair in this round
+def sibling_sponsor(member_idx, round_idx, participants_count):
+    half = 1 << round_idx
+    block_start = member_idx - member_idx % (2 * half)
+    if member_idx < block_start + half:
+        sponsor = block_start + half
+        return sponsor if sponsor < participants_count else None
+    return block_start
+
+
+# One round of the tree protocol for the participant whose key pair is the key pair of its current node.
+# Returns secret of the merged node and its blinded key. When derive is False (the last round) the blinded key
+# is not needed and is not calculated, the secret is returned instead.
+def tree_step(participant, sibling_public_bytes, derive=True):
+    participant.receive_public_key(sibling_public_bytes)
+    participant.finish_round()
+    secret = participant.public_bytes
+    if derive:
+        participant.generate_key_pair(X25519PrivateKey.from_private_bytes(secret))
+    return secret, participant.public_bytes
+
+
+# Tree protocol for participants with generated key pairs, returns the group key of the first participant
+def run_tree_protocol(participants, verbose=True):
+    participants_count = len(participants)
+    rounds_count = tree_rounds_count(participants_count)
+    secrets = [None] * participants_count
+    for round_idx in range(rounds_count):
+        if verbose:
+            print(f"======== Start round {round_idx} ========")
+        blinded_keys = [participant.public_bytes for participant in participants]
+        for member_idx, participant in enumerate(participants):
+            sponsor_idx = sibling_sponsor(member_idx, round_idx, participants_count)
+            if sponsor_idx is None:
+                continue
+            secrets[member_idx], _ = tree_step(participant, blinded_keys[sponsor_idx],
+                                               round_idx < rounds_count - 1)
+            if verbose:
+                print(f"Participant {member_idx} merged with the half of participant {sponsor_idx}: "
+                      f"{secrets[member_idx].hex()}")
+
+    return secrets[0]
+
+
+# Node of the key tree. Leaf holds participant of the member, internal node holds its secret.
+# Key pair of internal node (participant created from the secret) and its blinded key are calculated
+# when they are needed first time and are kept until the secret changes.
+class _TreeNode():
+    def __init__(self, member_id=None, participant=None):
+        self.member_id = member_id
+        self.parent = None
+        self.left = None
+        self.right = None
+        self.leaves_count = 1
+        self.secret = None
+        self.participant = participant
+        self.blinded_key = None if participant is None else participant.public_bytes
+
+    def is_leaf(self):
+        return self.left is None
+
+
+# Group of members sharing the key of the key tree (see the description of the tree protocol above)
+# which is updated incrementally when members join or leave.
+# Secrets and blinded keys of all nodes are cached. Join or leave changes only the nodes on the path from
+# the changed leaf to the root: the sponsor (member next to the changed place) generates a fresh leaf key
+# and the secrets of the nodes on its path are calculated again with one exchange per node, the rest of
+# the tree is reused. Rekey takes O(log n) exchanges instead of the full run of the protocol.
+# New member is added next to the leaf reached by going to the subtree with fewer leaves, so the tree stays
+# balanced. Every member needs only its leaf key and the blinded keys of the siblings of its path
+# (see member_state), O(log n) values.
+class TreeGroup():
+
+    def __init__(self):
+        self.root = None
+        self.__leaves = {}
+        # Operations since the group was created
+        self.counters = {'exchanges': 0, 'key_derivations': 0, 'key_generations': 0}
+
+    def __len__(self):
+        return len(self.__leaves)
+
+    def __contains__(self, member_id):
+        return member_id in self.__leaves
+
+    def members(self):
+        return list(self.__leaves)
+
+    # Group key is the secret of the root, the group of one member has no key
+    @property
+    def group_key(self):
+        return None if self.root is None or self.root.is_leaf() else self.root.secret
+
+    # Fresh leaf of the member with new key pair
+    def __new_leaf(self, member_id):
+        participant = Participant(member_id)
+        participant.generate_key_pair()
+        self.counters['key_generations'] += 1
+        return _TreeNode(member_id, participant)
+
+    # Key pair of internal node is created from its secret
+    def __node_participant(self, node):
+        if node.participant is None:
+            node.participant = Participant(None)
+            node.participant.generate_key_pair(X25519PrivateKey.from_private_bytes(node.secret))
+            node.blinded_key = node.participant.public_bytes
+            self.counters['key_derivations'] += 1
+        return node.participant
+
+    def __blinded_key(self, node):
+        self.__node_participant(node)
+        return node.blinded_key
+
+    # Secrets of the node and of all its ancestors are calculated again, returns number of exchanges
+    def __refresh_path(self, node):
+        exchanges_count = 0
+        while node is not None:
+            node.leaves_count = node.left.leaves_count + node.right.leaves_count
+            right_blinded_key = self.__blinded_key(node.right)
+            participant = self.__node_participant(node.left)
+            participant.receive_public_key(right_blinded_key)
+            participant.finish_round()
+            node.secret = participant.public_bytes
+            node.participant = None
+            node.blinded_key = None
+            exchanges_count += 1
+            node = node.parent
+        self.counters['exchanges'] += exchanges_count
+        return exchanges_count
+
+    # Leaf of the member replaces node in the tree with fresh key pair
+    def __refresh_leaf(self, node):
+        leaf = self.__new_leaf(node.member_id)
+        self.__replace(node, leaf)
+        self.__leaves[node.member_id] = leaf
+        return leaf
+
+    # Puts new node to the place of node in the tree
+    def __replace(self, node, new_node):
+        parent = node.parent
+        new_node.parent = parent
+        if parent is None:
+            self.root = new_node
+        elif parent.left is node:
+            parent.left = new_node
+        else:
+            parent.right = new_node
+
+    # Adds member to the group and rekeys it. Returns dictionary of the operations done by the rekey.
+    def join(self, member_id):
+        if member_id in self.__leaves:
+            raise ValueError(f'Member {member_id} is already in the group')
+        counters_before = dict(self.counters)
+        leaf = self.__new_leaf(member_id)
+        self.__leaves[member_id] = leaf
+        exchanges_count = 0
+        if self.root is None:
+            self.root = leaf
+        else:
+            # Sponsor is the leaf of the smaller subtree, it gets fresh key and the new member as sibling
+            sponsor = self.root
+            while not sponsor.is_leaf():
+                sponsor = sponsor.left if sponsor.left.leaves_count <= sponsor.right.leaves_count else sponsor.right
+            sponsor = self.__refresh_leaf(sponsor)
+            node = _TreeNode()
+            self.__replace(sponsor, node)
+            node.left, node.right = sponsor, leaf
+            sponsor.parent = leaf.parent = node
+            exchanges_count = self.__refresh_path(node)
+        return self.__event_counters(counters_before, exchanges_count)
+
+    # Removes member from the group and rekeys it. Returns dictionary of the operations done by the rekey.
+    def leave(self, member_id):
+        leaf = self.__leaves.pop(member_id)
+        counters_before = dict(self.counters)
+        parent = leaf.parent
+        exchanges_count = 0
+        if parent is None:
+            self.root = None
+        else:
+            # Sibling subtree takes place of the parent, its rightmost leaf is the sponsor and gets fresh key
+            sibling = parent.left if parent.right is leaf else parent.right
+            self.__replace(parent, sibling)
+            sponsor = sibling
+            while not sponsor.is_leaf():
+                sponsor = sponsor.right
+            sponsor = self.__refresh_leaf(sponsor)
+            exchanges_count = self.__refresh_path(sponsor.parent)
+        return self.__event_counters(counters_before, exchanges_count)
+
+    def __event_counters(self, counters_before, exchanges_count):
+        counters = {name: value - counters_before[name] for name, value in self.counters.items()}
+        counters['exchanges'] = exchanges_count
+        counters['members'] = len(self.__leaves)
+        return counters
+
+    # State the member needs to calculate the group key: its leaf participant and blinded keys of the siblings
+    # of the nodes on its path from the leaf to the root
+    def member_state(self, member_id):
+        node = self.__leaves[member_id]
+        co_path = []
+        while node.parent is not None:
+            parent = node.parent
+            co_path.append(self.__blinded_key(parent.right if parent.left is node else parent.left))
+            node = parent
+        return self.__leaves[member_id].participant, co_path
+
+
+# Group key calculated by the member from its state only (see TreeGroup.member_state). Exchange of the node
+# key with the blinded key of the sibling gives the same secret for the left and the right child,
+# so the position of the node is not needed. Key pair of the leaf participant is not changed.
+def group_key_from_state(participant, co_path):
+    secret = None
+    for sibling_blinded_key in co_path:
+        if secret is not None:
+            participant = Participant(participant.id)
+            participant.generate_key_pair(X25519PrivateKey.from_private_bytes(secret))
+        participant.receive_public_key(sibling_blinded_key)
+        participant.finish_round()
+        secret = participant.public_bytes
+    return secret
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tree group with members joining and leaving')
+    parser.add_argument('--members', type=int, default=256, help='Initial number of members')
+    parser.add_argument('--events', type=int, default=200, help='Number of random joins and leaves')
+    parser.add_argument('--check', type=int, default=8, help='Number of members checking the key after every event')
+    args = parser.parse_args()
+
+    group = TreeGroup()
+    start_time = time.perf_counter()
+    for member_id in range(args.members):
+        group.join(member_id)
+    print(f'Group of {len(group)} members built by joins in {(time.perf_counter() - start_time) * 1e3:.1f} ms, '
+          f'{group.counters["exchanges"]} exchanges')
+
+    next_member_id = args.members
+    events = {'join': [], 'leave': []}
+    event_time = 0.0
+    for _ in range(args.events):
+        start_time = time.perf_counter()
+        if random.random() < 0.5 and len(group) > 2:
+            event = 'leave'
+            counters = group.leave(random.choice(group.members()))
+        else:
+            event = 'join'
+            counters = group.join(next_member_id)
+            next_member_id += 1
+        event_time += time.perf_counter() - start_time
+        events[event].append(counters)
+        # Members calculate the new key from their own state
+        for member_id in random.sample(group.members(), min(args.check, len(group))):
+            if group_key_from_state(*group.member_state(member_id)) != group.group_key:
+                raise SystemExit(f'Member {member_id} has wrong group key')
+
+    members_count = len(group)
+    for event, event_counters in events.items():
+        if event_counters:
+            exchanges = [counters['exchanges'] for counters in event_counters]
+            print(f'{event:>5}: {len(event_counters)} events, exchanges per rekey: '
+                  f'mean {sum(exchanges) / len(exchanges):.1f}, max {max(exchanges)}')
+    print(f'Mean time of rekey: {event_time / args.events * 1e3:.2f} ms')
+    print(f'Full recalculation for {members_count} members: ring {members_count * (members_count - 1)} exchanges, '
+          f'tree {tree_rounds_count(members_count) * members_count} exchanges')
+    max_co_path = max(len(group.member_state(member_id)[1]) for member_id in group.members())
+    print(f'Member state: leaf key and up to {max_co_path} blinded keys of 32 bytes, '
+          f'group key checked by {args.check} members after every event')